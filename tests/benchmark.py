@@ -0,0 +1,345 @@
+# 可重复的离线基准测试，不需要网络和摄像头，结果写成JSON，可以在不同提交之间对比
+# 输入是用ffmpeg lavfi测试源(testsrc2)生成的本地视频文件，输出写到本地文件，
+# 每个用例在单独的子进程中运行，内存峰值和CPU时间互不影响：
+#   pull_decode    - Pull离线模式以最快速度解码，吞吐量(帧/秒)、读一帧阻塞时间、CPU、内存
+#   push_encode    - Push按目标帧率编码推流到本地文件，实际帧率、重复/丢弃的帧数、写一帧阻塞时间、CPU
+#   push_throughput - Push不限速地编码推流到本地文件，持续的最大编码帧率、写一帧阻塞时间、CPU
+#   pullpush_relay - PullPush转封装/重新编码转推到本地文件，ffmpeg报告的帧率和速度、每秒CPU时间
+#   pull_scaling   - 同时按原始帧率拉1到N路流，每路实际帧率、CPU、线程数、内存
+# 用法：
+#   python tests/benchmark.py --out results.json                 # 完整测试
+#   python tests/benchmark.py --quick --out results.json         # 只测小分辨率，约1分钟
+#   python tests/benchmark.py --compare base.json results.json   # 对比两次结果
+import argparse
+import json
+import os
+import platform
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from videostream import Pull, PullPush, Push
+from videostream.framering import BLOCK
+from videostream.tools import get_out_numpy_shape
+
+
+def make_source(path: str, size: str, fps: int, secs: int):
+    """用lavfi测试源生成H.264视频文件，关键帧间隔2秒"""
+    cmd = (f"ffmpeg -loglevel error -y -f lavfi -i testsrc2=size={size}:rate={fps} -t {secs} "
+           f"-c:v libx264 -preset ultrafast -g {2 * fps} -pix_fmt yuv420p '{path}'")
+    subprocess.check_call(shlex.split(cmd))
+
+
+def percentile(hist: dict, q: float) -> float:
+    """由Histogram.snapshot估计分位数，取所在分桶的上限，超过最大分桶时返回最大分桶的上限"""
+    if hist["count"] == 0:
+        return 0.
+    target, cumulative = q * hist["count"], 0
+    for le, n in zip(hist["buckets"], hist["counts"]):
+        cumulative += n
+        if cumulative >= target:
+            return le
+    return hist["buckets"][-1]
+
+
+def latency_metrics(hist: dict, prefix: str) -> dict:
+    return {
+        f"{prefix}_mean_ms": hist["sum"] / hist["count"] * 1e3 if hist["count"] else 0.,
+        f"{prefix}_p50_ms": percentile(hist, 0.5) * 1e3,
+        f"{prefix}_p99_ms": percentile(hist, 0.99) * 1e3,
+    }
+
+
+def usage() -> dict:
+    """当前进程和已经结束的子进程(ffmpeg、ffprobe)的CPU时间和内存峰值"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu_python_s": own.ru_utime + own.ru_stime,
+        "cpu_ffmpeg_s": children.ru_utime + children.ru_stime,
+        # Linux上ru_maxrss的单位是KB，macOS上是字节
+        "maxrss_python_mb": own.ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10),
+        "maxrss_ffmpeg_mb": children.ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10),
+    }
+
+
+def usage_delta(before: dict, after: dict) -> dict:
+    delta = {k: after[k] - before[k] for k in ("cpu_python_s", "cpu_ffmpeg_s")}
+    delta.update({k: after[k] for k in ("maxrss_python_mb", "maxrss_ffmpeg_mb")})
+    return delta
+
+
+def case_pull_decode(src: str, pix_fmt: str = "bgr24") -> dict:
+    before = usage()
+    t = time.perf_counter()
+    pull = Pull(src, pix_fmt=pix_fmt, offline=True)
+    frames = sum(1 for _ in pull)
+    wall = time.perf_counter() - t
+    stats = pull.stats()
+    pull.release()
+    metrics = usage_delta(before, usage())
+    return {
+        "frames": frames,
+        "wall_s": wall,
+        "fps": frames / wall,
+        **latency_metrics(stats["read_latency"], "read_latency"),
+        "cpu_per_frame_ms": (metrics["cpu_python_s"] + metrics["cpu_ffmpeg_s"]) / max(frames, 1) * 1e3,
+        **metrics,
+    }
+
+
+def case_push_encode(out: str, size: str, fps: int, secs: float, pix_fmt: str = "bgr24") -> dict:
+    w, h = (int(v) for v in size.split("x"))
+    # 预先生成几帧不同的画面，计时部分只有put_frame
+    frames = [np.random.randint(0, 255, get_out_numpy_shape((w, h), pix_fmt), dtype=np.uint8) for _ in range(4)]
+    before = usage()
+    push = Push(out, w, h, fps, pix_fmt=pix_fmt)
+    # 等待推流打开期间写入的黑帧不计入
+    start = push.stats()
+    t = time.monotonic()
+    n = 0
+    while time.monotonic() - t < secs:
+        push.put_frame(frames[n % len(frames)])
+        n += 1
+        delay = t + n / fps - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    stats = push.stats()
+    wall = time.monotonic() - t
+    push.release()
+    metrics = usage_delta(before, usage())
+    frames_out = stats["frames_out"] - start["frames_out"]
+    return {
+        "frames_in": stats["frames_in"],
+        "frames_out": frames_out,
+        "fps_out": frames_out / wall,
+        "target_fps": fps,
+        "repeated": stats["repeated"] - start["repeated"],
+        "dropped": stats["dropped"],
+        "ffmpeg_speed": stats["ffmpeg"].get("speed", 0.),
+        **latency_metrics(stats["write_latency"], "write_latency"),
+        "cpu_per_frame_ms": (metrics["cpu_python_s"] + metrics["cpu_ffmpeg_s"]) / max(frames_out, 1) * 1e3,
+        **metrics,
+    }
+
+
+def case_push_throughput(out: str, size: str, secs: float, pix_fmt: str = "bgr24") -> dict:
+    """不按帧率限速：可变帧率加BLOCK策略，put_frame只在缓冲区满时等待编码，测量持续的最大编码帧率"""
+    w, h = (int(v) for v in size.split("x"))
+    frames = [np.random.randint(0, 255, get_out_numpy_shape((w, h), pix_fmt), dtype=np.uint8) for _ in range(4)]
+    before = usage()
+    push = Push(out, w, h, 25, pix_fmt=pix_fmt, vfr=True, buffer_policy=BLOCK)
+    push.wait_opened(10)
+    start = push.stats()
+    t = time.monotonic()
+    n = 0
+    while time.monotonic() - t < secs:
+        push.put_frame(frames[n % len(frames)])
+        n += 1
+    stats = push.stats()
+    wall = time.monotonic() - t
+    push.release()
+    metrics = usage_delta(before, usage())
+    frames_out = stats["frames_out"] - start["frames_out"]
+    return {
+        "frames_out": frames_out,
+        "fps_out": frames_out / wall,
+        "dropped": stats["dropped"],
+        "ffmpeg_speed": stats["ffmpeg"].get("speed", 0.),
+        **latency_metrics(stats["write_latency"], "write_latency"),
+        "cpu_per_frame_ms": (metrics["cpu_python_s"] + metrics["cpu_ffmpeg_s"]) / max(frames_out, 1) * 1e3,
+        **metrics,
+    }
+
+
+def case_pullpush_relay(src: str, out: str, copy: bool, secs: float) -> dict:
+    before = usage()
+    pp = PullPush(src, out, copy=copy)
+    opened = pp.wait_opened(10)
+    time.sleep(secs)
+    stats = pp.stats()
+    pp.release()
+    metrics = usage_delta(before, usage())
+    return {
+        "opened": opened,
+        "stream_copy": stats["stream_copy"],
+        # 转封装时ffmpeg不报告帧数和帧率，只有输出时间和速度
+        "ffmpeg_fps": stats["ffmpeg"].get("fps", 0.),
+        "ffmpeg_speed": stats["ffmpeg"].get("speed", 0.),
+        "ffmpeg_out_time_s": stats["ffmpeg"].get("out_time_us", 0) / 1e6,
+        "cpu_per_s": (metrics["cpu_python_s"] + metrics["cpu_ffmpeg_s"]) / (stats["age"] or 1),
+        **metrics,
+    }
+
+
+def case_pull_scaling(src: str, n: int, secs: float, fps: int) -> dict:
+    before = usage()
+    pulls = [Pull(src, block=False) for _ in range(n)]
+    opened = sum(pull.wait_opened(20) for pull in pulls)
+    threads = threading.active_count()
+    # 开始时ffmpeg会先快速读入一小段(-re的initial burst)，跳过第1秒再计数
+    time.sleep(1)
+    for pull in pulls:
+        while pull.has_frame():
+            pull.get_frame()
+    frames = 0
+    t = time.monotonic()
+    while time.monotonic() - t < secs:
+        for pull in pulls:
+            while pull.has_frame():
+                pull.get_frame()
+                frames += 1
+        time.sleep(0.002)
+    wall = time.monotonic() - t
+    stats = [pull.stats() for pull in pulls]
+    for pull in pulls:
+        pull.stop()
+    for pull in pulls:
+        pull.release()
+    metrics = usage_delta(before, usage())
+    per_stream_fps = frames / wall / n
+    return {
+        "opened": opened,
+        "threads": threads,
+        "frames": frames,
+        "fps_per_stream": per_stream_fps,
+        # 每路实际帧率和原始帧率之比，跟不上时小于1
+        "realtime_ratio": per_stream_fps / fps,
+        "dropped": sum(s["dropped"] for s in stats),
+        **latency_metrics(stats[0]["read_latency"], "read_latency"),
+        "cpu_per_s": (metrics["cpu_python_s"] + metrics["cpu_ffmpeg_s"]) / wall,
+        **metrics,
+    }
+
+
+CASES = {
+    "pull_decode": case_pull_decode,
+    "push_encode": case_push_encode,
+    "push_throughput": case_push_throughput,
+    "pullpush_relay": case_pullpush_relay,
+    "pull_scaling": case_pull_scaling,
+}
+
+
+def run_case(name: str, params: dict) -> dict:
+    """在子进程中运行一个用例，返回它的指标"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--case", name, "--params", json.dumps(params)]
+    env = dict(os.environ)
+    # 子进程需要能导入videostream
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                      env.get("PYTHONPATH")]))
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, env=env, timeout=600)
+    if result.returncode != 0:
+        return {"error": f"returncode {result.returncode}"}
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def metadata() -> dict:
+    def output(args: list) -> str:
+        try:
+            return subprocess.check_output(args, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": output(["git", "rev-parse", "--short", "HEAD"]),
+        "ffmpeg": output(["ffmpeg", "-version"]).split("\n")[0],
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def plan(tmp: str, quick: bool, streams: list[int]) -> list[tuple]:
+    """生成输入文件，返回[(用例名, 参数), ...]"""
+    fps = 25
+    sizes = ["640x360"] if quick else ["640x360", "1280x720", "1920x1080"]
+    secs = 3 if quick else 10
+    sources = dict()
+    for size in sizes:
+        # 按原始帧率读取的用例(转推、多路拉流)在测量结束之前不能播放完
+        sources[size] = os.path.join(tmp, f"src_{size}.mp4")
+        make_source(sources[size], size, fps, 2 * secs + 5)
+
+    cases = []
+    for size in sizes:
+        cases.append(("pull_decode", {"src": sources[size]}))
+    for size in sizes:
+        out = os.path.join(tmp, f"push_{size}.flv")
+        cases.append(("push_encode", {"out": out, "size": size, "fps": fps, "secs": secs}))
+    for size in sizes:
+        out = os.path.join(tmp, f"push_max_{size}.flv")
+        cases.append(("push_throughput", {"out": out, "size": size, "secs": secs}))
+    for size in sizes:
+        for copy in (True, False):
+            # 每个用例写到不同的文件，转推命令没有-y，文件已经存在时ffmpeg会等待确认
+            out = os.path.join(tmp, f"relay_{size}_{'copy' if copy else 'transcode'}.flv")
+            cases.append(("pullpush_relay", {"src": sources[size], "out": out, "copy": copy, "secs": secs}))
+    for n in streams:
+        cases.append(("pull_scaling", {"src": sources[sizes[0]], "n": n, "secs": secs, "fps": fps}))
+    return cases
+
+
+def label(params: dict) -> str:
+    """用例参数中除了文件路径之外的部分，用于显示和对比"""
+    shown = {k: (os.path.basename(v) if k == "src" else v) for k, v in params.items() if k != "out"}
+    return " ".join(f"{k}={v}" for k, v in shown.items())
+
+
+def compare(base_path: str, new_path: str):
+    """按用例名和参数对比两次结果，打印每个指标的变化"""
+    with open(base_path) as f:
+        base = {(r["case"], label(r["params"])): r["metrics"] for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    for r in new:
+        key = (r["case"], label(r["params"]))
+        if key not in base:
+            continue
+        print(f"{key[0]} {key[1]}")
+        for metric, value in r["metrics"].items():
+            old = base[key].get(metric)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            change = f"{(value - old) / old * 100:+.1f}%" if old else ""
+            print(f"  {metric:>22} {old:>12.3f} -> {value:>12.3f} {change:>8}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="videostream离线基准测试")
+    parser.add_argument("--out", default="benchmark.json", help="结果JSON文件")
+    parser.add_argument("--quick", action="store_true", help="只测640x360，每个用例3秒")
+    parser.add_argument("--streams", default="1,2,4,8", help="pull_scaling的并发路数，逗号分隔")
+    parser.add_argument("--only", default="", help="只运行这些用例，逗号分隔")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="对比两次结果，不运行测试")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--params", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.case:
+        # 子进程：运行一个用例，最后一行输出指标
+        print(json.dumps(CASES[args.case](**json.loads(args.params))))
+    else:
+        only = [c for c in args.only.split(",") if c]
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, params in plan(tmp, args.quick, [int(n) for n in args.streams.split(",")]):
+                if only and name not in only:
+                    continue
+                metrics = run_case(name, params)
+                results.append({"case": name, "params": params, "metrics": metrics})
+                summary = ", ".join(f"{k}={v:.3g}" if isinstance(v, float) else f"{k}={v}"
+                                    for k, v in list(metrics.items())[:4])
+                print(f"{name:>15} {label(params):<40} {summary}")
+        with open(args.out, "w") as f:
+            json.dump({"meta": metadata(), "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"结果已写入{args.out}")
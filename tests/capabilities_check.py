@@ -0,0 +1,102 @@
+# 用一个输出固定内容的假ffmpeg脚本检查能力探测、磁盘缓存和加速器选择，不需要真的ffmpeg和显卡(只支持类Unix系统)
+import os
+import stat
+import sys
+import tempfile
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="videostream_caps_")
+os.environ["PATH"] = TMP_DIR + os.pathsep + os.environ["PATH"]
+os.environ["VIDEOSTREAM_CACHE_DIR"] = os.path.join(TMP_DIR, "cache")
+
+from videostream import capabilities  # noqa: E402
+from videostream.accelerator import NvidiaAccel, IntelAccel, CpuAccel, detect_accel  # noqa: E402
+
+CANNED = {
+    "-version": "ffmpeg version 6.1.1-fake Copyright (c) 2000-2023 the FFmpeg developers\n",
+    "-encoders": ("Encoders:\n"
+                  " V..... = Video\n"
+                  " A..... = Audio\n"
+                  " ------\n"
+                  " V....D libopenh264          OpenH264 H.264 / AVC (codec h264)\n"
+                  " V....D h264_nvenc           NVIDIA NVENC H.264 encoder (codec h264)\n"
+                  " V....D hevc_nvenc           NVIDIA NVENC hevc encoder (codec hevc)\n"
+                  " V....D libsvtav1            SVT-AV1 (codec av1)\n"
+                  " V....D libaom-av1           libaom AV1 (codec av1)\n"
+                  " A....D aac                  AAC (Advanced Audio Coding)\n"),
+    "-decoders": ("Decoders:\n"
+                  " V..... = Video\n"
+                  " ------\n"
+                  " VFS..D h264                 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10\n"
+                  " V..... h264_cuvid           Nvidia CUVID H264 decoder (codec h264)\n"
+                  " VFS..D hevc                 HEVC (High Efficiency Video Coding)\n"
+                  " V....D libdav1d             dav1d AV1 decoder by VideoLAN (codec av1)\n"
+                  " V....D av1                  Alliance for Open Media AV1\n"),
+    "-hwaccels": "Hardware acceleration methods:\nvdpau\ncuda\n\n",
+    "-filters": ("Filters:\n"
+                 "  T.. = Timeline support\n"
+                 "  | = Source or sink filter\n"
+                 " ..C scale             V->V       Scale the input video size and/or convert the image format.\n"
+                 " ... scale_cuda        V->V       GPU accelerated video resizer\n"
+                 " ... nullsrc           |->V       Null video source, return unprocessed video frames.\n"),
+}
+
+# 每次运行在calls文件中追加一行，用来统计ffmpeg被运行了几次
+FAKE_FFMPEG = f"""#!{sys.executable}
+import sys
+CANNED = {CANNED!r}
+with open({os.path.join(TMP_DIR, "calls")!r}, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+sys.stdout.write(CANNED.get(sys.argv[-1], ""))
+"""
+
+
+def write_fake_ffmpeg():
+    path = os.path.join(TMP_DIR, "ffmpeg")
+    with open(path, "w") as f:
+        f.write(FAKE_FFMPEG)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def calls() -> int:
+    try:
+        with open(os.path.join(TMP_DIR, "calls")) as f:
+            return len(f.readlines())
+    except FileNotFoundError:
+        return 0
+
+
+if __name__ == '__main__':
+    write_fake_ffmpeg()
+
+    caps = capabilities.get_capabilities()
+    print(caps)
+    assert caps.version == "6.1.1-fake"
+    assert caps.has_encoder("h264_nvenc") and not caps.has_encoder("libx264")
+    assert caps.video_decoders("_cuvid") == ["h264_cuvid"]
+    assert caps.hwaccels == ["vdpau", "cuda"]
+    assert caps.filters == ["scale", "scale_cuda", "nullsrc"]
+    probes = calls()
+    print(f"第一次探测运行了{probes}次ffmpeg")
+
+    capabilities.clear_capabilities_cache()
+    assert capabilities.get_capabilities().to_dict() == caps.to_dict()
+    assert calls() == probes, "磁盘缓存没有生效"
+    print("清除进程内缓存后从磁盘读取，没有再运行ffmpeg")
+
+    # 修改时间变化(例如升级了ffmpeg)后重新探测
+    time.sleep(0.01)
+    write_fake_ffmpeg()
+    capabilities.clear_capabilities_cache()
+    capabilities.get_capabilities()
+    assert calls() == 2 * probes, "ffmpeg改变后没有重新探测"
+    print("ffmpeg改变后重新探测")
+
+    assert NvidiaAccel.check_ffmpeg()
+    assert NvidiaAccel._encoder_map == {"h264": "h264_nvenc", "hevc": "hevc_nvenc"}
+    assert not IntelAccel.check_ffmpeg()
+    assert CpuAccel.get_encoder("h264") == "libopenh264" and CpuAccel.get_encoder_param() == ""
+    assert CpuAccel.get_encoder("av1") == "libsvtav1" and CpuAccel.get_decoder("av1") == "libdav1d"
+    assert calls() == 2 * probes, "加速器应该共用探测结果"
+    print(f"CpuAccel编码器: {CpuAccel._encoder_map}, 解码器: {CpuAccel._decoder_map}")
+    print(f"NvidiaAccel显卡个数: {NvidiaAccel.get_num()}, 自动选择的加速器: {detect_accel().__name__}")
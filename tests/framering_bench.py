@@ -0,0 +1,64 @@
+# 对比原来的 read + np.frombuffer + Queue 读帧方式 和 FrameRing 预分配帧槽 readinto 的方式
+# 用一个子进程不停地向管道写入数据，模拟ffmpeg输出rawvideo
+import subprocess
+import sys
+import time
+import tracemalloc
+from queue import Queue
+
+import numpy as np
+
+from videostream.framering import FrameRing
+
+
+WRITER = ("import sys\n"
+          "b = bytes(int(sys.argv[1]))\n"
+          "w = sys.stdout.buffer.write\n"
+          "while True:\n"
+          "    w(b)\n")
+
+
+def open_pipe(frame_nbytes: int) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-c", WRITER, str(frame_nbytes)], stdout=subprocess.PIPE)
+
+
+def bench_queue(shape: tuple, n_frames: int) -> tuple:
+    proc = open_pipe(int(np.prod(shape)))
+    q = Queue(maxsize=5)
+    tracemalloc.start()
+    t = time.perf_counter()
+    for _ in range(n_frames):
+        in_bytes = proc.stdout.read(np.prod(shape))
+        img = np.frombuffer(in_bytes, np.uint8).reshape(shape)
+        if q.full():
+            q.get()
+        q.put(img)
+    cost = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    proc.kill()
+    return n_frames / cost, peak
+
+
+def bench_ring(shape: tuple, n_frames: int) -> tuple:
+    proc = open_pipe(int(np.prod(shape)))
+    ring = FrameRing(shape, 5)  # 帧槽在统计之前分配，统计的是读帧过程中新增的内存
+    tracemalloc.start()
+    t = time.perf_counter()
+    for _ in range(n_frames):
+        ring.put_from(proc.stdout)
+    cost = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    proc.kill()
+    return n_frames / cost, peak
+
+
+if __name__ == '__main__':
+    for w, h in [(640, 360), (1920, 1080)]:
+        shape = (h, w, 3)
+        q_fps, q_peak = bench_queue(shape, 300)
+        r_fps, r_peak = bench_ring(shape, 300)
+        print(f"{w}x{h} rgb24")
+        print(f"  read+frombuffer+Queue: {q_fps:8.1f} fps, 读帧过程内存峰值 {q_peak / 2 ** 20:8.2f} MB")
+        print(f"  FrameRing.readinto   : {r_fps:8.1f} fps, 读帧过程内存峰值 {r_peak / 2 ** 20:8.2f} MB")
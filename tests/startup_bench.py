@@ -0,0 +1,86 @@
+# 测量Pull从创建到拿到第一帧的时间：
+#   before - 不使用探测缓存(__init__和拉流线程各运行一次ffprobe，即以前的行为)
+#   cache  - 拉流线程复用__init__的探测结果
+#   fast   - 探测缓存 + 低延迟探测参数(fast_start=True)
+# 用本地HTTP服务输出ffmpeg lavfi测试源实时编码的FLV直播流，每个连接单独编码，不需要网络和摄像头
+import shlex
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import videostream.pull
+from videostream import Pull
+from videostream.tools import clear_info_cache, get_info
+
+SOURCE_CMD = ("ffmpeg -loglevel error -re -f lavfi -i testsrc2=size=1280x720:rate=25 "
+              "-c:v libx264 -preset ultrafast -tune zerolatency -g 50 -f flv pipe:")
+
+
+class LiveHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "video/x-flv")
+        self.end_headers()
+        proc = subprocess.Popen(shlex.split(SOURCE_CMD), stdout=subprocess.PIPE)
+        try:
+            while True:
+                data = proc.stdout.read1(1 << 16)
+                if not data:
+                    break
+                self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LiveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def open_once(url: str, mode: str) -> tuple:
+    """返回(Pull返回的时间, 拿到第一帧的时间)"""
+    clear_info_cache()
+    # 模拟以前的行为：拉流线程重新探测
+    videostream.pull.PROBE_CACHE_TTL = 0 if mode == "before" else 10.
+    t0 = time.monotonic()
+    pull = Pull(url, fast_start=(mode == "fast"))
+    t_open = time.monotonic() - t0
+    frame = pull.get_frame(timeout=20)
+    t_frame = time.monotonic() - t0
+    pull.release()
+    assert frame is not None
+    return t_open, t_frame
+
+
+def probe_once(url: str, fast: bool) -> float:
+    t0 = time.monotonic()
+    get_info(url, fast=fast, max_age=0)
+    return time.monotonic() - t0
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    server = start_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/live"
+
+    print(f"{'probe':>8} {'median(s)':>10}")
+    for fast in (False, True):
+        times = [probe_once(url, fast) for _ in range(rounds)]
+        print(f"{'fast' if fast else 'default':>8} {statistics.median(times):>10.3f}")
+
+    print(f"{'mode':>8} {'open(s)':>10} {'first frame(s)':>15}")
+    for mode in ("before", "cache", "fast"):
+        results = [open_once(url, mode) for _ in range(rounds)]
+        print(f"{mode:>8} {statistics.median(r[0] for r in results):>10.3f} "
+              f"{statistics.median(r[1] for r in results):>15.3f}")
+    server.shutdown()
@@ -0,0 +1,62 @@
+# 对比 N 个 Pull(每路一个读线程) 和 StreamPool(少量selector读线程) 的线程数和CPU占用
+# 用ffmpeg的lavfi测试源生成本地视频文件作为输入，不需要网络和摄像头
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from videostream import Pull
+from videostream.streampool import StreamPool
+
+
+def make_source(path: str, size: str = "640x360", fps: int = 25, secs: int = 30):
+    cmd = (f"ffmpeg -loglevel error -y -f lavfi -i testsrc2=size={size}:rate={fps} -t {secs} "
+           f"-c:v libx264 -preset ultrafast -pix_fmt yuv420p '{path}'")
+    subprocess.check_call(shlex.split(cmd))
+
+
+def consume(streams: list, secs: float) -> tuple:
+    """消费所有流的帧，返回(帧数, 期间的CPU时间, 线程数)"""
+    frames = 0
+    threads = threading.active_count()
+    cpu = time.process_time()
+    end = time.monotonic() + secs
+    while time.monotonic() < end:
+        for s in streams:
+            if s.has_frame():
+                s.get_frame()
+                frames += 1
+        time.sleep(0.002)
+    return frames, time.process_time() - cpu, threads
+
+
+def bench_pull(path: str, n: int, secs: float) -> tuple:
+    pulls = [Pull(path) for _ in range(n)]
+    result = consume(pulls, secs)
+    [p.release() for p in pulls]
+    return result
+
+
+def bench_pool(path: str, n: int, secs: float, reader_num: int) -> tuple:
+    pool = StreamPool(reader_num=reader_num)
+    streams = [pool.add(path) for _ in range(n)]
+    result = consume(streams, secs)
+    pool.release()
+    return result
+
+
+if __name__ == '__main__':
+    secs = 5
+    counts = [int(c) for c in sys.argv[1:]] or [1, 4, 16, 32]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "src.mp4")
+        make_source(path)
+        print(f"{'streams':>8} {'mode':>10} {'threads':>8} {'frames':>8} {'cpu(s)':>8} {'cpu/frame(us)':>14}")
+        for n in counts:
+            for mode, fn in [("Pull", lambda: bench_pull(path, n, secs)),
+                             ("StreamPool", lambda: bench_pool(path, n, secs, 1))]:
+                frames, cpu, threads = fn()
+                print(f"{n:>8} {mode:>10} {threads:>8} {frames:>8} {cpu:>8.2f} {cpu / max(frames, 1) * 1e6:>14.1f}")
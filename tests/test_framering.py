@@ -0,0 +1,203 @@
+# FrameRing的确定性检查：用io.BytesIO代替ffmpeg的stdout，检查帧槽的持有/归还规则和各缓冲策略的丢帧数
+# 可以直接运行，也可以用pytest运行
+import io
+import threading
+import time
+from queue import Empty
+
+import numpy as np
+
+from videostream.framering import FrameRing, LATEST, DROP_OLDEST, DROP_NEWEST, BLOCK
+
+SHAPE = (2, 2)
+NBYTES = int(np.prod(SHAPE))
+
+
+def frames(*values: int) -> io.BytesIO:
+    """每一帧的所有字节都是它的编号，方便检查取到的是哪一帧"""
+    return io.BytesIO(b"".join(bytes([v]) * NBYTES for v in values))
+
+
+def fill(ring: FrameRing, n: int, start: int = 1) -> int:
+    """写入编号为start, start+1, ...的n帧，返回成功读满的帧数"""
+    stream = frames(*range(start, start + n))
+    return sum(ring.put_from(stream) for _ in range(n))
+
+
+def drain(ring: FrameRing) -> list:
+    """取出所有待消费的帧，返回帧编号"""
+    values = []
+    while ring.has_frame():
+        frame = ring.get(block=False)
+        values.append(int(frame[0, 0]))
+        ring.release(frame)
+    return values
+
+
+def test_put_get_release():
+    ring = FrameRing(SHAPE, size=3)
+    assert fill(ring, 2) == 2
+    assert ring.seq == 2 and ring.qsize() == 2
+    a = ring.get(block=False)
+    b = ring.get(block=False)
+    assert (a == 1).all() and (b == 2).all()
+    assert ring.seq_of(a) == 1 and ring.seq_of(b) == 2
+    assert ring.ts_of(b) >= ring.ts_of(a) > 0
+    # 持有的帧在release之前不会被覆盖
+    fill(ring, 1, start=3)
+    assert (a == 1).all() and (b == 2).all()
+    ring.release(a)
+    ring.release(b)
+    assert drain(ring) == [3]
+    try:
+        ring.get(block=False)
+        assert False, "没有帧时应该抛出Empty"
+    except Empty:
+        pass
+    try:
+        ring.get(timeout=0.01)
+        assert False, "超时应该抛出Empty"
+    except Empty:
+        pass
+
+
+def test_short_read_aborts():
+    ring = FrameRing(SHAPE, size=2)
+    stream = io.BytesIO(bytes([7]) * NBYTES + bytes([8]) * (NBYTES - 1))
+    assert ring.put_from(stream)
+    assert not ring.put_from(stream), "不足一帧的数据不能提交"
+    assert ring.seq == 1 and ring.dropped == 0
+    assert drain(ring) == [7]
+    # 放弃写入的槽回到空闲槽中，两个槽都还能用
+    assert fill(ring, 2, start=1) == 2 and ring.dropped == 0
+
+
+def test_release_all():
+    ring = FrameRing(SHAPE, size=3)
+    fill(ring, 3)
+    held = [ring.get(block=False) for _ in range(3)]
+    ring.release()
+    fill(ring, 3, start=4)
+    assert ring.dropped == 0
+    assert drain(ring) == [4, 5, 6]
+    assert len(held) == 3
+
+
+def test_all_slots_held():
+    ring = FrameRing(SHAPE, size=2)
+    fill(ring, 2)
+    a, b = ring.get(block=False), ring.get(block=False)
+    # 所有槽都被持有时新帧写到备用缓冲后丢弃，不覆盖持有的帧
+    assert fill(ring, 1, start=9) == 1
+    assert ring.dropped == 1 and ring.seq == 2
+    assert (a == 1).all() and (b == 2).all()
+    ring.release(a)
+    ring.release(b)
+
+
+def test_drop_oldest():
+    ring = FrameRing(SHAPE, size=3, policy=DROP_OLDEST)
+    fill(ring, 5)
+    assert ring.dropped == 2 and ring.seq == 5
+    assert drain(ring) == [3, 4, 5]
+
+
+def test_drop_newest():
+    ring = FrameRing(SHAPE, size=3, policy=DROP_NEWEST)
+    fill(ring, 5)
+    assert ring.dropped == 2 and ring.seq == 3
+    assert drain(ring) == [1, 2, 3]
+
+
+def test_latest():
+    ring = FrameRing(SHAPE, size=3, policy=LATEST)
+    fill(ring, 5)
+    assert ring.dropped == 4 and ring.seq == 5
+    assert drain(ring) == [5]
+
+
+def test_block():
+    ring = FrameRing(SHAPE, size=3, policy=BLOCK)
+    producer = threading.Thread(target=fill, args=(ring, 5))
+    producer.start()
+    time.sleep(0.1)
+    assert producer.is_alive(), "缓冲区满时生产者应该等待"
+    assert ring.qsize() == 3
+    received = []
+    while len(received) < 5:
+        frame = ring.get(timeout=1)
+        received.append(int(frame[0, 0]))
+        ring.release(frame)
+    producer.join(1)
+    assert not producer.is_alive()
+    assert received == [1, 2, 3, 4, 5] and ring.dropped == 0
+
+
+def test_block_close_wakes_producer():
+    ring = FrameRing(SHAPE, size=2, policy=BLOCK)
+    fill(ring, 2)
+    producer = threading.Thread(target=fill, args=(ring, 1, 3))
+    producer.start()
+    time.sleep(0.05)
+    ring.close()
+    producer.join(1)
+    assert not producer.is_alive()
+    assert ring.dropped == 1
+    # 关闭后剩余的帧仍然可以取出，取完返回None
+    assert drain(ring) == [1, 2]
+    assert ring.get() is None
+
+
+def test_peek_into():
+    ring = FrameRing(SHAPE, size=3)
+    dst = np.zeros(SHAPE, dtype=np.uint8)
+    assert ring.peek_into(dst) == (0, 0.)
+    fill(ring, 2)
+    seq, ts = ring.peek_into(dst)
+    assert seq == 2 and ts > 0 and (dst == 2).all()
+    # 没有更新的帧时不修改dst
+    dst[:] = 0
+    assert ring.peek_into(dst, after=seq) == (0, 0.)
+    assert (dst == 0).all()
+    # peek不影响get
+    assert drain(ring) == [1, 2]
+
+
+def test_peek_into_drop_newest():
+    ring = FrameRing(SHAPE, size=2, policy=DROP_NEWEST)
+    dst = np.zeros(SHAPE, dtype=np.uint8)
+    fill(ring, 2)
+    assert ring.peek_into(dst)[0] == 2
+    # 缓冲区满，新帧被丢弃，最新提交的帧还是2号
+    fill(ring, 3, start=3)
+    assert ring.dropped == 3
+    assert ring.peek_into(dst, after=2) == (0, 0.)
+
+
+def test_last_put():
+    ring = FrameRing(SHAPE, size=2, policy=DROP_NEWEST)
+    fill(ring, 2)
+    assert (ring.last_put == 2).all()
+    # 被缓冲策略丢弃的帧也能拿到，转发给其他消费者时不会重复旧帧
+    fill(ring, 1, start=3)
+    assert ring.dropped == 1 and (ring.last_put == 3).all()
+    assert not ring.put_from(io.BytesIO(b""))
+    assert ring.last_put is None
+
+
+def test_wait_frame():
+    ring = FrameRing(SHAPE, size=2)
+    assert not ring.wait_frame(timeout=0.01)
+    threading.Timer(0.05, fill, args=(ring, 1)).start()
+    assert ring.wait_frame(timeout=1)
+    assert ring.wait_new(0, timeout=0) and not ring.wait_new(1, timeout=0.01)
+    drain(ring)
+    ring.close()
+    assert not ring.wait_frame(timeout=1)
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
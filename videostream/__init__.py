@@ -1,9 +1,22 @@
 from videostream.pull import Pull
 from videostream.push import Push
 from videostream.pullpush import PullPush
+from videostream.streampool import StreamPool
+from videostream.batch import FrameBatch
+from videostream.shmbus import ShmFramePublisher, ShmFrameReader
+from videostream.pipeline import Pipeline
+from videostream.aio import AsyncPull, AsyncPush
+from videostream.parallel import ParallelFilePull
+from videostream.filereader import FileReader
+from videostream.bulk import wait_all_opened, release_all
+from videostream.metrics import MetricsExporter
+from videostream.reconnect import ReconnectPolicy
 
 
-__all__ = ["Push", "Pull", "PullPush", "accelerator"]
+__all__ = ["Push", "Pull", "PullPush", "StreamPool", "FrameBatch", "ShmFramePublisher", "ShmFrameReader",
+           "Pipeline", "AsyncPull", "AsyncPush", "ParallelFilePull",
+           "FileReader", "wait_all_opened", "release_all", "MetricsExporter", "ReconnectPolicy",
+           "accelerator", "capabilities"]
 
 
 
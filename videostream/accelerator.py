@@ -1,7 +1,10 @@
-import re
+import glob
+import os
 from abc import ABC, abstractmethod
 from subprocess import check_output, DEVNULL, CalledProcessError
-from typing import Union
+from typing import Sequence, Type, Union
+
+from videostream.capabilities import FfmpegCapabilities, get_capabilities, get_device_count
 
 
 class Accelerator(ABC):
@@ -20,8 +23,8 @@ class Accelerator(ABC):
         """检查当前ffmpeg是否支持此加速器"""
         pass
 
-    @staticmethod
-    def get_encoder_param() -> str:
+    @classmethod
+    def get_encoder_param(cls, codec: str = "h264") -> str:
         """获取加速器对应的编码器的参数"""
         pass
 
@@ -31,9 +34,14 @@ class Accelerator(ABC):
         """获取加速器的个数"""
         pass
 
+    @staticmethod
+    def capabilities() -> Union[FfmpegCapabilities, None]:
+        """当前ffmpeg支持的编解码器等，所有加速器共用一份，见capabilities.get_capabilities"""
+        return get_capabilities()
+
     @classmethod
     def is_ok(cls) -> bool:
-        """判断是否可以使用Nvidia加速器"""
+        """判断是否可以使用此加速器"""
         return cls.check_ffmpeg() and cls.get_num() > 0
 
     @classmethod
@@ -79,8 +87,8 @@ class NoAccel(Accelerator):
     def check_ffmpeg(cls) -> bool:
         return True
 
-    @staticmethod
-    def get_encoder_param() -> str:
+    @classmethod
+    def get_encoder_param(cls, codec: str = "h264") -> str:
         """获取编码器参数"""
         return "-tune zerolatency -preset ultrafast"
 
@@ -89,66 +97,181 @@ class NoAccel(Accelerator):
         return 1
 
 
-class NvidiaAccel(Accelerator):
+class CpuAccel(Accelerator):
+    """
+    不使用GPU，按当前ffmpeg实际编译进去的编解码器选择最快的软件实现，并使用对应的低延迟参数；
+    例如没有libx264的LGPL版本ffmpeg使用libopenh264，av1解码优先使用libdav1d
+    """
     _ffmpeg_support: Union[bool, None] = None
-    _nvidia_num: Union[int, None] = None
 
     _encoder_map: dict[str, str] = dict()
     _decoder_map: dict[str, str] = dict()
 
-    _encoder_pattern = re.compile(r"V.{5} (.{2,8}_nvenc) ", re.MULTILINE)
-    _decoder_pattern = re.compile(r"V.{5} (.{2,8}_cuvid) ", re.MULTILINE)
+    # 每种格式按优先级排列的候选编解码器
+    _encoder_prefer: dict[str, Sequence[str]] = {
+        "h264": ("libx264", "libopenh264"),
+        "hevc": ("libx265",),
+        "vp9": ("libvpx-vp9",),
+        "av1": ("libsvtav1", "librav1e", "libaom-av1"),
+    }
+    _decoder_prefer: dict[str, Sequence[str]] = {
+        "h264": ("h264",),
+        "hevc": ("hevc",),
+        "vp9": ("vp9", "libvpx-vp9"),
+        "av1": ("libdav1d", "libaom-av1", "av1"),
+    }
+    # 各编码器速度最快、延迟最低的参数
+    _encoder_params: dict[str, str] = {
+        "libx264": "-tune zerolatency -preset ultrafast",
+        "libx265": "-tune zerolatency -preset ultrafast",
+        "libvpx-vp9": "-deadline realtime -cpu-used 8 -row-mt 1",
+        "libsvtav1": "-preset 12",
+        "librav1e": "-speed 10",
+        "libaom-av1": "-usage realtime -cpu-used 8 -row-mt 1",
+    }
 
     @staticmethod
     def get_accel_opt():
-        return "-hwaccel cuda"
+        return ""
 
-    @staticmethod
-    def get_encoder_param() -> str:
+    @classmethod
+    def get_encoder_param(cls, codec: str = "h264") -> str:
         """获取编码器参数"""
-        return "-preset p1"
+        return cls._encoder_params.get(cls.get_encoder(codec), "")
 
     @classmethod
     def check_ffmpeg(cls) -> bool:
-        """检查当前ffmpeg是否支持此加速器"""
+        """检查当前ffmpeg是否支持此加速器，同时选出每种格式可用的编解码器"""
         if cls._ffmpeg_support is None:
-            try:
-                output = check_output(["ffmpeg", "-encoders"], stderr=DEVNULL).decode("utf-8")
-                encoders = cls._encoder_pattern.findall(output)
-                if len(encoders) == 0:
-                    cls._ffmpeg_support = False
-                    return cls._ffmpeg_support
+            caps = cls.capabilities()
+            if caps is None:
+                cls._ffmpeg_support = False
+                return cls._ffmpeg_support
+
+            cls._encoder_map = {codec: next(it for it in names if caps.has_encoder(it))
+                                for codec, names in cls._encoder_prefer.items()
+                                if any(caps.has_encoder(it) for it in names)}
+            cls._decoder_map = {codec: next(it for it in names if caps.has_decoder(it))
+                                for codec, names in cls._decoder_prefer.items()
+                                if any(caps.has_decoder(it) for it in names)}
+            cls._ffmpeg_support = "h264" in cls._encoder_map and "h264" in cls._decoder_map
+
+        return cls._ffmpeg_support
 
-                cls._encoder_map = {it.split("_")[0]: it for it in encoders}
+    @classmethod
+    def get_num(cls) -> int:
+        return 1
 
-                output = check_output(["ffmpeg", "-decoders"], stderr=DEVNULL).decode("utf-8")
-                decoders = cls._decoder_pattern.findall(output)
-                if len(decoders) == 0:
-                    cls._ffmpeg_support = False
-                    return cls._ffmpeg_support
 
-                cls._decoder_map = {it.split("_")[0]: it for it in decoders}
+class _HwAccel(Accelerator):
+    """用ffmpeg的-hwaccel和对应后缀的编解码器实现的GPU加速，子类给出加速方法和后缀"""
+    _ffmpeg_support: Union[bool, None] = None
+    _num: Union[int, None] = None
 
-            except CalledProcessError:
+    _encoder_map: dict[str, str] = dict()
+    _decoder_map: dict[str, str] = dict()
+
+    _hwaccel = ""  # -hwaccel的参数
+    _encoder_suffix = ""
+    _decoder_suffix = ""
+
+    @classmethod
+    def check_ffmpeg(cls) -> bool:
+        """检查当前ffmpeg是否支持此加速器"""
+        if cls._ffmpeg_support is None:
+            caps = cls.capabilities()
+            if caps is None or not caps.has_hwaccel(cls._hwaccel):
+                cls._ffmpeg_support = False
+                return cls._ffmpeg_support
+
+            encoders = caps.video_encoders(cls._encoder_suffix)
+            decoders = caps.video_decoders(cls._decoder_suffix)
+            if len(encoders) == 0 or len(decoders) == 0:
                 cls._ffmpeg_support = False
                 return cls._ffmpeg_support
 
+            cls._encoder_map = {it.split("_")[0]: it for it in encoders}
+            cls._decoder_map = {it.split("_")[0]: it for it in decoders}
             cls._ffmpeg_support = True
 
         return cls._ffmpeg_support
 
+    @classmethod
+    def _probe_num(cls) -> int:
+        """探测设备的个数，结果由get_num缓存"""
+        return 0
+
     @classmethod
     def get_num(cls) -> int:
         """获取加速器的个数"""
-        if cls._nvidia_num is None:
-            try:
-                output = check_output(["nvidia-smi", "-L"], shell=False, stderr=DEVNULL).decode("utf-8")
-                cls._nvidia_num = len([line for line in output.splitlines() if line.startswith("GPU ")])
-            except CalledProcessError:
-                cls._nvidia_num = 0
-                return cls._nvidia_num
+        if cls._num is None:
+            cls._num = get_device_count(cls._hwaccel, cls._probe_num)
+        return cls._num
+
 
-        return cls._nvidia_num
+class NvidiaAccel(_HwAccel):
+    _hwaccel = "cuda"
+    _encoder_suffix = "_nvenc"
+    _decoder_suffix = "_cuvid"
+
+    @staticmethod
+    def get_accel_opt():
+        return "-hwaccel cuda"
+
+    @classmethod
+    def get_encoder_param(cls, codec: str = "h264") -> str:
+        """获取编码器参数"""
+        return "-preset p1"
+
+    @classmethod
+    def _probe_num(cls) -> int:
+        try:
+            output = check_output(["nvidia-smi", "-L"], shell=False, stderr=DEVNULL).decode("utf-8")
+        except (CalledProcessError, OSError):
+            return 0
+        return len([line for line in output.splitlines() if line.startswith("GPU ")])
+
+
+class IntelAccel(_HwAccel):
+    """Intel集成显卡或独立显卡的Quick Sync Video加速"""
+    _hwaccel = "qsv"
+    _encoder_suffix = "_qsv"
+    _decoder_suffix = "_qsv"
+
+    @staticmethod
+    def get_accel_opt():
+        return "-hwaccel qsv"
+
+    @classmethod
+    def get_encoder_param(cls, codec: str = "h264") -> str:
+        """获取编码器参数"""
+        return "-preset veryfast -async_depth 1"
+
+    @classmethod
+    def _probe_num(cls) -> int:
+        if os.name != "posix":
+            # Windows上没有简单的方法列出显卡，交给ffmpeg自己判断
+            return 1
+        num = 0
+        for vendor_path in glob.glob("/sys/class/drm/renderD*/device/vendor"):
+            try:
+                with open(vendor_path) as f:
+                    num += f.read().strip() == "0x8086"
+            except OSError:
+                pass
+        return num
+
+
+def detect_accel(candidates: Sequence[Type[Accelerator]] = (NvidiaAccel, IntelAccel, CpuAccel)) \
+        -> Type[Accelerator]:
+    """
+    按顺序返回candidates中第一个可用的加速器，都不可用时返回NoAccel
+    ffmpeg支持的编解码器只探测一次并缓存在磁盘上，见capabilities.get_capabilities
+    """
+    for accel in candidates:
+        if accel.is_ok():
+            return accel
+    return NoAccel
 
 
 if __name__ == '__main__':
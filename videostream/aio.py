@@ -0,0 +1,285 @@
+import asyncio
+import shlex
+from asyncio.subprocess import DEVNULL, PIPE, Process
+from typing import Type, Union
+
+import numpy as np
+
+from videostream.accelerator import Accelerator, NoAccel
+from videostream.logger import logger
+from videostream.pull import make_pull_cmd
+from videostream.push import make_push_cmd
+from videostream.reconnect import Backoff, ReconnectPolicy
+from videostream.tools import (PROBE_CACHE_TTL, cache_info, clear_info_cache, get_cached_info, get_out_numpy_shape,
+                               has_video_size, is_stream, make_probe_cmd, parse_probe_output)
+
+
+async def _probe(url: str, audio: bool, fast: bool) -> list[dict]:
+    proc = await asyncio.create_subprocess_exec(*shlex.split(make_probe_cmd(url, audio, fast)),
+                                                stdout=PIPE, stderr=asyncio.subprocess.STDOUT)
+    output, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError(output.decode("utf-8"))
+    return parse_probe_output(output.decode("utf-8"))
+
+
+async def async_get_info(url: str, audio=False, fast=False, max_age: float = PROBE_CACHE_TTL) -> list[dict]:
+    """get_info的异步版本，和get_info共用探测结果缓存，视频URL有问题时抛出ValueError"""
+    info = get_cached_info(url, audio, max_age, fast)
+    if info is not None:
+        return info
+    info = await _probe(url, audio, fast)
+    if fast and not has_video_size(info):
+        info = await _probe(url, audio, False)
+        fast = False
+    cache_info(url, audio, info, fast)
+    return info
+
+
+async def _run_async(cmd: str, stdin=None, stdout=None) -> Process:
+    return await asyncio.create_subprocess_exec(*shlex.split(cmd), stdin=stdin, stdout=stdout, stderr=DEVNULL)
+
+
+async def _discard(reader: Union[asyncio.StreamReader, None]):
+    """读完并丢弃管道中剩余的数据，否则管道不会关闭，Process.wait()无法返回"""
+    if reader is None:
+        return
+    while await reader.read(1 << 20):
+        pass
+
+
+async def _release_process(proc: Union[Process, None]):
+    """release_process的异步版本，先terminate，5秒内没有退出则kill"""
+    if proc is None or proc.returncode is not None:
+        return
+    if proc.stdin is not None:
+        proc.stdin.close()
+    try:
+        proc.terminate()
+        await asyncio.wait_for(asyncio.gather(_discard(proc.stdout), proc.wait()), timeout=5)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        proc.kill()
+        await asyncio.gather(_discard(proc.stdout), proc.wait())
+
+
+def _check_accel(accel: Type[Accelerator]) -> Type[Accelerator]:
+    # 检查加速器是否可用，会运行ffmpeg、nvidia-smi等子进程，异步接口中要用asyncio.to_thread调用，不阻塞事件循环
+    if not accel.check_ffmpeg():
+        logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{accel.__name__}加速")
+        return NoAccel
+    elif accel.get_num() <= 0:
+        logger.warning(f"没有可用的{accel.__name__}设备或没有正确安装驱动")
+        return NoAccel
+    return accel
+
+
+class AsyncPull:
+    def __init__(self, url: str, pix_fmt: str = "rgb24", reconn: bool = False, accel: Type[Accelerator] = NoAccel,
+                 fast_start: bool = False, reconnect_policy: Union[ReconnectPolicy, None] = None):
+        """
+        基于asyncio子进程的拉流，不使用线程，一个事件循环可以同时拉取几百路流
+        使用 await open() 或 async with 打开，async for frame in pull 逐帧读取
+        :param url: 视频文件或视频流的地址
+        :param pix_fmt: 输出帧的格式
+        :param reconn: 对于视频流，断线后重连，对于视频文件，播放结束后再重头开始播放
+        :param accel: 使用的加速器，默认不使用加速器(NoAccel)
+        :param fast_start: 探测和拉流都使用低延迟参数，缩短打开视频流的时间，见tools.FAST_PROBE_OPT
+        :param reconnect_policy: 断线或打开失败后重连之前的等待时间和熔断，见reconnect.ReconnectPolicy，
+                                 None时使用默认策略；视频文件播放完重新播放时不等待
+        """
+        assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        self._url = url
+        self._pix_fmt = pix_fmt
+        self._reconn = reconn
+        self._accel = accel
+        self._fast_start = fast_start
+        self._backoff = Backoff(reconnect_policy, url)
+        self._got_frame = False  # 当前的ffmpeg进程是否已经输出过帧
+        self._proc: Union[Process, None] = None
+        self._out_np_shape = (0, 0, 0)
+        self._frame_nbytes = 0
+        self._closed = False
+        self._ffmpeg_cmd: Union[str, None] = None
+        self.stream_info: list[dict] = []
+
+    async def get_info(self) -> list[dict]:
+        return await async_get_info(self._url, fast=self._fast_start)
+
+    async def open(self) -> bool:
+        """探测流信息并启动ffmpeg进程，失败返回False"""
+        try:
+            self.stream_info = await self.get_info()
+            if len(self.stream_info) == 0:
+                logger.error("文件或流中没有视频流")
+                return False
+        except ValueError as e:
+            logger.error(e)
+            return False
+
+        self._accel = await asyncio.to_thread(_check_accel, self._accel)
+        self._out_np_shape = get_out_numpy_shape((self.stream_info[0]["width"], self.stream_info[0]["height"]),
+                                                 self._pix_fmt)
+        self._frame_nbytes = int(np.prod(self._out_np_shape))
+        self._ffmpeg_cmd = make_pull_cmd(self._url, self._pix_fmt, self._accel, fast=self._fast_start)
+        self._proc = await _run_async(self._ffmpeg_cmd, stdout=PIPE)
+        self._got_frame = False
+        self._closed = False
+        return True
+
+    async def reconnect(self) -> bool:
+        """关闭当前的ffmpeg进程，重新探测并打开"""
+        await _release_process(self._proc)
+        self._proc = None
+        clear_info_cache(self._url)  # 重连后分辨率可能已经改变，不能用缓存的探测结果
+        return await self.open()
+
+    async def read(self) -> Union[np.ndarray, None]:
+        """
+        读取下一帧，返回只读的numpy数组
+        返回None表示拉流已结束(没有设置reconn或已经close)
+        """
+        while not self._closed:
+            if self._proc is not None:
+                try:
+                    data = await self._proc.stdout.readexactly(self._frame_nbytes)
+                    if not self._got_frame:
+                        # 收到帧才算连接成功，连接上却不出帧的摄像头仍然按连续失败计算等待时间
+                        self._got_frame = True
+                        self._backoff.connected()
+                    return np.frombuffer(data, np.uint8).reshape(self._out_np_shape)
+                except asyncio.IncompleteReadError:
+                    logger.warning("拉流结束或断开")
+
+            if not self._reconn or self._closed:
+                break
+            if not (self._got_frame and not is_stream(self._url)):
+                # 打开失败或者断线，按重连策略等待，视频文件播放完立即从头播放
+                delay = self._backoff.next_delay()
+                logger.info(f"{self._url} {delay:.2f}秒后重连")
+                await asyncio.sleep(delay)
+                self._backoff.total_wait += delay
+                if self._closed:
+                    break
+            self._got_frame = False
+            await self.reconnect()
+        await self.close()
+        return None
+
+    def is_opened(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None and not self._closed
+
+    def stats(self) -> dict:
+        """重连的状态，见reconnect.Backoff.stats"""
+        return self._backoff.stats()
+
+    async def close(self):
+        self._closed = True
+        proc, self._proc = self._proc, None
+        await _release_process(proc)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> np.ndarray:
+        frame = await self.read()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    async def __aenter__(self):
+        if not await self.open():
+            raise ValueError(f"无法打开视频流 {self._url}")
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncPush:
+    def __init__(self, push_url: str, w: int, h: int, fr: int, pix_fmt: str = "rgb24", reconn: bool = False,
+                 accel: Type[Accelerator] = NoAccel, reconnect_policy: Union[ReconnectPolicy, None] = None):
+        """
+        基于asyncio子进程的推流，await write(frame)会等到ffmpeg读走数据，推流慢时调用方自然被阻塞(背压)
+        参数和Push相同；重连前按reconnect_policy等待，等待期间write不返回
+        """
+        assert w > 0 and h > 0, "宽高必须大于0"
+        assert 0 < fr < 120, "帧率必须大于0且小于120"
+        assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        self._push_url = push_url
+        self._w = w
+        self._h = h
+        self._fr = fr
+        self._pix_fmt = pix_fmt
+        self._reconn = reconn
+        self._accel = accel
+        self._backoff = Backoff(reconnect_policy, push_url)
+        self._written = 0  # 当前的ffmpeg进程已经写入的帧数
+        self._out_np_shape = get_out_numpy_shape((w, h), pix_fmt)
+        self._proc: Union[Process, None] = None
+        self._ffmpeg_cmd: Union[str, None] = None
+
+    async def open(self):
+        self._accel = await asyncio.to_thread(_check_accel, self._accel)
+        self._ffmpeg_cmd = make_push_cmd(self._push_url, self._w, self._h, self._fr, self._pix_fmt, self._accel)
+        self._proc = await _run_async(self._ffmpeg_cmd, stdin=PIPE)
+        self._written = 0
+
+    async def reconnect(self):
+        await _release_process(self._proc)
+        await self.open()
+
+    async def write(self, frame: np.ndarray):
+        """
+        写入一帧，等待ffmpeg的stdin缓冲区排空后返回
+        与服务器断开时，reconn为True则重新连接后重写这一帧，否则抛出BrokenPipeError
+        """
+        assert frame.shape == self._out_np_shape, f"帧的形状应为{self._out_np_shape}"
+        data = memoryview(np.ascontiguousarray(frame)).cast("B")
+        while True:
+            if self._proc is None:
+                await self.open()
+            try:
+                self._proc.stdin.write(data)
+                await self._proc.stdin.drain()
+                self._written += 1
+                if self._written == 10:
+                    # 和Push相同，管道有缓冲，写入成功几帧之后才算连接成功
+                    self._backoff.connected()
+                return
+            except (BrokenPipeError, ConnectionResetError):
+                logger.error("推流失败，可能是和服务器之间的网络连接问题")
+                if not self._reconn:
+                    raise BrokenPipeError("推流进程已退出")
+                # 服务器不可用时按重连策略等待，不要每写一帧就重启一次ffmpeg
+                delay = self._backoff.next_delay()
+                logger.info(f"{delay:.2f}秒后重新推流")
+                await asyncio.sleep(delay)
+                self._backoff.total_wait += delay
+                await self.reconnect()
+
+    def is_pushing(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None
+
+    def stats(self) -> dict:
+        """重连的状态，见reconnect.Backoff.stats"""
+        return self._backoff.stats()
+
+    async def close(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        # 关闭stdin让ffmpeg把剩余的帧编码完后正常退出
+        proc.stdin.close()
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            await _release_process(proc)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
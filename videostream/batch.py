@@ -0,0 +1,78 @@
+import time
+from typing import Sequence, Union
+
+import numpy as np
+
+from videostream.logger import logger
+
+
+class FrameBatch:
+    def __init__(self, streams: Sequence, shape: Union[Sequence[int], None] = None):
+        """
+        把多路拉流的最新帧拼成一个批次，用于批量推理
+        批次数组(N, H, W, C)只分配一次，每次fetch原地填充，不再逐帧np.stack
+        流可以还没有打开(block=False或者正在连接)，没有帧缓冲区的流在fetch中作为没有新帧的槽
+        :param streams: Pull或PoolStream列表，各路输出帧的形状必须相同
+        :param shape: 每一帧的形状，None时取第一路已经打开的流的帧形状，都还没有打开时在fetch中确定
+        """
+        assert len(streams) > 0
+        self._streams = list(streams)
+        n = len(self._streams)
+        self.shape: Union[tuple, None] = None
+        self.frames: Union[np.ndarray, None] = None  # 批次数组，fetch返回的就是它，确定帧形状后分配
+        self.seqs = np.zeros(n, dtype=np.int64)  # 每个槽中帧在各自流里的序号，0表示还没有帧
+        self.timestamps = np.zeros(n, dtype=np.float64)  # 每个槽中帧的提交时间(time.monotonic)
+        self.fresh = np.zeros(n, dtype=bool)  # 本次fetch中，这个槽是否拿到了新帧
+        self._rings = [None] * n  # 每个槽上一次读取的帧缓冲区，用来发现重连后被替换
+        if shape is None:
+            shape = next((s.frame_ring.shape for s in self._streams if s.frame_ring is not None), None)
+        if shape is not None:
+            self._allocate(shape)
+
+    def _allocate(self, shape: Sequence[int]):
+        self.shape = tuple(shape)
+        self.frames = np.zeros((len(self._streams),) + self.shape, dtype=np.uint8)
+
+    def fetch(self, wait_all: bool = False, timeout: Union[float, None] = None) -> np.ndarray:
+        """
+        用每一路的最新帧原地更新批次数组
+        没有新帧的槽保留上一次的内容，fresh为False，可以通过staleness判断是否可用
+        :param wait_all: 是否等到每一路都有新帧，或者到达超时时间；还没有打开的流先等它打开
+        :param timeout: wait_all时的最长等待时间(秒)，None表示一直等待
+        :return: self.frames，所有流都还没有打开、不知道帧形状时返回None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for i, stream in enumerate(self._streams):
+            ring = stream.frame_ring
+            if ring is None and wait_all:
+                stream.wait_opened(None if deadline is None else max(0., deadline - time.monotonic()))
+                ring = stream.frame_ring
+            if ring is None:
+                self.fresh[i] = False
+                continue
+            if self.frames is None:
+                self._allocate(ring.shape)
+            if ring.shape != self.shape:
+                logger.warning(f"第{i}路流的帧形状变为{ring.shape}，与批次形状{self.shape}不同，跳过")
+                self.fresh[i] = False
+                continue
+            if ring is not self._rings[i]:
+                # 重连后帧缓冲区被替换了，序号重新开始
+                self._rings[i] = ring
+                self.seqs[i] = 0
+            if wait_all:
+                remain = None if deadline is None else max(0., deadline - time.monotonic())
+                ring.wait_new(int(self.seqs[i]), remain)
+
+            seq, ts = ring.peek_into(self.frames[i], after=int(self.seqs[i]))
+            self.fresh[i] = seq > 0
+            if seq > 0:
+                self.seqs[i] = seq
+                self.timestamps[i] = ts
+        return self.frames
+
+    def staleness(self) -> np.ndarray:
+        """每个槽中帧距现在的时间(秒)，还没有帧的槽为inf"""
+        age = time.monotonic() - self.timestamps
+        age[self.seqs == 0] = np.inf
+        return age
@@ -0,0 +1,32 @@
+import time
+from typing import Sequence, Union
+
+
+def wait_all_opened(streams: Sequence, timeout: Union[float, None] = None) -> list[bool]:
+    """
+    等待多路流打开，所有流共用一个超时时间，总耗时取决于最慢的一路
+    适合和block=False一起使用：先创建所有的Pull、Push、PullPush，它们的探测和启动在各自的线程中同时进行
+    :param streams: 有wait_opened方法的对象
+    :param timeout: 总的超时时间(秒)，None表示一直等待
+    :return: 每一路是否已经打开，和streams顺序相同
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    opened = []
+    for stream in streams:
+        remaining = None if deadline is None else max(0., deadline - time.monotonic())
+        opened.append(stream.wait_opened(remaining))
+    return opened
+
+
+def release_all(streams: Sequence):
+    """
+    同时关闭多路流：先向每一路发出停止信号，各自的线程同时结束ffmpeg进程，再逐个等待线程退出，
+    总耗时取决于最慢的一路，而不是每一路的关闭时间之和
+    :param streams: Pull、Push、PullPush等有release方法的对象，有stop方法时先调用stop
+    """
+    for stream in streams:
+        stop = getattr(stream, "stop", None)
+        if stop is not None:
+            stop()
+    for stream in streams:
+        stream.release()
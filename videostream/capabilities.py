@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from subprocess import check_output, DEVNULL, CalledProcessError
+from typing import Union
+
+from videostream.logger import logger
+
+# 缓存格式的版本，解析方式改变时加1，旧的缓存自动失效
+_CAPS_VERSION = 1
+
+# 能力缓存的目录，可以用环境变量VIDEOSTREAM_CACHE_DIR指定
+CACHE_DIR = os.environ.get("VIDEOSTREAM_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "videostream")
+
+# -encoders/-decoders的一行： " V....D h264_nvenc           NVIDIA NVENC H.264 encoder (codec h264)"
+_CODEC_LINE = re.compile(r"^ ([VAS][A-Z.]{5}) (\S+)\s+(.*)$")
+# -filters的一行： " ... scale             V->V       Scale the input video size ..."
+_FILTER_LINE = re.compile(r"^ ([A-Z.]{2,3}) (\S+)\s+(\S*->\S*)\s")
+
+_memo: dict[str, "FfmpegCapabilities"] = dict()  # 本进程已经读取的能力，键是get_capabilities的ffmpeg参数
+_memo_lock = threading.Lock()
+
+
+class FfmpegCapabilities:
+    def __init__(self, path: str, version: str, encoders: dict, decoders: dict, hwaccels: list, filters: list):
+        """
+        一个ffmpeg可执行文件支持的编码器、解码器、硬件加速方法和滤镜，由get_capabilities探测或从缓存读取
+        :param encoders: {编码器名: 类型}，类型是"V"(视频)、"A"(音频)或"S"(字幕)
+        :param decoders: {解码器名: 类型}
+        """
+        self.path = path
+        self.version = version
+        self.encoders = encoders
+        self.decoders = decoders
+        self.hwaccels = hwaccels
+        self.filters = filters
+
+    def has_encoder(self, name: str) -> bool:
+        return name in self.encoders
+
+    def has_decoder(self, name: str) -> bool:
+        return name in self.decoders
+
+    def has_hwaccel(self, name: str) -> bool:
+        return name in self.hwaccels
+
+    def has_filter(self, name: str) -> bool:
+        return name in self.filters
+
+    def video_encoders(self, suffix: str = "") -> list[str]:
+        """以suffix结尾的视频编码器，如suffix="_nvenc" """
+        return [name for name, kind in self.encoders.items() if kind == "V" and name.endswith(suffix)]
+
+    def video_decoders(self, suffix: str = "") -> list[str]:
+        return [name for name, kind in self.decoders.items() if kind == "V" and name.endswith(suffix)]
+
+    def to_dict(self) -> dict:
+        return {"path": self.path, "version": self.version, "encoders": self.encoders, "decoders": self.decoders,
+                "hwaccels": self.hwaccels, "filters": self.filters}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "FfmpegCapabilities":
+        return cls(d["path"], d["version"], d["encoders"], d["decoders"], d["hwaccels"], d["filters"])
+
+    def __repr__(self):
+        return (f"FfmpegCapabilities({self.path!r}, version={self.version!r}, encoders={len(self.encoders)}, "
+                f"decoders={len(self.decoders)}, hwaccels={self.hwaccels})")
+
+
+def parse_codecs(output: str) -> dict:
+    """解析ffmpeg -encoders或-decoders的输出，返回{名字: 类型}"""
+    codecs = dict()
+    listing = False
+    for line in output.splitlines():
+        if line.strip().startswith("------"):
+            # 分隔线之前是各列标志的说明
+            listing = True
+            continue
+        match = _CODEC_LINE.match(line) if listing else None
+        if match is not None:
+            codecs[match.group(2)] = match.group(1)[0]
+    return codecs
+
+
+def parse_hwaccels(output: str) -> list[str]:
+    """解析ffmpeg -hwaccels的输出"""
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("Hardware acceleration methods"):
+            return [name.strip() for name in lines[i + 1:] if name.strip()]
+    return []
+
+
+def parse_filters(output: str) -> list[str]:
+    """解析ffmpeg -filters的输出"""
+    return [match.group(2) for match in map(_FILTER_LINE.match, output.splitlines()) if match is not None]
+
+
+def parse_version(output: str) -> str:
+    """从ffmpeg -version的第一行"ffmpeg version 6.1.1 Copyright ..."中取出版本号"""
+    parts = output.split("\n", 1)[0].split()
+    return parts[2] if len(parts) > 2 and parts[1] == "version" else ""
+
+
+def probe_capabilities(path: str) -> FfmpegCapabilities:
+    """运行ffmpeg探测能力，不使用缓存；运行失败时抛出CalledProcessError或OSError"""
+    def run(*args) -> str:
+        return check_output([path, "-hide_banner", *args], stderr=DEVNULL).decode("utf-8", errors="replace")
+
+    return FfmpegCapabilities(path, parse_version(run("-version")), parse_codecs(run("-encoders")),
+                              parse_codecs(run("-decoders")), parse_hwaccels(run("-hwaccels")),
+                              parse_filters(run("-filters")))
+
+
+def _cache_path(cache_dir: str, path: str) -> str:
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.ffcaps.json")
+
+
+def _load(cache_path: str, key: dict) -> Union[dict, None]:
+    """读取缓存文件，键不一致或者文件损坏时返回None"""
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            return cached["value"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return None
+
+
+def _save(cache_path: str, key: dict, value):
+    # 先写临时文件再替换，多个进程同时写时读到的总是完整的文件
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "value": value}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"无法写入缓存{cache_path}: {e}")
+
+
+def get_capabilities(ffmpeg: str = "ffmpeg", cache_dir: Union[str, None] = None,
+                     refresh: bool = False) -> Union[FfmpegCapabilities, None]:
+    """
+    获取ffmpeg的能力，每个ffmpeg可执行文件只探测一次：
+    结果缓存在本进程中，同时按(路径, 大小, 修改时间)缓存在磁盘上，ffmpeg升级或替换后自动重新探测，
+    短时间运行的工作进程不用每次都运行ffmpeg -encoders等命令
+    :param ffmpeg: ffmpeg的名字(在PATH中查找)或路径
+    :param cache_dir: 磁盘缓存的目录，None时使用CACHE_DIR
+    :param refresh: 忽略缓存，重新探测
+    :return: 找不到ffmpeg或者无法运行时返回None
+    """
+    with _memo_lock:
+        if not refresh and ffmpeg in _memo:
+            return _memo[ffmpeg]
+
+        found = shutil.which(ffmpeg)
+        if found is None:
+            return None
+        path = os.path.realpath(found)
+        stat = os.stat(path)
+        key = {"version": _CAPS_VERSION, "path": path, "size": stat.st_size, "mtime": stat.st_mtime}
+        cache_path = _cache_path(cache_dir or CACHE_DIR, path)
+
+        cached = None if refresh else _load(cache_path, key)
+        if cached is not None:
+            caps = FfmpegCapabilities.from_dict(cached)
+        else:
+            try:
+                caps = probe_capabilities(path)
+            except (CalledProcessError, OSError) as e:
+                logger.warning(f"无法获取{path}支持的编解码器: {e}")
+                return None
+            _save(cache_path, key, caps.to_dict())
+        _memo[ffmpeg] = caps
+        return caps
+
+
+def clear_capabilities_cache():
+    """清除本进程中缓存的能力，下一次get_capabilities重新读取磁盘缓存(或者重新探测)"""
+    with _memo_lock:
+        _memo.clear()
+
+
+def _boot_id() -> Union[str, None]:
+    """本次开机的唯一标识，只有Linux上有；换了显卡需要重启，可以用它作为设备个数缓存的键"""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_device_count(name: str, probe, cache_dir: Union[str, None] = None) -> int:
+    """
+    硬件设备(如nvidia显卡)的个数，在Linux上按本次开机缓存在磁盘上，其他系统每个进程探测一次；
+    探测到0个时不缓存，驱动加载前或者探测命令临时失败时不会在整个开机期间都认为没有设备
+    :param name: 设备的名字，用作缓存文件名
+    :param probe: 探测设备个数的函数，无法探测时返回0
+    """
+    boot_id = _boot_id()
+    if boot_id is None:
+        return probe()
+    cache_path = os.path.join(cache_dir or CACHE_DIR, f"{name}.devices.json")
+    key = {"boot_id": boot_id}
+    count = _load(cache_path, key)
+    if not isinstance(count, int):
+        count = probe()
+        if count > 0:
+            _save(cache_path, key, count)
+    return count
@@ -0,0 +1,174 @@
+import bisect
+import hashlib
+import json
+import os
+from typing import Sequence, Type, Union
+
+import numpy as np
+
+from videostream.accelerator import Accelerator, NoAccel
+from videostream.logger import logger
+from videostream.tools import get_info, get_frame_index, get_out_numpy_shape, make_seek_opt, run_async, \
+    release_process
+
+_INDEX_VERSION = 1
+
+
+def to_seconds(t: Union[float, int, str]) -> float:
+    """把 12.5 或 "00:12:31.4"、"12:31.4" 这样的时间转换为秒"""
+    if isinstance(t, str):
+        secs = 0.
+        for part in t.split(":"):
+            secs = secs * 60 + float(part)
+        return secs
+    return float(t)
+
+
+class FileReader:
+    def __init__(self, path: str, pix_fmt: str = "rgb24", cache_dir: Union[str, None] = None,
+                 batch_gap: int = 300, accel: Type[Accelerator] = NoAccel):
+        """
+        视频文件随机读帧：用ffprobe建立一次帧时间和关键帧的索引并缓存，
+        取帧时从目标帧之前最近的关键帧开始解码，只向前解码到目标帧为止
+        :param path: 视频文件路径
+        :param pix_fmt: 输出帧的格式
+        :param cache_dir: 索引缓存目录，None时缓存在视频文件旁边(.文件名.vsidx.json)
+        :param batch_gap: get_frames中相邻两个目标帧相差不超过这么多帧时，在同一个ffmpeg进程中顺序解码，
+                          超过时重新seek
+        :param accel: 使用的加速器，默认不使用加速器(NoAccel)
+        """
+        assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        self._path = path
+        self._pix_fmt = pix_fmt
+        self._cache_dir = cache_dir
+        self._batch_gap = batch_gap
+        self._accel = accel
+
+        # 检查加速器是否可用
+        if not self._accel.check_ffmpeg():
+            logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{self._accel.__name__}加速")
+            self._accel = NoAccel
+        elif self._accel.get_num() <= 0:
+            logger.warning(f"没有可用的{self._accel.__name__}设备或没有正确安装驱动")
+            self._accel = NoAccel
+
+        self.stream_info = get_info(path)
+        assert len(self.stream_info) > 0, "文件中没有视频流"
+        self._out_np_shape = get_out_numpy_shape((self.stream_info[0]["width"], self.stream_info[0]["height"]),
+                                                 pix_fmt)
+        self.index = self._load_index()
+        self._pts = self.index["pts"]
+        self._keyframes = self.index["keyframes"]
+        assert len(self._pts) > 0, "文件中没有视频帧"
+
+    def _cache_path(self) -> str:
+        abs_path = os.path.abspath(self._path)
+        if self._cache_dir is None:
+            folder, name = os.path.split(abs_path)
+            return os.path.join(folder, f".{name}.vsidx.json")
+        digest = hashlib.sha1(abs_path.encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_dir, f"{digest}.vsidx.json")
+
+    def _load_index(self) -> dict:
+        """读取缓存的索引，文件大小或修改时间变了就重新建立索引"""
+        stat = os.stat(self._path)
+        key = {"version": _INDEX_VERSION, "size": stat.st_size, "mtime": stat.st_mtime}
+        cache_path = self._cache_path()
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("key") == key:
+                return cached["index"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = get_frame_index(self._path)
+        try:
+            if self._cache_dir is not None:
+                os.makedirs(self._cache_dir, exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump({"key": key, "index": index}, f)
+        except OSError as e:
+            logger.warning(f"无法写入索引缓存{cache_path}: {e}")
+        return index
+
+    @property
+    def frame_count(self) -> int:
+        return len(self._pts)
+
+    @property
+    def duration(self) -> float:
+        """第一帧到最后一帧的时间"""
+        return self._pts[-1] - self._pts[0]
+
+    def frame_index_at(self, t: Union[float, str]) -> int:
+        """时间t(相对于第一帧)显示的那一帧的下标"""
+        target = self._pts[0] + to_seconds(t)
+        return max(0, bisect.bisect_right(self._pts, target + 1e-6) - 1)
+
+    def _keyframe_before(self, i: int) -> int:
+        pos = bisect.bisect_right(self._keyframes, i) - 1
+        return self._keyframes[pos] if pos >= 0 else 0
+
+    def get_frame_at(self, t: Union[float, str]) -> Union[np.ndarray, None]:
+        """
+        取时间t(秒或"HH:MM:SS.ms"，相对于第一帧)显示的那一帧
+        :return: 帧，解码失败时返回None
+        """
+        return self.get_frames([t])[0]
+
+    def get_frames(self, times: Sequence[Union[float, str]]) -> list:
+        """
+        取多个时间点的帧，返回顺序和times相同
+        目标帧按顺序分组，同一个关键帧之后或者相距不远的目标帧在同一个ffmpeg进程中解码
+        """
+        targets = [self.frame_index_at(t) for t in times]
+        frames: dict[int, np.ndarray] = dict()
+        for run in self._plan_runs(sorted(set(targets))):
+            frames.update(self._decode_run(run))
+        return [frames.get(i) for i in targets]
+
+    def _plan_runs(self, targets: list[int]) -> list[list[int]]:
+        """把排好序的目标帧分组，中间隔着关键帧且相距超过batch_gap时另起一组"""
+        runs: list[list[int]] = []
+        for i in targets:
+            if runs and (self._keyframe_before(i) <= runs[-1][-1] or i - runs[-1][-1] <= self._batch_gap):
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        return runs
+
+    def make_extract_cmd(self, run: list[int]) -> str:
+        """构造从run[0]之前的关键帧开始解码，只输出run中各帧的ffmpeg命令"""
+        start = self._keyframe_before(run[0])
+        pts = self._pts
+        # 用显示时间选出目标帧，容差取相邻两帧间隔的四分之一
+        conds = []
+        for i in run:
+            gap = min(pts[i] - pts[i - 1] if i > 0 else 1., pts[i + 1] - pts[i] if i + 1 < len(pts) else 1.)
+            conds.append(f"lt(abs(t-{pts[i]:.6f})\\,{gap / 4:.6f})")
+        return (f"ffmpeg -loglevel warning -copyts "
+                f"{self._accel.get_accel_opt()} {make_seek_opt(self.index, start)} "
+                f"-i '{self._path}' "
+                f"-vf \"select={'+'.join(conds)}\" -fps_mode passthrough -frames:v {len(run)} "
+                f"-pix_fmt {self._pix_fmt} -f rawvideo "
+                f"pipe: ")
+
+    def _decode_run(self, run: list[int]) -> dict:
+        ffmpeg_proc = run_async(self.make_extract_cmd(run))
+        frames = dict()
+        for i in run:
+            frame = np.empty(self._out_np_shape, dtype=np.uint8)
+            buf = memoryview(frame).cast("B")
+            filled = 0
+            while filled < len(buf):
+                n = ffmpeg_proc.stdout.readinto(buf[filled:])
+                if not n:
+                    break
+                filled += n
+            if filled < len(buf):
+                logger.warning(f"解码第{i}帧失败")
+                break
+            frames[i] = frame
+        release_process(ffmpeg_proc)
+        return frames
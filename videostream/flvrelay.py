@@ -0,0 +1,207 @@
+import subprocess
+from queue import Empty, Full, Queue
+from threading import Thread
+from typing import BinaryIO, Sequence, Union
+
+from videostream.logger import logger
+from videostream.reconnect import Backoff, ReconnectPolicy
+from videostream.tools import release_process, run_async
+
+_FLV_HEADER_LEN = 9 + 4  # 文件头和第一个PreviousTagSize
+_TAG_HEADER_LEN = 11
+_TAG_VIDEO = 9
+_TAG_SCRIPT = 18
+
+
+def _read_exact(stream: BinaryIO, n: int) -> Union[bytes, None]:
+    try:
+        data = stream.read(n)
+    except (ValueError, OSError):
+        # 编码进程已经被关闭
+        return None
+    if data is None or len(data) < n:
+        return None
+    return data
+
+
+def is_keyframe_tag(tag: bytes) -> bool:
+    """FLV tag是否是视频关键帧"""
+    return tag[0] == _TAG_VIDEO and len(tag) > _TAG_HEADER_LEN and tag[_TAG_HEADER_LEN] >> 4 == 1
+
+
+def _is_header_tag(tag: bytes) -> bool:
+    """onMetaData或AVC sequence header，新的接收端在第一个关键帧之前需要先收到它们"""
+    if tag[0] == _TAG_SCRIPT:
+        return True
+    return (tag[0] == _TAG_VIDEO and len(tag) > _TAG_HEADER_LEN + 1
+            and tag[_TAG_HEADER_LEN] & 0x0f == 7 and tag[_TAG_HEADER_LEN + 1] == 0)
+
+
+class _Relay:
+    def __init__(self, fanout: "FlvFanout", url: str, reconn: bool, queue_size: int,
+                 reconnect_policy: Union[ReconnectPolicy, None]):
+        """把FLV tag转推到一个地址的ffmpeg进程(-c copy)，断开后按重连策略单独重连，不影响其他地址和编码进程"""
+        self.url = url
+        self._fanout = fanout
+        self._reconn = reconn
+        self._backoff = Backoff(reconnect_policy, url)  # 重连的等待时间，只在转推线程中更新
+        self._written = 0  # 当前的转推进程已经写入的tag数
+        self._q: Queue = Queue(maxsize=queue_size)
+        self._skip_until_key = True  # 队列满丢过tag，在下一个关键帧之前都不能再放入，只由分发线程修改
+        self._resync = False  # 编码进程重启了，需要用新的文件头重新开始推流
+        self._proc: Union[subprocess.Popen, None] = None
+        self._stop = False
+        self.pushing = False
+        self.reconnects = 0
+        self.dropped = 0  # 因为推流慢、队列满而丢弃的tag数
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, tag: bytes):
+        """由分发线程调用，不会阻塞"""
+        if self._skip_until_key:
+            if not is_keyframe_tag(tag):
+                self.dropped += 1
+                return
+            self._skip_until_key = False
+        try:
+            self._q.put_nowait(tag)
+        except Full:
+            self.dropped += 1
+            self._skip_until_key = True
+
+    def resync(self):
+        """由分发线程在新的FLV流开始前调用，丢掉旧流中还没有发出的tag"""
+        self._resync = True
+        self._skip_until_key = True
+        while True:
+            try:
+                self._q.get_nowait()
+            except Empty:
+                break
+
+    def _start(self) -> bool:
+        # 文件头中已经有onMetaData和sequence header，不需要再分析输入，减少开始推流的延迟
+        cmd = f"ffmpeg -loglevel warning -analyzeduration 0 -probesize 32 -f flv -i - -c copy -f flv '{self.url}'"
+        self._proc = run_async(cmd)
+        self._written = 0
+        try:
+            self._proc.stdin.write(self._fanout.header)
+        except (BrokenPipeError, OSError):
+            self._close()
+            return False
+        return True
+
+    def _close(self):
+        self.pushing = False
+        if self._proc is not None:
+            release_process(self._proc)
+            self._proc = None
+
+    def _run(self):
+        while not self._stop:
+            try:
+                tag = self._q.get(timeout=0.1)
+            except Empty:
+                continue
+            if self._resync:
+                self._resync = False
+                self._close()
+            if self._proc is None:
+                # 新启动的转推进程先写文件头，再从关键帧开始
+                if self._fanout.header is None or not is_keyframe_tag(tag):
+                    continue
+                if not self._start():
+                    logger.error(f"无法转推到{self.url}")
+                    if not self._reconn or not self._wait_reconnect():
+                        break
+                    continue
+            try:
+                self._proc.stdin.write(tag)
+                self._proc.stdin.flush()
+                self.pushing = True
+                self._written += 1
+                if self._written == 10:
+                    # 和Push相同，管道有缓冲，写入成功一些数据之后才算连接成功
+                    self._backoff.connected()
+            except (BrokenPipeError, OSError):
+                logger.error(f"转推到{self.url}失败，可能是和服务器之间的网络连接问题")
+                self._close()
+                if not self._reconn or not self._wait_reconnect():
+                    break
+        self._close()
+
+    def _wait_reconnect(self) -> bool:
+        """按重连策略等待，各地址的等待时间互相错开；返回False表示等待期间被关闭"""
+        delay = self._backoff.next_delay()
+        logger.info(f"{delay:.2f}秒后重新转推到{self.url}")
+        if not self._backoff.wait(delay, lambda: self._stop):
+            return False
+        self.reconnects += 1
+        # 等待期间排队的tag已经过时，重连后从新的关键帧开始
+        while True:
+            try:
+                self._q.get_nowait()
+            except Empty:
+                break
+        return True
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+
+
+class FlvFanout:
+    def __init__(self, urls: Sequence[str], reconn: bool = False, queue_size: int = 300,
+                 reconnect_policy: Union[ReconnectPolicy, None] = None):
+        """
+        把一个ffmpeg编码进程输出的FLV流按tag拆开，分发给每个推流地址各自的转推进程(-c copy)，只编码一次
+        每个地址有自己的队列和重连，某个服务器断开或变慢只会让这一路丢帧、重连，不影响编码和其他地址
+        :param urls: 推流地址
+        :param reconn: 转推失败后是否重连
+        :param queue_size: 每个地址最多缓存的tag数，满了以后丢弃到下一个关键帧
+        :param reconnect_policy: 每个地址转推失败后重连之前的等待时间和熔断，见reconnect.ReconnectPolicy，
+                                 None时使用默认策略
+        """
+        self.header: Union[bytes, None] = None  # FLV文件头、onMetaData和sequence header，新的转推进程先收到它们
+        self._relays = [_Relay(self, url, reconn, queue_size, reconnect_policy) for url in urls]
+
+    def feed(self, stream: BinaryIO) -> bool:
+        """
+        从编码进程的stdout读取FLV流并分发，读到流结束时返回
+        每次调用都是一个新的FLV流，各转推进程会用新的文件头重新开始
+        :return: 是否正常读到了流结束
+        """
+        file_header = _read_exact(stream, _FLV_HEADER_LEN)
+        if file_header is None or file_header[:3] != b"FLV":
+            return False
+        self.header = None
+        header_tags: list[bytes] = []
+        for relay in self._relays:
+            relay.resync()
+
+        while True:
+            tag_header = _read_exact(stream, _TAG_HEADER_LEN)
+            if tag_header is None:
+                return True
+            size = int.from_bytes(tag_header[1:4], "big")
+            body = _read_exact(stream, size + 4)  # tag数据和PreviousTagSize
+            if body is None:
+                return True
+            tag = tag_header + body
+            if self.header is None and _is_header_tag(tag):
+                header_tags.append(tag)
+                continue
+            if self.header is None:
+                self.header = file_header + b"".join(header_tags)
+            for relay in self._relays:
+                relay.put(tag)
+
+    def health(self) -> list[dict]:
+        """每个推流地址的状态"""
+        return [{"url": r.url, "alive": r.pushing, "reconnects": r.reconnects, "dropped": r.dropped,
+                 **r._backoff.stats()} for r in self._relays]
+
+    def close(self):
+        for relay in self._relays:
+            relay.close()
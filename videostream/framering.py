@@ -0,0 +1,244 @@
+import threading
+import time
+from collections import deque
+from queue import Empty
+from typing import BinaryIO, Sequence, Union
+
+import numpy as np
+
+# 缓冲策略
+LATEST = "latest"  # 只保留最新的一帧(mailbox)，消费者总是拿到最新帧，延迟最低，适合实时控制
+DROP_OLDEST = "drop_oldest"  # 缓冲区满时丢弃最旧的帧，适合实时分析
+DROP_NEWEST = "drop_newest"  # 缓冲区满时丢弃新来的帧，已缓存的帧保持连续
+BLOCK = "block"  # 缓冲区满时生产者等待消费者，不丢帧，适合录像和离线分析
+POLICIES = (LATEST, DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class FrameRing:
+    def __init__(self, shape: Sequence[int], size: int = 5, dtype=np.uint8, policy: str = DROP_OLDEST):
+        """
+        预分配的环形帧缓冲区，由一个生产者线程写入，消费者取出帧的视图(view)
+        所有帧槽在创建时一次性分配，之后读帧不再申请内存
+        槽的状态：空闲 -> 写入中 -> 待消费 -> 被消费者持有 -> 空闲
+        每个操作只在一把锁内移动槽号，不拷贝帧数据
+        :param shape: 一帧数据的numpy形状
+        :param size: 帧槽的个数，即最多缓存的帧数
+        :param dtype: 帧数据类型
+        :param policy: 缓冲区满时的策略，LATEST、DROP_OLDEST、DROP_NEWEST或BLOCK，见模块中的说明
+        """
+        assert size >= 2, "帧槽个数至少为2"
+        assert policy in POLICIES, f"缓冲策略必须是{POLICIES}之一"
+        self.shape = tuple(shape)
+        self.size = size
+        self._slots = np.empty((size,) + self.shape, dtype=dtype)
+        self._spare = np.empty(self.shape, dtype=dtype)  # 所有槽都被消费者持有时，新帧读到这里然后丢弃
+        self._slot_nbytes = self._slots[0].nbytes
+        self._base_ptr = self._slots.__array_interface__["data"][0]
+
+        self._cond = threading.Condition()
+        self._free = deque(range(size))  # 空闲的槽
+        self._ready = deque()  # 已写满等待消费的槽，左边是最旧的帧
+        self._held = deque()  # 被消费者持有的槽
+        self._writing = -1  # 正在写入的槽，-1表示写到_spare中
+        self._pinned: dict[int, int] = dict()  # 正在被peek_into拷贝的槽及其引用计数，生产者不会覆盖这些槽
+        self._closed = False
+        self.policy = policy
+        self.dropped = 0  # 按缓冲策略丢弃的帧数
+        # put_from最近读入的一帧(帧槽或备用缓冲，可能已按缓冲策略丢弃)，只在生产者线程中、下一次写入之前有效
+        self.last_put: Union[np.ndarray, None] = None
+
+        # 每提交一帧序号加1，以及每个槽中帧的序号和提交时间(time.monotonic)
+        self.seq = 0
+        self._latest = -1  # 最新提交的帧所在的槽
+        self._slot_seq = np.zeros(size, dtype=np.int64)
+        self._slot_ts = np.zeros(size, dtype=np.float64)
+
+    @property
+    def frame_nbytes(self) -> int:
+        return self._slot_nbytes
+
+    def acquire(self) -> np.ndarray:
+        """
+        生产者获取一个可写的帧槽
+        没有空闲槽时，LATEST、DROP_OLDEST回收最旧的待消费帧（丢弃最旧的帧）；
+        DROP_NEWEST以及所有槽都被消费者持有时，返回备用缓冲，写入的帧会被丢弃；
+        BLOCK一直等到消费者归还帧槽，缓冲区关闭时返回备用缓冲
+        """
+        with self._cond:
+            self._writing = self._take_unpinned(self._free)
+            if self._writing < 0 and self.policy == BLOCK:
+                while self._writing < 0 and not self._closed:
+                    self._cond.wait()
+                    self._writing = self._take_unpinned(self._free)
+            elif self._writing < 0 and self.policy != DROP_NEWEST:
+                self._writing = self._take_unpinned(self._ready)
+                if self._writing >= 0:
+                    self.dropped += 1
+        return self._spare if self._writing < 0 else self._slots[self._writing]
+
+    def _take_unpinned(self, slots: deque) -> int:
+        """从左边取出第一个没有被peek_into占用的槽，没有时返回-1"""
+        for i, idx in enumerate(slots):
+            if idx not in self._pinned:
+                del slots[i]
+                return idx
+        return -1
+
+    def commit(self, ts: Union[float, None] = None):
+        """
+        生产者写完一帧，交给消费者
+        :param ts: 这一帧的时间，None时取time.monotonic()
+        """
+        with self._cond:
+            if self._writing < 0:
+                self.dropped += 1
+            else:
+                self.seq += 1
+                self._slot_seq[self._writing] = self.seq
+                self._slot_ts[self._writing] = time.monotonic() if ts is None else ts
+                self._latest = self._writing
+                if self.policy == LATEST:
+                    # 还没被取走的旧帧直接回收
+                    self.dropped += len(self._ready)
+                    self._free.extend(self._ready)
+                    self._ready.clear()
+                self._ready.append(self._writing)
+                self._cond.notify_all()
+            self._writing = -1
+
+    def abort(self):
+        """生产者放弃正在写入的帧"""
+        with self._cond:
+            if self._writing >= 0:
+                self._free.append(self._writing)
+                self._cond.notify_all()
+            self._writing = -1
+
+    def put_from(self, stream: BinaryIO) -> bool:
+        """
+        从流中读取一帧直接写入帧槽(readinto)，不产生额外的内存分配
+        :param stream: ffmpeg进程的stdout等支持readinto的二进制流
+        :return: False-流已经结束或读到的数据不足一帧
+        """
+        frame = self.acquire()
+        buf = memoryview(frame).cast("B")
+        filled = 0
+        while filled < self._slot_nbytes:
+            n = stream.readinto(buf[filled:])
+            if not n:
+                self.abort()
+                self.last_put = None
+                return False
+            filled += n
+        self.commit()
+        self.last_put = frame
+        return True
+
+    def get(self, block: bool = True, timeout: Union[float, None] = None) -> Union[np.ndarray, None]:
+        """
+        消费者取出最旧的一帧，返回的是帧槽的视图，调用release之前帧数据一直有效
+        超时抛出queue.Empty，缓冲区已关闭且没有剩余帧时返回None
+        """
+        with self._cond:
+            if not self._ready and not self._closed:
+                if not block:
+                    raise Empty
+                if not self._cond.wait_for(lambda: self._ready or self._closed, timeout):
+                    raise Empty
+            if not self._ready:
+                return None
+            idx = self._ready.popleft()
+            self._held.append(idx)
+        return self._slots[idx]
+
+    def peek_into(self, dst: np.ndarray, after: int = 0) -> tuple:
+        """
+        把最新提交的一帧拷贝到dst中，不从缓冲区取出，也不影响get
+        拷贝期间该槽不会被生产者覆盖，且不持有锁
+        :param dst: 目标数组，形状和帧相同
+        :param after: 只拷贝序号大于after的帧
+        :return: (帧序号, 提交时间)，没有符合条件的帧时返回(0, 0.)且不修改dst
+        """
+        with self._cond:
+            idx = self._latest
+            if idx < 0 or idx == self._writing:
+                # 还没有帧，或者最新的帧所在的槽已经被生产者拿去写新帧了
+                return 0, 0.
+            seq = int(self._slot_seq[idx])
+            if seq <= after:
+                return 0, 0.
+            ts = float(self._slot_ts[idx])
+            self._pinned[idx] = self._pinned.get(idx, 0) + 1
+        try:
+            np.copyto(dst, self._slots[idx])
+        finally:
+            with self._cond:
+                self._pinned[idx] -= 1
+                if self._pinned[idx] == 0:
+                    del self._pinned[idx]
+        return seq, ts
+
+    def wait_frame(self, timeout: Union[float, None] = None) -> bool:
+        """等待直到有待消费的帧，有帧时立即返回True，超时或缓冲区关闭且没有剩余帧时返回False"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._ready or self._closed, timeout)
+            return len(self._ready) > 0
+
+    def wait_new(self, after: int, timeout: Union[float, None] = None) -> bool:
+        """等待直到有序号大于after的帧，超时或缓冲区关闭返回False"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > after or self._closed, timeout)
+            return self.seq > after
+
+    def release(self, frame: Union[np.ndarray, None] = None):
+        """
+        消费者归还帧槽
+        :param frame: get返回的帧，为None时归还所有持有的帧
+        """
+        with self._cond:
+            if frame is None:
+                self._free.extend(self._held)
+                self._held.clear()
+            else:
+                idx = self._slot_index(frame)
+                if idx in self._held:
+                    self._held.remove(idx)
+                    self._free.append(idx)
+            self._cond.notify_all()
+
+    def seq_of(self, frame: np.ndarray) -> int:
+        """get返回的帧的序号，从1开始"""
+        idx = self._slot_index(frame)
+        return int(self._slot_seq[idx]) if idx >= 0 else 0
+
+    def ts_of(self, frame: np.ndarray) -> float:
+        """get返回的帧提交时的时间"""
+        idx = self._slot_index(frame)
+        return float(self._slot_ts[idx]) if idx >= 0 else 0.
+
+    def _slot_index(self, frame: np.ndarray) -> int:
+        offset = frame.__array_interface__["data"][0] - self._base_ptr
+        if offset < 0 or offset >= self._slots.nbytes:
+            return -1
+        return offset // self._slot_nbytes
+
+    def has_frame(self) -> bool:
+        return len(self._ready) > 0
+
+    def qsize(self) -> int:
+        return len(self._ready)
+
+    def stats(self) -> dict:
+        """缓冲策略、已提交和丢弃的帧数、当前排队的帧数"""
+        return {"policy": self.policy, "size": self.size, "committed": self.seq, "dropped": self.dropped,
+                "queued": len(self._ready)}
+
+    def close(self):
+        """关闭缓冲区，唤醒所有等待的消费者和阻塞的生产者"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
@@ -0,0 +1,238 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Sequence, Union
+
+from videostream.state import RECONNECTING, RUNNING, STATES, StreamState
+
+# 读写一帧耗时的直方图分桶(秒)，覆盖从管道中已有数据到等待一个低帧率摄像头的下一帧
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 5.)
+
+# stats()中按累计值导出的字段，其余数值字段导出为当前值(gauge)
+COUNTER_KEYS = ("frames_in", "frames_out", "repeated", "dropped", "bytes_in", "bytes_out", "reconnects", "stalls",
+                "reconnect_wait")
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+        固定分桶的直方图，只由一个线程写入，observe只做一次二分查找和几次加法
+        读取时不加锁，快照中各字段之间可能相差一次observe
+        """
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # 最后一个桶是+Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        """{"buckets": 分桶上限, "counts": 每个桶的个数(不累计，最后一个是+Inf), "sum", "count"}"""
+        return {"buckets": list(self.buckets), "counts": list(self._counts), "sum": self.sum, "count": self.count}
+
+
+class _Rate:
+    def __init__(self, window: float = 1.):
+        """按window秒的窗口统计每秒的次数"""
+        self._window = window
+        self._start = time.monotonic()
+        self._n = 0
+        self._value = 0.
+
+    def tick(self, now: float):
+        self._n += 1
+        if now - self._start >= self._window:
+            self._value = self._n / (now - self._start)
+            self._start, self._n = now, 0
+
+    def value(self) -> float:
+        # 超过两个窗口没有新的计数，说明已经停了
+        return self._value if time.monotonic() - self._start < 2 * self._window else 0.
+
+
+class StreamMetrics:
+    def __init__(self, state: StreamState):
+        """
+        一路流的性能计数，由拉流/推流线程在每一帧更新，stats()时取快照
+        重连次数和运行时间由状态机的回调更新
+        """
+        self.created = time.monotonic()
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reconnects = 0
+        self.last_in = 0.  # 最近一次收到帧的时间(time.monotonic)，用于发现卡住的流
+        self.last_out = 0.  # 最近一次送出帧的时间(time.monotonic)
+        self.read_latency = Histogram()
+        self.write_latency = Histogram()
+        self._fps_in = _Rate()
+        self._fps_out = _Rate()
+        self._state = state
+        state.on_change(self._on_state)
+
+    def _on_state(self, old: str, new: str):
+        if new == RECONNECTING:
+            self.reconnects += 1
+
+    def frame_in(self, nbytes: int, latency: Union[float, None] = None):
+        """
+        收到一帧
+        :param latency: 读这一帧阻塞的时间(秒)
+        """
+        now = time.monotonic()
+        self.last_in = now
+        self.frames_in += 1
+        self.bytes_in += nbytes
+        self._fps_in.tick(now)
+        if latency is not None:
+            self.read_latency.observe(latency)
+
+    def frame_out(self, nbytes: int, latency: Union[float, None] = None):
+        """
+        送出一帧
+        :param latency: 写这一帧阻塞的时间(秒)
+        """
+        now = time.monotonic()
+        self.last_out = now
+        self.frames_out += 1
+        self.bytes_out += nbytes
+        self._fps_out.tick(now)
+        if latency is not None:
+            self.write_latency.observe(latency)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "state": self._state.state,
+            "age": now - self.created,  # 创建以来的时间(秒)
+            "uptime": now - self._state.since if self._state.state == RUNNING else 0.,  # 本次连续运行的时间(秒)
+            "reconnects": self.reconnects,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "fps_in": self._fps_in.value(),
+            "fps_out": self._fps_out.value(),
+        }
+
+
+def _format_labels(labels: dict) -> str:
+    def escape(v) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus(streams: dict, prefix: str = "videostream") -> str:
+    """
+    把多路流的stats()转换为Prometheus文本格式
+    数值字段导出为 {prefix}_{字段}，COUNTER_KEYS中的字段加_total后缀，状态导出为
+    {prefix}_state{state="running"} 1，其他状态为0，直方图导出为_bucket/_sum/_count，帧缓冲区按output标签导出，
+    ffmpeg的进度(见monitor.parse_progress)导出为 {prefix}_ffmpeg_{字段}
+    :param streams: {名字: 有stats方法的对象}，名字作为stream标签
+    """
+    families: dict[str, tuple] = dict()  # 指标名 -> (类型, [(样本名, 标签, 值), ...])，同名的样本写在一起
+
+    def add(family: str, kind: str, labels: dict, value, suffix: str = ""):
+        families.setdefault(family, (kind, []))[1].append((family + suffix, labels, value))
+
+    for stream_name, stream in streams.items():
+        stats = stream.stats()
+        base = {"stream": stream_name, "kind": stats.get("kind", "")}
+        for key, value in stats.items():
+            if key == "state":
+                # 每个状态都导出，切换后旧状态变为0而不是消失
+                for state in STATES:
+                    add(f"{prefix}_state", "gauge", {**base, "state": state}, int(state == value))
+            elif isinstance(value, bool):
+                add(f"{prefix}_{key}", "gauge", base, int(value))
+            elif isinstance(value, (int, float)):
+                if key in COUNTER_KEYS:
+                    add(f"{prefix}_{key}_total", "counter", base, value)
+                else:
+                    add(f"{prefix}_{key}", "gauge", base, value)
+            elif isinstance(value, dict) and "buckets" in value:
+                family = f"{prefix}_{key}_seconds"
+                cumulative = 0
+                for le, n in zip(value["buckets"] + ["+Inf"], value["counts"]):
+                    cumulative += n
+                    add(family, "histogram", {**base, "le": le}, cumulative, "_bucket")
+                add(family, "histogram", base, value["sum"], "_sum")
+                add(family, "histogram", base, value["count"], "_count")
+            elif key == "buffers":
+                for output, ring_stats in value.items():
+                    labels = {**base, "output": output}
+                    add(f"{prefix}_buffer_committed_total", "counter", labels, ring_stats["committed"])
+                    add(f"{prefix}_buffer_dropped_total", "counter", labels, ring_stats["dropped"])
+                    add(f"{prefix}_buffer_queued", "gauge", labels, ring_stats["queued"])
+            elif key == "ffmpeg":
+                # 当前ffmpeg进程的进度，重连后从0开始，所以都按当前值导出
+                for field, field_value in value.items():
+                    add(f"{prefix}_ffmpeg_{field}", "gauge", base, field_value)
+
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append(f"# TYPE {family} {kind}")
+        lines += [f"{name}{_format_labels(labels)} {value}" for name, labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    def __init__(self, streams: Union[dict, None] = None, host: str = "127.0.0.1", port: int = 9100,
+                 prefix: str = "videostream"):
+        """
+        在本地HTTP端口上以Prometheus文本格式导出各路流的stats()，只在被抓取时计算，不抓取时没有开销
+        GET /metrics 返回所有流的指标
+        :param streams: {名字: Pull/Push/PullPush}，之后也可以用add、remove增减
+        :param port: 端口，0表示自动选择，实际端口见port属性
+        """
+        self._streams = dict(streams or {})
+        self._lock = threading.Lock()
+        self._prefix = prefix
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def add(self, name: str, stream):
+        with self._lock:
+            self._streams[name] = stream
+
+    def remove(self, name: str):
+        with self._lock:
+            self._streams.pop(name, None)
+
+    def render(self) -> str:
+        with self._lock:
+            streams = dict(self._streams)
+        return render_prometheus(streams, self._prefix)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
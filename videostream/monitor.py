@@ -0,0 +1,201 @@
+import os
+import selectors
+import threading
+import time
+from collections import deque
+from subprocess import Popen
+from typing import Callable, Sequence, Union
+
+from videostream.logger import logger
+from videostream.tools import run_async
+
+# -progress输出中需要的字段及其解析方法，bitrate单位是kbit/s，speed是相对实时的倍数
+_PROGRESS_FIELDS = {
+    "frame": int,
+    "fps": float,
+    "bitrate": lambda v: float(v.replace("kbits/s", "")),
+    "total_size": int,
+    "out_time_us": int,
+    "dup_frames": int,
+    "drop_frames": int,
+    "speed": lambda v: float(v.rstrip("x")),
+}
+
+
+def progress_supported() -> bool:
+    """-progress写到单独的管道需要把文件描述符传给子进程(pass_fds)，只支持类Unix系统"""
+    return os.name == "posix"
+
+
+def make_progress_opt(fd: Union[int, None]) -> str:
+    """让ffmpeg把进度(key=value，每0.5秒一组)写到文件描述符fd，fd为None时返回空字符串"""
+    return f"-progress pipe:{fd}" if fd is not None else ""
+
+
+def parse_progress(block: dict) -> dict:
+    """把一组-progress输出转换为数值，N/A和无法解析的字段省略"""
+    parsed = dict()
+    for key, parse in _PROGRESS_FIELDS.items():
+        value = block.get(key)
+        if value is None or value == "N/A":
+            continue
+        try:
+            parsed[key] = parse(value)
+        except ValueError:
+            pass
+    return parsed
+
+
+class LogRing:
+    def __init__(self, maxlen: int = 100):
+        """保存ffmpeg最近输出的日志行(-loglevel warning时只有警告和错误)，用于诊断，断线重连后仍然保留"""
+        self._lines: deque = deque(maxlen=maxlen)
+
+    def append(self, line: str):
+        self._lines.append((time.time(), line))
+
+    def lines(self, n: Union[int, None] = None) -> list[tuple]:
+        """最近的n行，[(时间戳time.time(), 日志行), ...]，从旧到新"""
+        lines = list(self._lines)
+        return lines if n is None else lines[-n:]
+
+
+class FfmpegMonitor:
+    def __init__(self, proc: Popen, progress_fd: Union[int, None], log: LogRing,
+                 on_line: Union[Callable[[str], None], None] = None):
+        """
+        在一个线程中读取ffmpeg进程的stderr和-progress管道，直到两者都关闭
+        stderr的每一行存入log，进度保存在progress中
+        :param proc: 用run_async(capture_stderr=True)启动的ffmpeg进程
+        :param progress_fd: -progress管道的读端，本对象负责关闭；None表示不读进度
+        :param on_line: 每一行stderr的回调，在监视线程中调用
+        """
+        self.progress: dict = dict()  # 最近一组进度，见parse_progress
+        self.updated = 0.  # 最近一次收到进度的时间(time.monotonic)
+        self.advanced = 0.  # 最近一次输出有进展(帧数或输出时间增加)的时间(time.monotonic)
+        self._proc = proc
+        self._progress_fd = progress_fd
+        self._log = log
+        self._on_line = on_line
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _handle_line(self, line: str, is_progress: bool, block: dict):
+        if not is_progress:
+            self._log.append(line)
+            if self._on_line is not None:
+                self._on_line(line)
+            return
+        key, _, value = line.partition("=")
+        block[key] = value
+        if key == "progress":
+            # 一组进度以progress=continue或progress=end结束
+            progress = parse_progress(block)
+            now = time.monotonic()
+            if (progress.get("frame", 0) > self.progress.get("frame", 0)
+                    or progress.get("out_time_us", 0) > self.progress.get("out_time_us", 0)):
+                self.advanced = now
+            self.progress, self.updated = progress, now
+            block.clear()
+
+    def _run(self):
+        if self._progress_fd is None:
+            # 只有stderr时直接逐行读取，不需要selector
+            try:
+                for raw in self._proc.stderr:
+                    self._handle_line(raw.decode("utf-8", errors="replace").rstrip(), False, dict())
+            finally:
+                self._proc.stderr.close()
+            return
+
+        selector = selectors.DefaultSelector()
+        stderr_fd = self._proc.stderr.fileno()
+        selector.register(stderr_fd, selectors.EVENT_READ, False)
+        selector.register(self._progress_fd, selectors.EVENT_READ, True)
+        pending = {False: b"", True: b""}  # 还没有凑成一行的数据
+        block: dict = dict()
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    try:
+                        data = os.read(key.fd, 65536)
+                    except OSError:
+                        data = b""
+                    if not data:
+                        selector.unregister(key.fd)
+                        continue
+                    *lines, pending[key.data] = (pending[key.data] + data).split(b"\n")
+                    for line in lines:
+                        self._handle_line(line.decode("utf-8", errors="replace").rstrip(), key.data, block)
+        except Exception as e:
+            logger.exception("读取ffmpeg的日志和进度失败", e)
+        finally:
+            selector.close()
+            os.close(self._progress_fd)
+            self._proc.stderr.close()
+
+    def join(self, timeout: Union[float, None] = None):
+        self._thread.join(timeout)
+
+
+def run_monitored(cmd: str, log: LogRing, pass_fds: Sequence[int] = (),
+                  on_line: Union[Callable[[str], None], None] = None) -> tuple:
+    """
+    启动ffmpeg进程并监视它：支持时加上-progress写到单独的管道，stderr的日志存入log，见FfmpegMonitor
+    :param cmd: 以"ffmpeg "开头的命令，-progress是全局选项，加在ffmpeg之后
+    :param pass_fds: 额外传给子进程的文件描述符，见run_async
+    :return: (ffmpeg进程, FfmpegMonitor)
+    """
+    assert cmd.startswith("ffmpeg "), "只能监视ffmpeg命令"
+    progress_r, progress_w = os.pipe() if progress_supported() else (None, None)
+    if progress_w is not None:
+        cmd = cmd.replace("ffmpeg ", f"ffmpeg {make_progress_opt(progress_w)} ", 1)
+        pass_fds = tuple(pass_fds) + (progress_w,)
+    try:
+        proc = run_async(cmd, pass_fds=pass_fds, capture_stderr=True)
+    except Exception:
+        if progress_r is not None:
+            os.close(progress_r)
+        raise
+    finally:
+        if progress_w is not None:
+            os.close(progress_w)
+    return proc, FfmpegMonitor(proc, progress_r, log, on_line)
+
+
+class StallWatchdog:
+    def __init__(self, interval: float = 0.5):
+        """
+        一个线程每隔interval秒调用所有注册的检查函数，用来发现卡住(不再出帧但也不断开)的流
+        检查函数应该很快返回，发现卡住时自己结束ffmpeg进程，由流的工作线程重连
+        """
+        self._interval = interval
+        self._checks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._thread: Union[threading.Thread, None] = None
+
+    def add(self, check: Callable[[], None]):
+        with self._lock:
+            self._checks.append(check)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def remove(self, check: Callable[[], None]):
+        with self._lock:
+            if check in self._checks:
+                self._checks.remove(check)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                checks = list(self._checks)
+            for check in checks:
+                try:
+                    check()
+                except Exception as e:
+                    logger.exception("卡顿检查出错", e)
+
+
+watchdog = StallWatchdog()  # 所有流共用的看门狗线程，第一次注册时启动
@@ -0,0 +1,247 @@
+import math
+import os
+import threading
+import time
+from queue import Empty
+from threading import Thread
+from typing import Type, Union
+
+import numpy as np
+
+from videostream.accelerator import Accelerator, NoAccel
+from videostream.framering import BLOCK, FrameRing
+from videostream.logger import logger
+from videostream.tools import (get_info, get_frame_index, get_out_numpy_shape, make_seek_opt, run_async,
+                               release_process)
+
+
+def plan_segments(index: dict, n: int) -> list[tuple]:
+    """
+    在关键帧处把视频分成最多n段，每段的帧数尽量相等
+    :param index: get_frame_index的返回值
+    :param n: 段数
+    :return: [(起始帧下标, 帧数), ...]
+    """
+    total = len(index["pts"])
+    keyframes = [k for k in index["keyframes"] if k > 0]
+    starts = [0]
+    for i in range(1, n):
+        target = total * i / n
+        if not keyframes:
+            break
+        k = min(keyframes, key=lambda kf: abs(kf - target))
+        if k > starts[-1]:
+            starts.append(k)
+    return [(s, e - s) for s, e in zip(starts, starts[1:] + [total])]
+
+
+def make_segment_cmd(url: str, pix_fmt: str, accel: Type[Accelerator], index: dict, start: int, count: int) -> str:
+    """
+    构造解码一段视频的ffmpeg命令，输出恰好count帧
+    从起始关键帧处seek(-noaccurate_seek，不丢弃seek点之后的帧)，
+    时间戳保持原值(-copyts)，用select丢掉open GOP中显示时间早于起始关键帧、属于上一段的帧，
+    -fps_mode passthrough保证不插帧也不丢帧
+    """
+    pts = index["pts"]
+    seek_opt, select_opt = make_seek_opt(index, start), ""
+    if start > 0:
+        half = (pts[start] - pts[start - 1]) / 2
+        select_opt = f'-vf "select=gte(t\\,{pts[start] - half:.6f})"'
+
+    return (f"ffmpeg -loglevel warning -copyts "
+            f"{accel.get_accel_opt()} {seek_opt} "
+            f"-i '{url}' "
+            f"{select_opt} -fps_mode passthrough -frames:v {count} "
+            f"-pix_fmt {pix_fmt} -f rawvideo "
+            f"pipe: ")
+
+
+class ParallelFilePull:
+    def __init__(self, url: str, segments: Union[int, None] = None, pix_fmt: str = "rgb24", ordered: bool = True,
+                 buffer_size: int = 8, accel: Type[Accelerator] = NoAccel, chunk_frames: int = 50,
+                 max_buffer_bytes: Union[int, None] = None):
+        """
+        把一个视频文件在关键帧处分成多段，每段用一个ffmpeg进程同时解码，离线分析时按CPU核数缩短耗时
+        每一帧恰好交付一次，段的边界处不重复也不遗漏
+        :param url: 视频文件的地址
+        :param segments: 同时运行的ffmpeg进程数，默认是CPU核数
+        :param pix_fmt: 输出帧的格式
+        :param ordered: True-get_frame按帧的顺序返回帧：文件在关键帧处切成约chunk_frames帧的小块，
+                        各进程按顺序领取还没解码的块，缓冲区满时等待，在前面的块被读取时继续解码；
+                        False-分成segments段，各段解码出帧就返回(帧下标, 帧)，完全并行
+        :param buffer_size: 每一段(块)的帧缓冲区最多缓存的帧数，和块的帧数无关
+        :param accel: 使用的加速器，默认不使用加速器(NoAccel)
+        :param chunk_frames: ordered为True时每块的目标帧数，块的边界只能在关键帧处，所以不小于GOP长度
+        :param max_buffer_bytes: ordered为True时所有块的帧缓冲区加起来最多占用的字节数，
+                                 决定最多领先正在读取的块多少块；None时为(segments + 1) * buffer_size帧
+        """
+        assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        assert chunk_frames >= 1 and buffer_size >= 2
+        self._url = url
+        self._pix_fmt = pix_fmt
+        self._ordered = ordered
+        self._accel = accel
+        self._stop = False
+
+        # 检查加速器是否可用
+        if not self._accel.check_ffmpeg():
+            logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{self._accel.__name__}加速")
+            self._accel = NoAccel
+        elif self._accel.get_num() <= 0:
+            logger.warning(f"没有可用的{self._accel.__name__}设备或没有正确安装驱动")
+            self._accel = NoAccel
+
+        self.stream_info = get_info(url)
+        assert len(self.stream_info) > 0, "文件中没有视频流"
+        self.index = get_frame_index(url)
+        self.frame_count = len(self.index["pts"])
+        workers = segments or os.cpu_count() or 1
+        self._out_np_shape = get_out_numpy_shape((self.stream_info[0]["width"], self.stream_info[0]["height"]),
+                                                 pix_fmt)
+        if ordered:
+            self.segments = plan_segments(self.index, max(workers, math.ceil(self.frame_count / chunk_frames)))
+            # 每块的缓冲区在开始解码时分配，读完后释放；所有块的缓冲区加起来不超过_max_slots帧
+            self._rings: list[Union[FrameRing, None]] = [None] * len(self.segments)
+            frame_nbytes = int(np.prod(self._out_np_shape))
+            self._max_slots = (max(max_buffer_bytes // frame_nbytes, 2) if max_buffer_bytes is not None
+                               else (workers + 1) * buffer_size)
+            self._buffer_size = min(buffer_size, self._max_slots)
+        else:
+            self.segments = plan_segments(self.index, workers)
+            self._rings = [FrameRing(self._out_np_shape, buffer_size, policy=BLOCK) for _ in self.segments]
+        self._live_slots = 0  # ordered为True时已分配、还没有释放的帧槽数
+        self._cond = threading.Condition()  # 分配新块、任意一段有新帧或结束时通知
+        self._next = 0  # 下一个要领取的段
+        self._current = 0  # 按顺序取帧时，当前正在读的段
+        self._last_ring: Union[FrameRing, None] = None  # 上一次get_frame取出的帧所在的缓冲区
+        self._threads = [Thread(target=self._run, daemon=True) for _ in range(min(workers, len(self.segments)))]
+        for t in self._threads:
+            t.start()
+
+    def _slots(self, i: int) -> int:
+        """第i块的帧缓冲区的帧槽数"""
+        return max(min(self.segments[i][1], self._buffer_size), 2)
+
+    def _can_claim(self) -> bool:
+        """下一段可以领取：缓冲区已经分配(ordered为False)，或者分配后不超过_max_slots；
+        没有已分配的缓冲区时总是可以领取，正在读取的块不会因为预算太小而等不到缓冲区"""
+        if self._next >= len(self.segments) or self._rings[self._next] is not None:
+            return True
+        return self._live_slots == 0 or self._live_slots + self._slots(self._next) <= self._max_slots
+
+    def _run(self):
+        """工作线程：按顺序领取还没解码的段，领先当前读取的段多少段由缓冲区的内存预算决定"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stop or self._can_claim())
+                if self._stop or self._next >= len(self.segments):
+                    return
+                i = self._next
+                self._next += 1
+                if self._rings[i] is None:
+                    self._rings[i] = FrameRing(self._out_np_shape, self._slots(i), policy=BLOCK)
+                    self._live_slots += self._rings[i].size
+                ring = self._rings[i]
+                self._cond.notify_all()
+            self._decode(i, ring)
+
+    def _decode(self, i: int, ring: FrameRing):
+        """解码第i段到ring中"""
+        start, count = self.segments[i]
+        cmd = make_segment_cmd(self._url, self._pix_fmt, self._accel, self.index, start, count)
+        ffmpeg_proc = run_async(cmd)
+        got = 0
+        while got < count and not self._stop:
+            if not ring.put_from(ffmpeg_proc.stdout):
+                break
+            got += 1
+            if not self._ordered:
+                with self._cond:
+                    self._cond.notify_all()
+        if got < count and not self._stop:
+            logger.warning(f"第{i}段应解码{count}帧，实际只有{got}帧")
+        release_process(ffmpeg_proc)
+        ring.close()
+        with self._cond:
+            self._cond.notify_all()
+
+    def get_frame(self, block: bool = True, timeout: Union[float, None] = None) -> Union[np.ndarray, tuple, None]:
+        """
+        返回帧缓冲区的视图，在下一次get_frame之前有效，全部帧都取完后返回None
+        ordered为True时返回帧，为False时返回(帧下标, 帧)
+        """
+        if self._last_ring is not None:
+            self._last_ring.release()
+            self._last_ring = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._ordered:
+            return self._get_ordered(block, deadline)
+        return self._get_any(block, deadline)
+
+    @staticmethod
+    def _remaining(deadline: Union[float, None]) -> Union[float, None]:
+        """距离deadline的秒数，已经超时抛出Empty"""
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Empty
+        return remaining
+
+    def _get_ordered(self, block: bool, deadline: Union[float, None]) -> Union[np.ndarray, None]:
+        while self._current < len(self._rings):
+            with self._cond:
+                if self._rings[self._current] is None:
+                    # 这一块还没有开始解码
+                    if not block:
+                        raise Empty
+                    if not self._cond.wait_for(lambda: self._stop or self._rings[self._current] is not None,
+                                               self._remaining(deadline)):
+                        raise Empty
+                    if self._stop:
+                        return None
+                ring = self._rings[self._current]
+            frame = ring.get(block, self._remaining(deadline) if block else None)
+            if frame is not None:
+                self._last_ring = ring
+                return frame
+            # 这一块读完了，释放它的缓冲区，让工作线程领取后面的块
+            with self._cond:
+                self._rings[self._current] = None
+                self._live_slots -= ring.size
+                self._current += 1
+                self._cond.notify_all()
+        return None
+
+    def _get_any(self, block: bool, deadline: Union[float, None]) -> Union[tuple, None]:
+        with self._cond:
+            while True:
+                for (start, _), ring in zip(self.segments, self._rings):
+                    if ring.has_frame():
+                        frame = ring.get(block=False)
+                        self._last_ring = ring
+                        return start + ring.seq_of(frame) - 1, frame
+                if all(ring.closed for ring in self._rings):
+                    return None
+                if not block:
+                    raise Empty
+                if not self._cond.wait(self._remaining(deadline)):
+                    raise Empty
+
+    def __iter__(self):
+        while True:
+            item = self.get_frame()
+            if item is None:
+                return
+            yield item
+
+    def release(self):
+        """停止所有段的解码"""
+        with self._cond:
+            self._stop = True
+            rings = [ring for ring in self._rings if ring is not None]
+            self._cond.notify_all()
+        for ring in rings:
+            ring.close()
+        for t in self._threads:
+            t.join()
@@ -0,0 +1,329 @@
+import multiprocessing as mp
+import multiprocessing.connection
+import threading
+import time
+import uuid
+from multiprocessing import shared_memory
+from queue import Empty, Queue
+from threading import Thread
+from typing import Callable, Sequence, Union
+
+import numpy as np
+
+from videostream.logger import logger
+from videostream.shmbus import _attach_untracked
+
+
+class _StageTimer:
+    def __init__(self):
+        """统计一个处理阶段的次数、平均耗时和最大耗时"""
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, secs: float):
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+
+    def snapshot(self) -> dict:
+        mean = self.total / self.count if self.count else 0.
+        return {"count": self.count, "mean": mean, "max": self.max}
+
+
+def _worker(in_name: str, out_name: str, in_shape: tuple, out_shape: tuple, slot_num: int,
+            fn: Callable, tasks: mp.Queue, results, busy, index: int):
+    """
+    工作进程：从共享内存的输入槽读帧，处理结果写到同号的输出槽，只通过队列传递(序号, 槽号)
+    results是本进程专用的管道，send直接写入管道，不像mp.Queue.put那样由后台线程稍后写出，
+    进程意外退出时已经处理完的结果不会丢失；
+    busy[2 * index]、busy[2 * index + 1]记录正在处理的序号和槽号，进程意外退出时主进程据此跳过这一帧
+    """
+    in_shm, out_shm = _attach_untracked(in_name), _attach_untracked(out_name)
+    in_slots = np.ndarray((slot_num,) + in_shape, dtype=np.uint8, buffer=in_shm.buf)
+    out_slots = np.ndarray((slot_num,) + out_shape, dtype=np.uint8, buffer=out_shm.buf)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, slot = task
+        busy[2 * index], busy[2 * index + 1] = seq, slot
+        t = time.perf_counter()
+        try:
+            result = fn(in_slots[slot])
+            # fn返回None时认为是在输入帧上原地处理
+            np.copyto(out_slots[slot], in_slots[slot] if result is None else result.reshape(out_shape))
+            ok = True
+        except Exception as e:
+            logger.exception(f"处理第{seq}帧出错: {e}")
+            ok = False
+        results.send((seq, slot, ok, time.perf_counter() - t))
+        busy[2 * index] = -1
+    results.close()
+    del in_slots, out_slots
+    in_shm.close()
+    out_shm.close()
+
+
+class Pipeline:
+    def __init__(self, pull, fn: Callable[[np.ndarray], Union[np.ndarray, None]], push, workers: int = 2,
+                 window: Union[int, None] = None, late: str = "wait", late_timeout: float = 1.,
+                 out_shape: Union[Sequence[int], None] = None):
+        """
+        拉流 -> 多进程处理 -> 按原顺序推流
+        帧通过共享内存传给工作进程，进程间只传递(序号, 槽号)，不pickle帧数据
+        :param pull: Pull或PoolStream
+        :param fn: 处理函数，输入一帧，返回处理后的帧，返回None表示在输入帧上原地修改；
+                   需要能被pickle(模块级函数)，在工作进程中调用
+        :param push: Push，处理后的帧按拉流的顺序调用push.put_frame
+        :param workers: 工作进程数
+        :param window: 同时在处理中的最多帧数，默认是workers的2倍，窗口满时拉流端的帧留在Pull的缓冲区中
+        :param late: 迟到帧的处理策略，"wait"-一直等它处理完，保证不丢帧(工作进程意外退出时它正在处理的帧算作出错)；
+                     "drop"-等待超过late_timeout就跳过它，后面的帧继续推送，迟到的结果直接丢弃
+        :param late_timeout: "drop"策略下最长等待时间(秒)
+        :param out_shape: 处理结果的形状，默认和输入帧相同
+        """
+        assert workers >= 1
+        assert late in ("wait", "drop")
+        assert pull.frame_ring is not None, "拉流没有打开"
+        self._pull = pull
+        self._push = push
+        self._late = late
+        self._late_timeout = late_timeout
+        self._slot_num = window or workers * 2
+        self._in_shape = pull.frame_ring.shape
+        self._out_shape = tuple(out_shape) if out_shape is not None else self._in_shape
+
+        tag = uuid.uuid4().hex[:12]
+        self._in_shm = shared_memory.SharedMemory(name=f"vs_in_{tag}", create=True,
+                                                  size=self._slot_num * int(np.prod(self._in_shape)))
+        self._out_shm = shared_memory.SharedMemory(name=f"vs_out_{tag}", create=True,
+                                                   size=self._slot_num * int(np.prod(self._out_shape)))
+        self._in_slots = np.ndarray((self._slot_num,) + self._in_shape, dtype=np.uint8, buffer=self._in_shm.buf)
+        self._out_slots = np.ndarray((self._slot_num,) + self._out_shape, dtype=np.uint8, buffer=self._out_shm.buf)
+
+        self._free: Queue = Queue()  # 空闲的槽
+        for i in range(self._slot_num):
+            self._free.put(i)
+        self._tasks = mp.Queue()
+        self._fn = fn
+        self._busy = mp.Array("q", [-1] * (2 * workers), lock=False)  # 每个工作进程正在处理的(序号, 槽号)
+        self._workers: list[Union[mp.Process, None]] = [None] * workers
+        self._results: list = [None] * workers  # 每个工作进程的结果管道的读端
+
+        self._lock = threading.Lock()
+        self._sent_at: dict[int, float] = dict()  # 已分发、还没有推送或丢弃的帧的分发时间
+        self._next_seq = 0  # 下一个要分发的帧序号
+        self._stop = False
+        self._start_time = time.monotonic()
+        self._pushed = 0
+        self._dropped_late = 0
+        # 出错的帧数，分发线程和收集线程各自计数，不会因为同时+=而丢失
+        self._errors = 0  # 处理出错或者工作进程退出丢失的帧，只在收集线程中更新
+        self._shape_errors = 0  # 形状不一致而跳过的帧，只在分发线程中更新
+        self._worker_restarts = 0
+        self._bad_shape: Union[tuple, None] = None  # 最近一次报告过的不一致的帧形状
+        self._timers = {name: _StageTimer() for name in ("pull", "dispatch", "process", "reorder", "push", "total")}
+
+        for i in range(workers):
+            self._start_worker(i)
+        self._dispatch_thread = Thread(target=self._dispatch, daemon=True)
+        self._collect_thread = Thread(target=self._collect, daemon=True)
+        self._dispatch_thread.start()
+        self._collect_thread.start()
+
+    def _start_worker(self, index: int):
+        """启动(或重启)第index个工作进程，每个进程有自己的结果管道"""
+        self._busy[2 * index] = -1
+        reader, writer = mp.Pipe(duplex=False)
+        if self._results[index] is not None:
+            self._results[index].close()
+        self._results[index] = reader
+        self._workers[index] = mp.Process(target=_worker, daemon=True,
+                                          args=(self._in_shm.name, self._out_shm.name, self._in_shape,
+                                                self._out_shape, self._slot_num, self._fn, self._tasks, writer,
+                                                self._busy, index))
+        self._workers[index].start()
+        # 只有工作进程持有写端，它退出后读端读到EOF
+        writer.close()
+
+    def _receive(self, timeout: float) -> list[tuple]:
+        """等待并读取所有工作进程已经发出的结果"""
+        results = []
+        for conn in mp.connection.wait(self._results, timeout):
+            try:
+                while conn.poll():
+                    results.append(conn.recv())
+            except (EOFError, OSError):
+                # 工作进程已经退出，由_check_workers重启
+                pass
+        return results
+
+    def _dispatch(self):
+        """分发线程：取帧，拷贝到空闲的输入槽，交给工作进程"""
+        while not self._stop:
+            try:
+                slot = self._free.get(timeout=0.1)
+            except Empty:
+                continue
+
+            t = time.perf_counter()
+            frame = None
+            while not self._stop:
+                try:
+                    frame = self._pull.get_frame(block=True, timeout=0.1)
+                except Empty:
+                    continue
+                if frame is None:
+                    # 拉流已关闭
+                    time.sleep(0.01)
+                    continue
+                break
+            if frame is None:
+                self._free.put(slot)
+                break
+            self._timers["pull"].add(time.perf_counter() - t)
+
+            if frame.shape != self._in_shape:
+                # 拉流重连后分辨率变了，共享内存的槽按原来的形状分配，只能跳过
+                if frame.shape != self._bad_shape:
+                    logger.error(f"帧的形状{frame.shape}和Pipeline创建时的{self._in_shape}不一致，跳过这些帧")
+                    self._bad_shape = frame.shape
+                self._pull.release_frame(frame)
+                self._free.put(slot)
+                self._shape_errors += 1
+                continue
+
+            t = time.perf_counter()
+            np.copyto(self._in_slots[slot], frame)
+            self._pull.release_frame(frame)
+            with self._lock:
+                seq = self._next_seq
+                self._next_seq += 1
+                self._sent_at[seq] = time.perf_counter()
+            self._tasks.put((seq, slot))
+            self._timers["dispatch"].add(time.perf_counter() - t)
+
+    def _collect(self):
+        """收集线程：把处理结果按序号重新排序后推送"""
+        done: dict[int, tuple] = dict()  # 已处理完、等待按顺序推送的帧: 序号 -> (槽号, 是否成功, 完成时间)
+        skipped: set[int] = set()  # "drop"策略下被跳过的序号，结果到达后直接丢弃
+        emit_seq = 0
+        while not self._stop:
+            results = self._receive(0.05)
+            # 先处理退出的进程发出的全部结果，再把它处理到一半的帧算作出错
+            lost = self._check_workers(results)
+            for seq, slot, ok, secs in results:
+                self._timers["process"].add(secs)
+                if seq in skipped:
+                    skipped.remove(seq)
+                    self._free.put(slot)
+                elif seq < emit_seq or seq in done:
+                    # 工作进程退出时已经按出错处理过的帧，槽已经归还
+                    pass
+                else:
+                    done[seq] = (slot, ok, time.perf_counter())
+
+            for seq, slot in lost:
+                if seq in skipped:
+                    skipped.remove(seq)
+                    self._free.put(slot)
+                elif seq >= emit_seq and seq not in done:
+                    done[seq] = (slot, False, time.perf_counter())
+
+            while not self._stop:
+                if emit_seq in done:
+                    slot, ok, finished_at = done.pop(emit_seq)
+                    self._emit(emit_seq, slot, ok, finished_at)
+                    emit_seq += 1
+                    continue
+
+                with self._lock:
+                    sent_at = self._sent_at.get(emit_seq)
+                if sent_at is None:
+                    break
+                if self._late == "drop" and time.perf_counter() - sent_at > self._late_timeout:
+                    # 这一帧迟到了，跳过它继续推送后面的帧
+                    with self._lock:
+                        self._sent_at.pop(emit_seq, None)
+                    skipped.add(emit_seq)
+                    self._dropped_late += 1
+                    emit_seq += 1
+                    continue
+                break
+
+    def _check_workers(self, results: list[tuple]) -> list[tuple]:
+        """
+        重启意外退出的工作进程，返回它们退出时正在处理的(序号, 槽号)
+        :param results: 退出的进程的结果管道中剩下的结果追加到这里，重启会关闭旧的管道
+        """
+        lost = []
+        for i, w in enumerate(self._workers):
+            if w.exitcode is None or self._stop:
+                continue
+            conn = self._results[i]
+            try:
+                while conn.poll():
+                    results.append(conn.recv())
+            except (EOFError, OSError):
+                pass
+            seq, slot = self._busy[2 * i], self._busy[2 * i + 1]
+            logger.error(f"Pipeline工作进程意外退出(exitcode={w.exitcode})" + (f"，跳过第{seq}帧" if seq >= 0 else ""))
+            if seq >= 0:
+                lost.append((seq, slot))
+            self._start_worker(i)
+            self._worker_restarts += 1
+        return lost
+
+    def _emit(self, seq: int, slot: int, ok: bool, finished_at: float):
+        now = time.perf_counter()
+        self._timers["reorder"].add(now - finished_at)
+        if ok:
+            self._push.put_frame(self._out_slots[slot])
+            self._pushed += 1
+            self._timers["push"].add(time.perf_counter() - now)
+        else:
+            self._errors += 1
+        self._free.put(slot)
+        with self._lock:
+            sent_at = self._sent_at.pop(seq, now)
+        self._timers["total"].add(time.perf_counter() - sent_at)
+
+    def stats(self) -> dict:
+        """
+        吞吐量和各阶段耗时(秒)
+        pull-等待拉流帧，dispatch-拷贝到共享内存并分发，process-工作进程中fn的耗时，
+        reorder-处理完后等待前面的帧的时间，push-put_frame的耗时，total-从分发到推送的延迟
+        """
+        elapsed = time.monotonic() - self._start_time
+        with self._lock:
+            in_flight = len(self._sent_at)
+        return {
+            "dispatched": self._next_seq,
+            "pushed": self._pushed,
+            "dropped_late": self._dropped_late,
+            "errors": self._errors + self._shape_errors,
+            "worker_restarts": self._worker_restarts,
+            "in_flight": in_flight,
+            "fps": self._pushed / elapsed if elapsed > 0 else 0.,
+            "stages": {name: timer.snapshot() for name, timer in self._timers.items()},
+        }
+
+    def release(self):
+        """停止分发和工作进程，释放共享内存，不会关闭pull和push"""
+        self._stop = True
+        self._dispatch_thread.join()
+        self._collect_thread.join()
+        for _ in self._workers:
+            self._tasks.put(None)
+        for w in self._workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()
+        for conn in self._results:
+            conn.close()
+        del self._in_slots, self._out_slots
+        for shm in (self._in_shm, self._out_shm):
+            shm.close()
+            shm.unlink()
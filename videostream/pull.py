@@ -1,151 +1,574 @@
+import os
 import subprocess
 import time
-from queue import Queue
 from threading import Thread
-from typing import Type, Union
+from typing import Callable, Sequence, Type, Union
 
 import cv2
 import numpy as np
 
 from videostream.accelerator import Accelerator, NoAccel
+from videostream.framering import BLOCK, DROP_OLDEST, FrameRing
 from videostream.logger import logger
-from videostream.tools import get_info, is_stream, run_async, release_process, get_out_numpy_shape
+from videostream.metrics import StreamMetrics
+from videostream.monitor import FfmpegMonitor, LogRing, run_monitored, watchdog
+from videostream.reconnect import Backoff, ReconnectPolicy
+from videostream.shmbus import ShmFramePublisher
+from videostream.state import CONNECTING, FAILED, RECONNECTING, RUNNING, STOPPED, StreamState
+from videostream.tools import (FAST_PROBE_OPT, PROBE_CACHE_TTL, get_info, is_stream, release_process,
+                               get_out_numpy_shape, get_out_size)
+
+
+def make_filter_chain(size: Union[Sequence[int], None] = None, crop: Union[Sequence[int], None] = None,
+                      fps: Union[float, None] = None) -> str:
+    """
+    构造解码后先裁剪、再缩放、最后抽帧的滤镜链，在ffmpeg中完成，不用把原始大小的帧传给python
+    :param size: 缩放后的(宽, 高)，必须是已经算好的具体数值，见get_out_size
+    :param crop: 裁剪区域(x, y, 宽, 高)
+    :param fps: 输出帧率
+    :return: 逗号分隔的滤镜链，不需要处理时返回空字符串
+    """
+    filters = []
+    if crop is not None:
+        x, y, w, h = crop
+        filters.append(f"crop={w}:{h}:{x}:{y}")
+    if size is not None:
+        filters.append(f"scale={size[0]}:{size[1]}")
+    if fps is not None:
+        filters.append(f"fps={fps}")
+    return ",".join(filters)
+
+
+def make_filter_opt(size: Union[Sequence[int], None] = None, crop: Union[Sequence[int], None] = None,
+                    fps: Union[float, None] = None) -> str:
+    """单路输出的-vf参数，见make_filter_chain"""
+    chain = make_filter_chain(size, crop, fps)
+    return f"-vf {chain}" if chain else ""
+
+
+def _make_input_opt(url: str, accel: Type[Accelerator], realtime: bool, keyframes_only: bool, fast: bool) -> str:
+    accel_opt = accel.get_accel_opt()
+    rtsp_opt = f"-rtsp_transport tcp" if url.startswith("rtsp://") else ""
+    fast_opt = ""
+    if is_stream(url):
+        file_stream_opt = "-flags low_delay"
+        fast_opt = FAST_PROBE_OPT if fast else ""
+    else:
+        file_stream_opt = "-re" if realtime else ""
+    skip_opt = "-skip_frame nokey" if keyframes_only else ""
+    return f"{rtsp_opt} {accel_opt} {file_stream_opt} {fast_opt} {skip_opt} -i '{url}'"
+
+
+def make_pull_cmd(url: str, pix_fmt: str, accel: Type[Accelerator], realtime: bool = True,
+                  size: Union[Sequence[int], None] = None, crop: Union[Sequence[int], None] = None,
+                  fps: Union[float, None] = None, keyframes_only: bool = False, fast: bool = False) -> str:
+    """
+    构造拉流的ffmpeg命令，解码后的帧以rawvideo格式输出到stdout
+    :param realtime: 对于视频文件，是否按原始帧率读取(-re)，False时以最快速度解码
+    :param size, crop, fps: 见make_filter_chain
+    :param keyframes_only: 只解码关键帧(-skip_frame nokey)，非关键帧在解码器中直接跳过
+    :param fast: 对视频流使用低延迟的探测参数打开输入，见tools.FAST_PROBE_OPT
+    """
+    # rawvideo按恒定帧率输出，只解码关键帧时需要passthrough，否则ffmpeg会重复关键帧补齐帧率
+    sync_opt = "-fps_mode passthrough" if keyframes_only else ""
+
+    return (f"ffmpeg -loglevel warning "
+            f"{_make_input_opt(url, accel, realtime, keyframes_only, fast)} "
+            f"{make_filter_opt(size, crop, fps)} {sync_opt} "
+            f"-pix_fmt {pix_fmt} -f rawvideo "
+            f"pipe: ")
+
+
+def make_split_pull_cmd(url: str, accel: Type[Accelerator], outputs: Sequence[dict], realtime: bool = True,
+                        keyframes_only: bool = False, fast: bool = False) -> str:
+    """
+    构造一次解码、多路输出的拉流命令：split滤镜把解码后的帧分成多路，每路单独裁剪、缩放、抽帧，
+    以rawvideo格式写到各自的管道
+    :param outputs: 每一路输出的参数 {"fd": 写入的文件描述符(stdout为1), "pix_fmt", "size", "crop", "fps"}，
+                    size、crop、fps的含义见make_filter_chain
+    其他参数见make_pull_cmd
+    """
+    n = len(outputs)
+    graph = [f"[0:v]split={n}" + "".join(f"[s{i}]" for i in range(n))]
+    for i, out in enumerate(outputs):
+        chain = make_filter_chain(out.get("size"), out.get("crop"), out.get("fps")) or "null"
+        graph.append(f"[s{i}]{chain}[o{i}]")
+    sync_opt = "-fps_mode passthrough" if keyframes_only else ""
+    out_opts = " ".join(f"-map '[o{i}]' {sync_opt} -pix_fmt {out['pix_fmt']} -f rawvideo pipe:{out['fd']}"
+                        for i, out in enumerate(outputs))
+
+    return (f"ffmpeg -loglevel warning "
+            f"{_make_input_opt(url, accel, realtime, keyframes_only, fast)} "
+            f"-filter_complex '{';'.join(graph)}' "
+            f"{out_opts}")
 
 
 class Pull:
-    def __init__(self, url: str, pix_fmt: str = "rgb24", reconn: bool = False, accel: Type[Accelerator] = NoAccel):
+    MAIN = "main"  # 主输出的名字，即由pix_fmt、size、crop、fps指定的那一路
+
+    def __init__(self, url: str, pix_fmt: str = "rgb24", reconn: bool = False, accel: Type[Accelerator] = NoAccel,
+                 buffer_size: int = 5, shm_name: Union[str, None] = None, offline: bool = False,
+                 size: Union[Sequence[int], None] = None, crop: Union[Sequence[int], None] = None,
+                 fps: Union[float, None] = None, keyframes_only: bool = False,
+                 outputs: Union[dict, None] = None, buffer_policy: str = DROP_OLDEST, fast_start: bool = False,
+                 block: bool = True, stall_timeout: Union[float, None] = 10.,
+                 reconnect_policy: Union[ReconnectPolicy, None] = None):
         """
         :param url: 视频文件或视频流的地址
         :param pix_fmt: 输出帧的格式， "rgb24" 或 "bgr24"
         :param reconn: 对于视频流，断线后重连，对于视频文件，播放结束后再重头开始播放
         :param accel: 使用哪个加速器，默认不适用加速器(NoAccel)
+        :param buffer_size: 预分配的帧槽个数，缓存满时按buffer_policy处理
+        :param shm_name: 不为None时，同时把每一帧发布到以此命名的共享内存中，供其他进程用ShmFrameReader读取
+        :param offline: 离线模式，用于分析视频文件：不按原始帧率读取，以最快速度解码；
+                        缓冲区满时等待消费者而不丢帧，每一帧恰好交付一次；播放结束后get_frame返回None
+        :param size: 输出帧的(宽, 高)，在ffmpeg中缩放，其中一个为-1时保持宽高比，None表示不缩放
+        :param crop: 只输出画面中的(x, y, 宽, 高)区域，在缩放之前裁剪，None表示不裁剪
+        :param fps: 输出帧率，在ffmpeg中抽帧，None表示保持原始帧率
+        :param keyframes_only: 只解码和输出关键帧，适合低频抽帧的分析任务
+        :param outputs: 额外的输出，{名字: {"pix_fmt", "size", "crop", "fps"}}，省略的pix_fmt和主输出相同；
+                        和主输出共用一个连接、一次解码，用split滤镜分成多路写到各自的管道，
+                        每一路有自己的帧缓冲区，用get_frame(output=名字)读取；
+                        离线模式下每一路都要读取，否则缓冲区满后会阻塞其他输出
+        :param buffer_policy: 帧缓冲区满时的策略，见framering：
+                              "latest"-只保留最新帧，"drop_oldest"-丢弃最旧的帧，"drop_newest"-丢弃新帧，
+                              "block"-等待消费者不丢帧；离线模式总是"block"
+        :param fast_start: 探测和拉流都使用低延迟参数(较小的probesize、analyzeduration，-fflags nobuffer)，
+                           缩短打开和重连视频流的时间，见tools.FAST_PROBE_OPT
+        :param block: True-探测并等待拉流打开(最多9秒)后返回；
+                      False-立即返回，探测和启动ffmpeg都在拉流线程中进行，同时打开多路流时互不等待，
+                      用wait_opened等待打开，打开之前get_frame返回None
+        :param stall_timeout: 拉流中超过这么多秒没有收到新帧(摄像头卡住但没有断开连接)时结束ffmpeg进程，
+                              reconn为True时重连，否则拉流失败；按fps抽帧时至少取3个帧间隔，
+                              只解码关键帧时应大于关键帧间隔；None表示不检查；"block"策略下不检查，
+                              因为消费者慢时拉流线程本来就会等待
+        :param reconnect_policy: 断线重连的等待时间、熔断和是否复用探测结果，见reconnect.ReconnectPolicy，
+                                 None时使用默认策略；视频文件播放完重新播放时不等待
         """
         assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        assert fps is None or fps > 0, "帧率必须大于0"
+        assert stall_timeout is None or stall_timeout > 0, "卡顿超时必须大于0"
         self._url = url
-        self._pix_fmt = pix_fmt
         self._accel = accel
         self._reconn = reconn  # 多线程共享的变量，尽量只做原子操作，不能保证原子操作时就加把锁
-        self._is_pulling = False  # 反馈给外部的ffmpeg拉流进程的运行状态，多线程共享的变量
+        self._state = StreamState(CONNECTING)  # 拉流状态，由拉流线程切换，见state
+        self._metrics = StreamMetrics(self._state)  # 性能计数，见stats
+        # 重连后被替换掉的帧缓冲区已提交和丢弃的帧数，每一路输出为[committed, dropped]，使计数不因替换而归零
+        self._retired_counts: dict[str, list[int]] = dict()
         self._stop = False  # 由外部传给线程的停止信号，多线程共享的变量
-        self._q = Queue(maxsize=5)
+        self._buffer_size = buffer_size
+        self._offline = offline
+        self._buffer_policy = BLOCK if offline else buffer_policy
+        self._keyframes_only = keyframes_only
+        self._fast_start = fast_start
+        if stall_timeout is not None and fps is not None:
+            stall_timeout = max(stall_timeout, 3 / fps)
+        self._stall_timeout = stall_timeout if self._buffer_policy != BLOCK else None
+        self._stalls = 0  # 因为卡住而结束ffmpeg进程的次数
+        self._stalled_proc: Union[subprocess.Popen, None] = None  # 已经因为卡住而结束的进程，避免重复处理
+        self._stalled_at = 0.
+        self._log = LogRing()  # ffmpeg最近的警告和错误，见ffmpeg_log
+        self._monitor: Union[FfmpegMonitor, None] = None  # 当前ffmpeg进程的日志和进度
+        self._backoff = Backoff(reconnect_policy, url)  # 重连的等待时间，只在拉流线程中更新
+        # 各路输出的参数，第一路是主输出
+        self._outputs = {self.MAIN: {"pix_fmt": pix_fmt, "size": size, "crop": crop, "fps": fps}}
+        for name, spec in (outputs or {}).items():
+            assert name not in self._outputs, f"输出的名字{name}重复"
+            spec = {"pix_fmt": pix_fmt, "size": None, "crop": None, "fps": None, **spec}
+            assert spec["pix_fmt"] in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+            assert spec["fps"] is None or spec["fps"] > 0, "帧率必须大于0"
+            self._outputs[name] = spec
+        self._rings: dict[str, FrameRing] = dict()  # 每一路输出预分配的帧缓冲区，拉流线程写入，外部读取
+        self._shm_name = shm_name
+        self._bus: Union[ShmFramePublisher, None] = None  # 共享内存帧发布者，只发布主输出
         self._prod_thread = Thread(target=self._run)
         self._ffmpeg_cmd: Union[str, None] = None
-
-        try:
-            self.stream_info = get_info(self._url)
-            if self.stream_info is None or len(self.stream_info) == 0:
-                logger.error("无法获取视频流信息")
-                return
-        except ValueError as e:
-            logger.error(e)
-            return
+        self._ffmpeg_proc: Union[subprocess.Popen, None] = None  # 当前的拉流进程，stop时直接结束它
+        self.stream_info: list[dict] = []
 
         # 检查加速器是否可用
         if not self._accel.check_ffmpeg():
-            logger.warning("未安装ffmpeg或当前ffmpeg不支持nvidia GPU加速")
+            logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{self._accel.__name__}加速")
             self._accel = NoAccel
         elif self._accel.get_num() <= 0:
-            logger.warning("没有可用的nvidia显卡或没有正确安装nvidia驱动")
+            logger.warning(f"没有可用的{self._accel.__name__}设备或没有正确安装驱动")
             self._accel = NoAccel
 
-        self._make_ffmpeg_cmd()
+        if block:
+            try:
+                self.stream_info = get_info(self._url, fast=self._fast_start)
+                if self.stream_info is None or len(self.stream_info) == 0:
+                    logger.error("无法获取视频流信息")
+                    self._state.set(FAILED)
+                    return
+            except ValueError as e:
+                logger.error(e)
+                self._state.set(FAILED)
+                return
+            self._make_ffmpeg_cmd()
 
-        # 开启读帧线程，等待线程中打开拉流进程
+        # 开启读帧线程，在线程中分配帧缓冲区、打开拉流进程；拉流线程直接使用上面的探测结果
         self._prod_thread.start()
-        wait_cnt = 0
-        while not self._is_pulling and wait_cnt < 300:
-            time.sleep(0.03)
-            wait_cnt += 1
-
-        if wait_cnt >= 298:
+        if block and not self.wait_opened(9):
+            self._state.set(FAILED)
             self.release()
             logger.error("无法打开视频流")
 
-    def _make_ffmpeg_cmd(self):
-        """构造ffmpeg命令"""
-        accel_opt = self._accel.get_accel_opt()
-        rtsp_opt = f"-rtsp_transport tcp" if self._url.startswith("rtsp://") else ""
-        file_stream_opt = f"-re" if not is_stream(self._url) else "-flags low_delay"
+    @property
+    def _ring(self) -> Union[FrameRing, None]:
+        """主输出的帧缓冲区"""
+        return self._rings.get(self.MAIN)
+
+    def _make_ffmpeg_cmd(self, fds: Sequence[int] = (), pin_size: bool = False):
+        """
+        构造ffmpeg命令
+        :param fds: 额外输出写入的文件描述符，和outputs的顺序相同
+        :param pin_size: 没有指定size的输出也缩放到由stream_info算出的大小，
+                         重连时没有重新探测，分辨率即使变了，帧的大小也和帧缓冲区一致
+        """
+        outputs = []
+        for (name, spec), fd in zip(self._outputs.items(), (1,) + tuple(fds)):
+            size = self.get_out_size(name) if spec["size"] is not None or pin_size else None
+            outputs.append({**spec, "size": size, "fd": fd})
+        if len(self._outputs) == 1:
+            main = outputs[0]
+            self._ffmpeg_cmd = make_pull_cmd(self._url, main["pix_fmt"], self._accel, realtime=not self._offline,
+                                             size=main["size"], crop=main["crop"], fps=main["fps"],
+                                             keyframes_only=self._keyframes_only, fast=self._fast_start)
+        else:
+            self._ffmpeg_cmd = make_split_pull_cmd(self._url, self._accel, outputs, realtime=not self._offline,
+                                                   keyframes_only=self._keyframes_only, fast=self._fast_start)
+
+    @property
+    def outputs(self) -> list[str]:
+        """所有输出的名字，第一个是主输出"""
+        return list(self._outputs)
+
+    @property
+    def out_size(self) -> tuple:
+        """主输出帧的(宽, 高)，即裁剪、缩放之后的大小"""
+        return self.get_out_size()
+
+    def get_out_size(self, output: Union[str, None] = None) -> tuple:
+        """某一路输出帧的(宽, 高)"""
+        spec = self._outputs[output or self.MAIN]
+        return get_out_size((self.stream_info[0]["width"], self.stream_info[0]["height"]), spec["size"], spec["crop"])
 
-        self._ffmpeg_cmd = (f"ffmpeg -loglevel warning "
-                            f"{rtsp_opt} {accel_opt} {file_stream_opt} "
-                            f"-i '{self._url}' "
-                            f"-pix_fmt {self._pix_fmt} -f rawvideo "
-                            f"pipe: ")
+    def _out_np_shape(self, output: Union[str, None] = None) -> tuple:
+        return get_out_numpy_shape(self.get_out_size(output), self._outputs[output or self.MAIN]["pix_fmt"])
+
+    def _launch(self, pin_size: bool = False) -> tuple:
+        """
+        启动ffmpeg进程，主输出写到stdout，额外的输出各用一个管道，由各自的读线程读入帧缓冲区；
+        ffmpeg的日志和进度由FfmpegMonitor读取
+        :param pin_size: 见_make_ffmpeg_cmd
+        """
+        pipes = [os.pipe() for _ in range(len(self._outputs) - 1)]
+        try:
+            self._make_ffmpeg_cmd([w for _, w in pipes], pin_size)
+            ffmpeg_proc, self._monitor = run_monitored(self._ffmpeg_cmd, self._log, pass_fds=[w for _, w in pipes])
+        except Exception:
+            for r, _ in pipes:
+                os.close(r)
+            raise
+        finally:
+            for _, w in pipes:
+                os.close(w)
+
+        readers = []
+        for name, (r, _) in zip(list(self._outputs)[1:], pipes):
+            reader = Thread(target=self._read_output, args=(self._rings[name], os.fdopen(r, "rb")), daemon=True)
+            reader.start()
+            readers.append(reader)
+        return ffmpeg_proc, readers
+
+    def _read_output(self, ring: FrameRing, pipe):
+        """额外输出的读线程，读到管道结束(ffmpeg退出)为止"""
+        try:
+            while not self._stop and ring.put_from(pipe):
+                pass
+        finally:
+            pipe.close()
 
     def _run(self):
         # 运行在子线程中
         ffmpeg_proc: Union[subprocess.Popen, None] = None
-        out_np_shape = (0, 0, 0)
-        while True:
+        readers: list[Thread] = []
+        # 第一次连接直接用__init__中的探测结果，重连时重新探测，分辨率可能已经改变；
+        # 上一次连接收到过帧、只是断线时，按重连策略直接使用上一次的探测结果，重连更快
+        max_age = PROBE_CACHE_TTL
+        reuse_info = False
+        launched = False
+        if self._stall_timeout is not None:
+            watchdog.add(self._check_stall)
+        while not self._stop:
             # 检查流，开启拉流的ffmpeg进程
+            launched = False
             try:
-                self.stream_info = get_info(self._url)
+                if not reuse_info:
+                    self.stream_info = get_info(self._url, fast=self._fast_start, max_age=max_age)
+                max_age = 0
                 if len(self.stream_info) == 0:
-                    self._is_pulling = False
                     logger.error("文件或流中没有视频流")
                 else:
-                    out_np_shape = get_out_numpy_shape(
-                        (self.stream_info[0]["width"], self.stream_info[0]["height"]),
-                        self._pix_fmt)
+                    for name in self._outputs:
+                        out_np_shape = self._out_np_shape(name)
+                        old_ring = self._rings.get(name)
+                        if old_ring is not None and out_np_shape == old_ring.shape:
+                            continue
+                        # 第一次连接，或者重连后分辨率变了，(重新)分配帧缓冲区
+                        self._rings[name] = FrameRing(out_np_shape, self._buffer_size, policy=self._buffer_policy)
+                        if old_ring is not None:
+                            old_ring.close()
+                            counts = self._retired_counts.setdefault(name, [0, 0])
+                            counts[0] += old_ring.seq
+                            counts[1] += old_ring.dropped
+                        if name == self.MAIN and self._shm_name is not None:
+                            if self._bus is not None:
+                                # 读者看到旧的共享内存关闭后需要重新附加
+                                self._bus.close()
+                            self._bus = ShmFramePublisher(self._shm_name, out_np_shape)
                     if ffmpeg_proc is not None:
                         release_process(ffmpeg_proc)
-                    ffmpeg_proc = run_async(self._ffmpeg_cmd)
-                    self._is_pulling = True
+                    ffmpeg_proc, new_readers = self._launch(pin_size=reuse_info)
+                    self._ffmpeg_proc = ffmpeg_proc
+                    readers = [r for r in readers if r.is_alive()] + new_readers
+                    launched = True
+                    self._state.set(RUNNING)
             except ValueError as e:
                 logger.error(e)
-                self._is_pulling = False
             except Exception as e:
                 logger.exception("", e)
-                self._is_pulling = False
 
             # 从ffmpeg进程读帧放入队列中
-            while not self._stop:  # 此信号是外部传进来的停止信号
-                in_bytes = ffmpeg_proc.stdout.read(np.prod(out_np_shape))
-                # 读数据错误，结束整个拉流程序
-                if not in_bytes:
-                    self._is_pulling = False  # 告诉外界ffmpeg拉流进程死了
+            frames_before = self._metrics.frames_in
+            while launched and not self._stop:  # 此信号是外部传进来的停止信号
+                # 直接读入预分配的帧槽，缓存满时丢弃最旧的帧
+                t = time.perf_counter()
+                if not self._ring.put_from(ffmpeg_proc.stdout):
+                    # 读数据错误，ffmpeg拉流进程已经退出
                     break
-
-                img = np.frombuffer(in_bytes, np.uint8).reshape(out_np_shape)
-                if self._q.full():
-                    self._q.get()  # 丢弃多余的帧
-                self._q.put(img)
+                self._metrics.frame_in(self._ring.frame_nbytes, time.perf_counter() - t)
+                if self._metrics.frames_in == frames_before + 1:
+                    # 收到第一帧才算连接成功，接受连接却不出帧的摄像头被看门狗结束后仍然按连续失败计算等待时间
+                    self._backoff.connected()
+                if self._bus is not None:
+                    # 直接发布刚读入的帧，被本地缓冲策略丢弃的帧对共享内存的读者仍然是新帧
+                    self._bus.publish(self._ring.last_put)
 
             if not self._reconn:
                 break
+            if launched and not self._stop:
+                self._state.set(RECONNECTING)
+            productive = launched and self._metrics.frames_in > frames_before
+            reuse_info = productive and self._backoff.policy.reuse_info
+            if productive and not is_stream(self._url):
+                # 视频文件播放完，立即从头播放
+                continue
+            # 打开失败或者断线，按重连策略等待，避免摄像头不可用时不停地重启ffmpeg
+            delay = self._backoff.next_delay()
+            logger.info(f"{self._url} {delay:.2f}秒后重连")
+            self._backoff.wait(delay, lambda: self._stop)
+
+        if self._stall_timeout is not None:
+            watchdog.remove(self._check_stall)
+        if ffmpeg_proc is not None:
+            release_process(ffmpeg_proc)
+        if self._ring is not None:
+            self._ring.close()
+        # 主输出结束时ffmpeg已经退出，等额外输出读完管道中剩下的帧
+        for reader in readers:
+            reader.join()
+        for ring in self._rings.values():
+            ring.close()
+        if self._bus is not None:
+            self._bus.close()
+        # 主动停止或者视频文件播放完是正常结束，视频流断线不再重连、打开失败是失败
+        if self._stop or (launched and not is_stream(self._url)):
+            self._state.set(STOPPED)
+        else:
+            self._state.set(FAILED)
+
+    def _check_stall(self):
+        """在看门狗线程中定时调用：拉流中超过stall_timeout秒没有新帧时结束ffmpeg进程，读帧返回后由拉流线程重连"""
+        proc = self._ffmpeg_proc
+        if self._stop or proc is None:
+            return
+        now = time.monotonic()
+        if proc is self._stalled_proc:
+            # terminate之后ffmpeg仍然没有退出(比如卡在网络读写中)，强制杀死，否则读帧会一直阻塞
+            if proc.poll() is None and now - self._stalled_at > 5:
+                proc.kill()
+            return
+        # 刚启动还没有收到帧时从进入RUNNING开始计时
+        if self._state.state == RUNNING and now - max(self._metrics.last_in, self._state.since) > self._stall_timeout:
+            logger.warning(f"{self._url} 超过{self._stall_timeout}秒没有收到新帧，结束ffmpeg进程")
+            self._stalled_proc, self._stalled_at = proc, now
+            self._stalls += 1
+            proc.terminate()
+
+    def get_frame(self, block: bool = True, timeout: Union[float, None] = None,
+                  copy: bool = False, output: Union[str, None] = None) -> Union[np.ndarray, None]:
+        """
+        读到None表示拉流已经关闭，或者出现错误
+        :param block: 没有帧时是否阻塞等待
+        :param timeout: 阻塞等待的超时时间，超时抛出queue.Empty
+        :param copy: False-返回帧缓冲区的视图，在调用release_frame或下一次get_frame之前有效；
+                     True-返回一份拷贝，适合需要长时间保留帧的调用方
+        :param output: 从哪一路输出读取，None表示主输出
+        """
+        ring = self._rings.get(output or self.MAIN)
+        if ring is None:
+            return None
+        ring.release()  # 上一次取出的帧视图在这里失效
+        frame = ring.get(block, timeout)
+        if frame is not None and ring is self._ring:
+            self._metrics.frame_out(frame.nbytes)
+        if copy and frame is not None:
+            view, frame = frame, frame.copy()
+            ring.release(view)
+        return frame
+
+    def __iter__(self):
+        """逐帧迭代主输出，直到拉流结束(get_frame返回None)，适合离线模式"""
+        while True:
+            frame = self.get_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def release_frame(self, frame: Union[np.ndarray, None] = None, output: Union[str, None] = None):
+        """归还get_frame返回的帧视图，之后该视图的数据可能被新帧覆盖"""
+        ring = self._rings.get(output or self.MAIN)
+        if ring is not None:
+            ring.release(frame)
 
-        release_process(ffmpeg_proc)
+    @property
+    def frame_ring(self) -> Union[FrameRing, None]:
+        """主输出当前使用的帧缓冲区，重连后分辨率变化时会被替换"""
+        return self._ring
 
-    def get_frame(self, block: bool = True, timeout: Union[float, None] = None) -> np.ndarray:
-        """读到None表示拉流已经关闭，或者出现错误"""
-        return self._q.get(block, timeout)
+    def get_frame_ring(self, output: Union[str, None] = None) -> Union[FrameRing, None]:
+        """某一路输出当前使用的帧缓冲区"""
+        return self._rings.get(output or self.MAIN)
+
+    def buffer_stats(self) -> dict:
+        """每一路输出的帧缓冲区的策略、已提交和丢弃的帧数、排队的帧数，用于调整延迟"""
+        stats = dict()
+        for name, ring in list(self._rings.items()):
+            committed, dropped = self._retired_counts.get(name, (0, 0))
+            ring_stats = ring.stats()
+            ring_stats["committed"] += committed
+            ring_stats["dropped"] += dropped
+            stats[name] = ring_stats
+        return stats
+
+    def stats(self) -> dict:
+        """
+        拉流的性能指标快照，只读取计数器，可以频繁调用；用metrics.MetricsExporter以Prometheus格式导出
+        :return: {"kind": "pull", "state", "age": 创建以来的秒数, "uptime": 本次连续拉流的秒数, "reconnects",
+                  "frames_in"/"bytes_in": ffmpeg输出的主输出帧数/字节数, "fps_in": 最近1秒的输出帧率,
+                  "frames_out"/"bytes_out": get_frame取走的帧数/字节数, "fps_out",
+                  "dropped": 按缓冲策略丢弃的帧数, "queued": 排队等待读取的帧数,
+                  "stalls": 因为卡住而重启的次数, "reconnect_failures"/"reconnect_delay"/"reconnect_wait"/"circuit_open":
+                  重连的状态，见reconnect.Backoff.stats, "read_latency": 从管道读一帧阻塞时间的直方图,
+                  "buffers": 每一路输出的buffer_stats, "ffmpeg": 当前ffmpeg进程报告的进度，见monitor.parse_progress}
+        """
+        ring = self._ring
+        monitor = self._monitor
+        return {
+            "kind": "pull",
+            **self._metrics.snapshot(),
+            "dropped": (self._retired_counts.get(self.MAIN, (0, 0))[1]
+                        + (ring.dropped if ring is not None else 0)),
+            "queued": ring.qsize() if ring is not None else 0,
+            "stalls": self._stalls,
+            **self._backoff.stats(),
+            "read_latency": self._metrics.read_latency.snapshot(),
+            "buffers": self.buffer_stats(),
+            "ffmpeg": dict(monitor.progress) if monitor is not None else {},
+        }
+
+    def ffmpeg_log(self, n: Union[int, None] = None) -> list[tuple]:
+        """ffmpeg最近输出的n条警告和错误[(时间戳, 日志行), ...]，包括之前断线的进程，用于诊断"""
+        return self._log.lines(n)
 
     def is_opened(self) -> bool:
         """判断拉流是否打开，如果reconn设为True，那么再重连的过程中，拉流状态会是关闭的"""
-        return self._is_pulling
+        return self._state.state == RUNNING
+
+    @property
+    def state(self) -> str:
+        """拉流状态：connecting、running、reconnecting、stopped或failed，见state"""
+        return self._state.state
+
+    def wait_state(self, states: Union[str, Sequence[str]], timeout: Union[float, None] = None) -> bool:
+        """阻塞等待进入states中的任意一个状态，超时或者拉流已经结束(进入了其他最终状态)时返回False"""
+        return self._state.wait_for(states, timeout)
+
+    def on_state_change(self, callback: Callable[[str, str], None]) -> Callable[[str, str], None]:
+        """注册状态切换的回调callback(旧状态, 新状态)，在拉流线程中调用，应尽快返回；可以作为装饰器使用"""
+        return self._state.on_change(callback)
 
-    def has_frame(self) -> bool:
-        return not self._q.empty()
+    def wait_opened(self, timeout: Union[float, None] = None) -> bool:
+        """等待拉流打开，用于block=False时；返回是否已经打开，超时或者打开失败时返回False"""
+        return self._state.wait_for(RUNNING, timeout)
+
+    def wait_frame(self, timeout: Union[float, None] = None, output: Union[str, None] = None) -> bool:
+        """
+        阻塞等待直到有帧可以读取，新帧到达时立即唤醒，不需要循环调用has_frame
+        重连期间继续等待
+        :return: True-有帧，get_frame不会阻塞；False-超时或者拉流已经结束
+        """
+        name = output or self.MAIN
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0., deadline - time.monotonic())
+            ring = self._rings.get(name)
+            if ring is None:
+                # 还没有打开，帧缓冲区在拉流线程中分配
+                if not self._state.wait_for(RUNNING, remaining):
+                    return False
+                continue
+            if ring.wait_frame(remaining):
+                return True
+            if ring is self._rings.get(name) or (deadline is not None and time.monotonic() >= deadline):
+                # 超时，或者缓冲区已经关闭、拉流结束；缓冲区被替换(重连后分辨率变了)时继续等新的缓冲区
+                return False
+
+    def has_frame(self, output: Union[str, None] = None) -> bool:
+        ring = self._rings.get(output or self.MAIN)
+        return ring is not None and ring.has_frame()
+
+    def stop(self):
+        """发出停止信号并结束ffmpeg进程，不等待拉流线程退出；同时关闭多路流时先对每一路调用stop，见release_all"""
+        self._reconn = False
+        self._stop = True
+        proc = self._ffmpeg_proc
+        if proc is not None:
+            proc.terminate()  # 流卡住时读帧会一直阻塞，直接结束进程让读帧返回
+        for ring in list(self._rings.values()):
+            ring.close()  # 唤醒离线模式下等待消费者的拉流线程和读线程
 
     def release(self):
-        """设置_is_open为false, 拉流线程重会关闭ffmpeg进程"""
+        """停止拉流，等待拉流线程关闭ffmpeg进程后返回"""
         while self._prod_thread.is_alive():
-            self._reconn = False
-            self._stop = True
-            time.sleep(0.03)
+            self.stop()
+            self._prod_thread.join(0.03)
 
 
 if __name__ == '__main__':
+    from videostream.batch import FrameBatch
+
     url1 = "D:/Program Files/tests/media/output1.mp4"
     url3 = "Integrated Camera"
 
     pulls = [Pull(url1, pix_fmt="bgr24", accel=NoAccel) for _ in range(2)]
+    batch = FrameBatch(pulls)
 
     while True:
-        frames = [pull.get_frame(block=True) for pull in pulls]
-        zip_frames = [cv2.resize(frame, (1080 // len(frames), 840)) for frame in frames if frame is not None]
-        cv2.imshow("frame", np.concatenate(zip_frames, axis=1))
+        frames = batch.fetch(wait_all=True, timeout=1)
+        cv2.imshow("frame", cv2.hconcat(list(frames)))
         # cv2.imshow("frame", frames[0])
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
@@ -1,94 +1,363 @@
+import re
+import shlex
 import subprocess
 import time
+from subprocess import TimeoutExpired
 from threading import Thread
-from typing import Type, Union
+from typing import Callable, Sequence, Type, Union
 
 from videostream.accelerator import Accelerator, NoAccel, NvidiaAccel
 from videostream.logger import logger
-from videostream.tools import run_async, release_process, is_stream
+from videostream.metrics import StreamMetrics
+from videostream.monitor import FfmpegMonitor, LogRing, progress_supported, run_monitored, watchdog
+from videostream.reconnect import Backoff, ReconnectPolicy
+from videostream.state import CONNECTING, FAILED, RECONNECTING, RUNNING, STOPPED, StreamState
+from videostream.tools import release_process, is_stream, get_info
+
+# FLV(RTMP)中的H.264可以直接转封装的profile，10bit和4:2:2、4:4:4的profile大多数服务器和播放器不支持
+FLV_COPY_PROFILES = ("Baseline", "Constrained Baseline", "Main", "High")
+FLV_COPY_PIX_FMTS = ("yuv420p", "yuvj420p")
+FLV_H264_TAG = 7  # FLV中H.264的编码ID，tee复用器不会像flv那样自动替换mp4等容器的codec tag
+
+# tee复用器中某一路输出失败时的日志，序号是这一路在tee输出列表中的位置
+_SLAVE_FAILED = re.compile(r"Slave muxer #(\d+) failed: (.*?)(, continuing with|$)")
+
+
+def can_stream_copy(info: dict) -> bool:
+    """
+    判断视频流能否不重新编码、直接转封装(-c copy)推送到FLV/RTMP
+    :param info: get_info返回的一路视频流的信息
+    """
+    return (info.get("codec_name") == "h264"
+            and info.get("profile") in FLV_COPY_PROFILES
+            and info.get("pix_fmt", "yuv420p") in FLV_COPY_PIX_FMTS)
+
+
+def _with_stream_spec(param: str, spec: str) -> str:
+    """给参数中的每个选项加上流说明符，如 -preset ultrafast -> -preset:v:1 ultrafast"""
+    return " ".join(f"{t}:{spec}" if t.startswith("-") else t for t in shlex.split(param))
 
 
 class PullPush:
-    def __init__(self, pull_url: str, push_url: str, reconn: bool = False, accel: Type[Accelerator] = NoAccel):
+    MODE_COPY = "copy"
+    MODE_TRANSCODE = "transcode"
+
+    def __init__(self, pull_url: str, push_url: Union[str, Sequence[Union[str, dict]]], reconn: bool = False,
+                 accel: Type[Accelerator] = NoAccel, copy: Union[bool, None] = None, block: bool = True,
+                 stall_timeout: Union[float, None] = 10., reconnect_policy: Union[ReconnectPolicy, None] = None):
         """
         :param pull_url: 拉取视频的地址
-        :param push_url: 推送视频的地址
+        :param push_url: 推送视频的地址；
+                         也可以是多个输出的列表，每个输出是地址或{"url", "size", "bitrate", "encoder"}，
+                         size为(宽, 高)，其中一个为-1时保持宽高比，bitrate如"2M"，encoder如"libx264"，省略的参数表示和源视频相同；
+                         所有输出在一个ffmpeg进程中完成，只拉流、解码一次，参数相同的输出共用一次编码，
+                         某一路推流失败不影响其他输出，见output_health
         :param reconn: 断线重连
         :param accel: 使用的加速器，默认不使用加速器(NoAccel)
+        :param copy: None-自动选择，源视频是FLV支持的H.264时直接转封装，否则重新编码；
+                     True-总是转封装；False-总是重新编码；对多个输出时只影响没有指定参数的输出
+        :param block: True-探测源视频并等待转推开始(最多9秒)后返回；
+                      False-立即返回，探测和启动ffmpeg都在工作线程中进行，用wait_opened等待
+        :param stall_timeout: 转推中超过这么多秒ffmpeg报告的输出进度没有增加(源卡住但没有断开连接)时结束ffmpeg进程，
+                              reconn为True时重连，否则转推失败；None表示不检查；需要-progress管道，只支持类Unix系统
+        :param reconnect_policy: 断线重连的等待时间、熔断和是否复用探测结果，见reconnect.ReconnectPolicy，
+                                 None时使用默认策略
         """
+        assert stall_timeout is None or stall_timeout > 0, "卡顿超时必须大于0"
         self._pull_url = pull_url
         self._push_url = push_url
         self._reconn = reconn
         self._accel = accel
+        self._copy = copy
+        self.mode: Union[str, None] = None  # 实际使用的方式，MODE_COPY 或 MODE_TRANSCODE
+        self._outputs: Union[list[dict], None] = None  # 多个输出时每个输出的参数和状态
+        self._renditions: list[tuple] = []  # 不同的(size, bitrate, encoder)组合，每种编码一次
+        if not isinstance(push_url, str):
+            self._parse_outputs(push_url)
         self._stop = False  # 外部输入的停止信号
-        self._working = False  # ffmpeg 进程是否在运行
+        self._state = StreamState(CONNECTING)  # 转推状态，由工作线程切换，见state
+        self._metrics = StreamMetrics(self._state)  # 运行时间和重连次数，见stats
         self._work_thread = Thread(target=self._run)
         self._ffmpeg_cmd: Union[str, None] = None
+        self._ffmpeg_proc: Union[subprocess.Popen, None] = None  # 当前的转推进程，stop时直接结束它
+        self._stall_timeout = stall_timeout if progress_supported() else None
+        self._stalls = 0  # 因为卡住而结束ffmpeg进程的次数
+        self._stalled_proc: Union[subprocess.Popen, None] = None  # 已经因为卡住而结束的进程，避免重复处理
+        self._stalled_at = 0.
+        self._log = LogRing()  # ffmpeg最近的警告和错误，见ffmpeg_log
+        self._monitor: Union[FfmpegMonitor, None] = None  # 当前ffmpeg进程的日志和进度
+        self._backoff = Backoff(reconnect_policy, pull_url)  # 重连的等待时间，只在工作线程中更新
 
         # 检查加速器是否可用
         if not self._accel.check_ffmpeg():
-            logger.warning("未安装ffmpeg或当前ffmpeg不支持nvidia GPU加速")
+            logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{self._accel.__name__}加速")
             self._accel = NoAccel
         elif self._accel.get_num() <= 0:
-            logger.warning("没有可用的nvidia显卡或没有正确安装nvidia驱动")
+            logger.warning(f"没有可用的{self._accel.__name__}设备或没有正确安装驱动")
             self._accel = NoAccel
 
-        self._make_ffmpeg_cmd()
+        if block:
+            self._make_ffmpeg_cmd()
         self._work_thread.start()
-        wait_cnt = 0
-        while not self._working and wait_cnt < 300:
-            time.sleep(0.03)
-            wait_cnt += 1
+        if block:
+            self.wait_opened(9)
+
+    def _choose_mode(self) -> str:
+        """根据源视频的编码选择转封装还是重新编码"""
+        if self._copy is not None:
+            return self.MODE_COPY if self._copy else self.MODE_TRANSCODE
+        try:
+            stream_info = get_info(self._pull_url)
+        except ValueError as e:
+            logger.error(e)
+            return self.MODE_TRANSCODE
+        if len(stream_info) > 0 and can_stream_copy(stream_info[0]):
+            return self.MODE_COPY
+        return self.MODE_TRANSCODE
+
+    def _parse_outputs(self, outputs: Sequence[Union[str, dict]]):
+        assert len(outputs) > 0, "至少需要一个输出"
+        self._outputs = []
+        for out in outputs:
+            out = {"url": out} if isinstance(out, str) else dict(out)
+            size = tuple(out["size"]) if out.get("size") is not None else None
+            assert size is None or (len(size) == 2 and size != (-1, -1)), "输出尺寸不合法"
+            key = (size, out.get("bitrate"), out.get("encoder"))
+            if key not in self._renditions:
+                self._renditions.append(key)
+            self._outputs.append({"url": out["url"], "rendition": self._renditions.index(key),
+                                  "alive": False, "error": None})
 
     def _make_ffmpeg_cmd(self):
-        accel_opt = self._accel.get_accel_opt()
+        mode = self._choose_mode()
+        if mode != self.mode:
+            logger.info(f"{self._pull_url} -> {self._push_url} 使用{'转封装' if mode == self.MODE_COPY else '重新编码'}")
+        self.mode = mode
+        if self._outputs is not None:
+            self._ffmpeg_cmd = self._make_fanout_cmd()
+            return
+
         rtsp_opt = "-rtsp_transport tcp -flags low_delay" if self._pull_url.startswith("rtsp://") else ""
         file_stream_opt = f"-re" if not is_stream(self._pull_url) else "-flags low_delay"
-        encoder = self._accel.get_encoder("h264")
-        encoder_param = self._accel.get_encoder_param()
+        if mode == self.MODE_COPY:
+            # 不解码也不编码，不需要加速器
+            accel_opt, video_opt = "", "-c:v copy"
+        else:
+            accel_opt = self._accel.get_accel_opt()
+            encoder = self._accel.get_encoder("h264")
+            encoder_param = self._accel.get_encoder_param()
+            video_opt = f"-c:v {encoder} {encoder_param} -pix_fmt yuv420p"
 
         self._ffmpeg_cmd = ("ffmpeg "
                             "-loglevel warning "
                             f"{accel_opt} {rtsp_opt} {file_stream_opt} "
                             f"-i {self._pull_url} "
-                            f"-c:v {encoder} {encoder_param} "
-                            "-pix_fmt yuv420p -f flv "
+                            f"{video_opt} -f flv "
                             f"{self._push_url}")
 
+    def _make_fanout_cmd(self) -> str:
+        """
+        多个输出：需要编码的每种参数从split滤镜得到一路并编码一次，不需要编码的直接复制源视频流，
+        用tee复用器按select把各路编码结果分发给对应的推流地址，onfail=ignore使失败的输出不影响其他输出
+        源有音频时第一路音频只编码一次AAC(FLV都支持)，每个输出都带上这路音频
+        """
+        maps, codec_opts, chains = [], [], []
+        for i, (size, bitrate, encoder) in enumerate(self._renditions):
+            if size is None and bitrate is None and encoder is None and self.mode == self.MODE_COPY:
+                maps.append("-map 0:v:0")
+                codec_opts.append(f"-c:v:{i} copy -tag:v:{i} {FLV_H264_TAG}")
+                continue
+            # scale的-2表示按比例计算并取偶数
+            chains.append((i, f"scale={size[0] if size[0] != -1 else -2}:{size[1] if size[1] != -1 else -2}"
+                           if size is not None else "null"))
+            maps.append(f"-map '[r{i}]'")
+            if encoder is None:
+                encoder = self._accel.get_encoder("h264")
+                encoder_param = _with_stream_spec(self._accel.get_encoder_param(), f"v:{i}")
+            else:
+                encoder_param = ""
+            bitrate_opt = f"-b:v:{i} {bitrate}" if bitrate is not None else ""
+            codec_opts.append(f"-c:v:{i} {encoder} {encoder_param} {bitrate_opt} -pix_fmt:v:{i} yuv420p")
+
+        filter_opt, accel_opt = "", ""
+        if chains:
+            # 需要解码时才使用加速器
+            accel_opt = self._accel.get_accel_opt()
+            graph = [f"[0:v]split={len(chains)}" + "".join(f"[s{i}]" for i, _ in chains)]
+            graph += [f"[s{i}]{chain}[r{i}]" for i, chain in chains]
+            filter_opt = f"-filter_complex '{';'.join(graph)}'"
+        # 0:a:0?在源没有音频时忽略，select中的a也就选不到流
+        maps.append("-map '0:a:0?'")
+        codec_opts.append("-c:a aac")
+        slaves = "|".join(f"[select=\\'v:{out['rendition']},a\\':f=flv:onfail=ignore]{out['url']}"
+                          for out in self._outputs)
+
+        rtsp_opt = "-rtsp_transport tcp -flags low_delay" if self._pull_url.startswith("rtsp://") else ""
+        file_stream_opt = f"-re" if not is_stream(self._pull_url) else "-flags low_delay"
+        return ("ffmpeg "
+                "-loglevel warning "
+                f"{accel_opt} {rtsp_opt} {file_stream_opt} "
+                f"-i {self._pull_url} "
+                f"{filter_opt} {' '.join(maps)} {' '.join(codec_opts)} "
+                f'-f tee "{slaves}"')
+
+    def _watch_line(self, line: str):
+        """ffmpeg的每一行日志，从tee复用器的日志中得到每个输出的状态"""
+        match = _SLAVE_FAILED.search(line)
+        if match is None:
+            return
+        i = int(match.group(1))
+        if i < len(self._outputs):
+            self._outputs[i]["alive"] = False
+            self._outputs[i]["error"] = match.group(2)
+            logger.warning(f"推流到{self._outputs[i]['url']}失败: {match.group(2)}")
+
+    def _check_stall(self):
+        """在看门狗线程中定时调用：转推中超过stall_timeout秒输出没有进展时结束ffmpeg进程，由工作线程重连"""
+        proc, monitor = self._ffmpeg_proc, self._monitor
+        if self._stop or proc is None or monitor is None:
+            return
+        now = time.monotonic()
+        if proc is self._stalled_proc:
+            # terminate之后ffmpeg仍然没有退出，强制杀死
+            if proc.poll() is None and now - self._stalled_at > 5:
+                proc.kill()
+            return
+        if self._state.state == RUNNING and now - max(monitor.advanced, self._state.since) > self._stall_timeout:
+            logger.warning(f"{self._pull_url} 超过{self._stall_timeout}秒没有输出新的帧，结束ffmpeg进程")
+            self._stalled_proc, self._stalled_at = proc, now
+            self._stalls += 1
+            proc.terminate()
+
     def _run(self):
         # 用来维护推拉进程的线程，包括断线重连的功能
         ffmpeg_proc: Union[subprocess.Popen, None] = None
-        while True:
+        failed = False  # 最后一次运行的ffmpeg进程是否异常退出
+        reuse_info = False  # 上一次转推正常运行过，重连时沿用上一次的命令，不重新探测
+        if self._stall_timeout is not None:
+            watchdog.add(self._check_stall)
+        while not self._stop:
             if ffmpeg_proc is not None:
                 release_process(ffmpeg_proc)
-            self._ffmpeg_process = run_async(self._ffmpeg_cmd)
+                if not reuse_info:
+                    self._ffmpeg_cmd = None  # 重连后源视频的编码可能变了，重新探测，选择转封装还是重新编码
+            if self._ffmpeg_cmd is None:
+                self._make_ffmpeg_cmd()
+            if self._outputs is None:
+                ffmpeg_proc, self._monitor = run_monitored(self._ffmpeg_cmd, self._log)
+            else:
+                for out in self._outputs:
+                    out["alive"], out["error"] = True, None
+                ffmpeg_proc, self._monitor = run_monitored(self._ffmpeg_cmd, self._log, on_line=self._watch_line)
+            self._ffmpeg_proc = ffmpeg_proc
 
             check_cnt = 0
-            while self._ffmpeg_process.poll() is None:
-                time.sleep(2)
-                check_cnt += 1
-                if check_cnt == 2:
-                    self._working = True
-
-                if self._stop:
-                    break
-            else:
-                logger.warning("ffmpeg拉推流失败")
-            self._working = False
+            while not self._stop:
+                try:
+                    # stop会直接结束进程，不用等满2秒
+                    ffmpeg_proc.wait(timeout=2)
+                except TimeoutExpired:
+                    check_cnt += 1
+                    if check_cnt == 2:
+                        self._backoff.connected()
+                        self._state.set(RUNNING)
+                    continue
+                # 视频文件转推完成时ffmpeg正常退出
+                failed = ffmpeg_proc.returncode != 0 and not self._stop
+                if failed:
+                    logger.warning("ffmpeg拉推流失败")
+                break
 
             if not self._reconn:
                 break
+            if not self._stop:
+                self._state.set(RECONNECTING)
+            reuse_info = check_cnt >= 2 and self._backoff.policy.reuse_info
+            if not failed and not is_stream(self._pull_url):
+                # 视频文件转推完，立即从头开始
+                continue
+            # 打开失败或者断线，按重连策略等待，避免源或服务器不可用时不停地重启ffmpeg
+            delay = self._backoff.next_delay()
+            logger.info(f"{self._pull_url} {delay:.2f}秒后重连")
+            self._backoff.wait(delay, lambda: self._stop)
+
+        if self._stall_timeout is not None:
+            watchdog.remove(self._check_stall)
+        if ffmpeg_proc is not None:
+            release_process(ffmpeg_proc)
+        self._state.set(FAILED if failed and not self._stop else STOPPED)
 
-        release_process(ffmpeg_proc)
+    def stop(self):
+        """发出停止信号并结束ffmpeg进程，不等待工作线程退出；同时关闭多路转推时先对每一路调用stop，见release_all"""
+        self._reconn = False
+        self._stop = True
+        proc = self._ffmpeg_proc
+        if proc is not None:
+            proc.terminate()
 
     def release(self):
+        """停止转推，等待工作线程关闭ffmpeg进程后返回"""
         while self._work_thread.is_alive():
-            self._reconn = False
-            self._stop = True
-            time.sleep(0.03)
+            self.stop()
+            self._work_thread.join(0.03)
+
+    def wait_opened(self, timeout: Union[float, None] = None) -> bool:
+        """等待转推开始，用于block=False时；返回是否正在转推"""
+        return self._state.wait_for(RUNNING, timeout)
 
     def is_working(self) -> bool:
-        return self._working
+        return self._state.state == RUNNING
+
+    @property
+    def state(self) -> str:
+        """转推状态：connecting、running、reconnecting、stopped或failed，见state"""
+        return self._state.state
+
+    def wait_state(self, states: Union[str, Sequence[str]], timeout: Union[float, None] = None) -> bool:
+        """阻塞等待进入states中的任意一个状态，超时或者转推已经结束(进入了其他最终状态)时返回False"""
+        return self._state.wait_for(states, timeout)
+
+    def on_state_change(self, callback: Callable[[str, str], None]) -> Callable[[str, str], None]:
+        """注册状态切换的回调callback(旧状态, 新状态)，在工作线程中调用，应尽快返回；可以作为装饰器使用"""
+        return self._state.on_change(callback)
+
+    def stats(self) -> dict:
+        """
+        转推的指标快照，帧的编解码都在ffmpeg进程中，帧率、码率等来自ffmpeg的-progress输出
+        :return: {"kind": "pullpush", "state", "age", "uptime", "reconnects", "stream_copy": 是否直接转封装,
+                  "outputs_alive": 正常推流的输出个数, "stalls": 因为卡住而重启的次数,
+                  "reconnect_failures"/"reconnect_delay"/"reconnect_wait"/"circuit_open":
+                  重连的状态，见reconnect.Backoff.stats,
+                  "ffmpeg": 当前ffmpeg进程报告的进度，见monitor.parse_progress}
+        """
+        snapshot = self._metrics.snapshot()
+        monitor = self._monitor
+        return {
+            "kind": "pullpush",
+            **{key: snapshot[key] for key in ("state", "age", "uptime", "reconnects")},
+            "stream_copy": self.is_stream_copy(),
+            "outputs_alive": sum(1 for out in self.output_health() if out["alive"]),
+            "stalls": self._stalls,
+            **self._backoff.stats(),
+            "ffmpeg": dict(monitor.progress) if monitor is not None else {},
+        }
+
+    def ffmpeg_log(self, n: Union[int, None] = None) -> list[tuple]:
+        """ffmpeg最近输出的n条警告和错误[(时间戳, 日志行), ...]，包括之前断线的进程，用于诊断"""
+        return self._log.lines(n)
+
+    def is_stream_copy(self) -> bool:
+        """是否在直接转封装，没有重新编码"""
+        return self.mode == self.MODE_COPY
+
+    def output_health(self) -> list[dict]:
+        """
+        多个输出时每个输出的状态
+        :return: [{"url", "rendition": 使用第几种编码参数, "alive": 是否在正常推流, "error": 失败原因}, ...]
+        """
+        if self._outputs is None:
+            return [{"url": self._push_url, "rendition": 0, "alive": self.is_working(), "error": None}]
+        return [dict(out, alive=out["alive"] and self.is_working()) for out in self._outputs]
 
 
 if __name__ == '__main__':
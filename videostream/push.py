@@ -1,136 +1,356 @@
 import subprocess
 import time
-from queue import Queue
-from threading import Thread
-from typing import Type, Union
+from queue import Empty
+from threading import Lock, Thread
+from typing import Callable, Sequence, Type, Union
 
 import numpy as np
 
 from videostream.accelerator import Accelerator, NoAccel
+from videostream.flvrelay import FlvFanout
+from videostream.framering import DROP_OLDEST, FrameRing
 from videostream.logger import logger
-from videostream.tools import release_process, run_async
+from videostream.metrics import StreamMetrics
+from videostream.monitor import FfmpegMonitor, LogRing, run_monitored, watchdog
+from videostream.reconnect import Backoff, ReconnectPolicy
+from videostream.state import CONNECTING, FAILED, RECONNECTING, RUNNING, STOPPED, StreamState
+from videostream.tools import release_process, get_out_numpy_shape
+
+
+def make_push_cmd(push_url: str, w: int, h: int, fr: int, pix_fmt: str, accel: Type[Accelerator],
+                  gop: Union[int, None] = None, vfr: bool = False) -> str:
+    """
+    构造推流的ffmpeg命令，从stdin读取rawvideo格式的帧，编码后推送
+    :param gop: 关键帧间隔(帧数)，None时使用编码器的默认值
+    :param vfr: 可变帧率，每一帧的时间戳取ffmpeg读到它的时间，输出时不插帧也不丢帧；
+                rawvideo的时间基是1/帧率，这里设为1/1000使时间戳精确到毫秒
+    """
+    accel_opt = accel.get_accel_opt()
+    encoder = accel.get_encoder("h264")
+    encoder_param = accel.get_encoder_param()
+    rate_opt = "-use_wallclock_as_timestamps 1 -framerate 1000" if vfr else f"-r {fr}"
+    return ("ffmpeg "
+            "-loglevel warning "
+            f"{accel_opt} "
+            "-y "
+            "-rw_timeout 3000000 "
+            f"-f rawvideo "
+            f"-pix_fmt {pix_fmt} "
+            f"-s {w}x{h} "
+            f"{rate_opt} "
+            "-i - "
+            f"-c:v {encoder} "
+            f"{encoder_param} "
+            f"{f'-g {gop} ' if gop is not None else ''}"
+            f"{'-fps_mode vfr ' if vfr else ''}"
+            "-an "
+            "-pix_fmt yuv420p "
+            "-f flv "
+            f"{push_url}")
 
 
 class Push:
-    def __init__(self, push_url: str,
+    _max_drift = 1.  # 写帧的时间和计划时间相差超过这么多秒时重新对齐，不再追赶
+
+    def __init__(self, push_url: Union[str, Sequence[str]],
                  w: int, h: int, fr: int, pix_fmt: str = "rgb24",
                  reconn: bool = False,
-                 accel: Type[Accelerator] = NoAccel):
+                 accel: Type[Accelerator] = NoAccel,
+                 vfr: bool = False,
+                 buffer_size: int = 5,
+                 buffer_policy: str = DROP_OLDEST, block: bool = True,
+                 stall_timeout: Union[float, None] = 10., reconnect_policy: Union[ReconnectPolicy, None] = None):
         """
         推流到服务器上
-        :param push_url: 推送url
+        :param push_url: 推送url；也可以是多个url的列表，只编码一次，编码结果分发给每个地址各自的转推进程，
+                         每个地址单独断线重连，某个服务器断开不会影响编码和其他地址，见destination_health
         :param w: 视频宽
         :param h: 视频高
         :param fr: 帧率
-        :param pix_fmt: 像素格式
+        :param pix_fmt: 输入帧的像素格式，"rgb24"、"bgr24"、"yuv420p"、"yuvj420p"、"nv12"或"gray"，
+                        帧的形状见get_out_numpy_shape；yuv420p、nv12每像素1.5字节，通过管道的数据量是rgb24的一半
         :param reconn: 与视频流服务器断线重连
         :param accel: 使用的加速器，默认不适用加速器(NoAccel)
+        :param vfr: False-恒定帧率，按fr的节奏写帧，没有新帧时重复上一帧；
+                    True-可变帧率，每一帧按put_frame时给出的时间写入，不重复帧，编码量和实际产生的帧数一致
+        :param buffer_size: 预分配的帧槽个数
+        :param buffer_policy: 推流跟不上、帧槽满时的策略，见framering：
+                              "latest"-只推最新帧，"drop_oldest"-丢弃最旧的帧，"drop_newest"-丢弃新帧，
+                              "block"-put_frame等待，不丢帧
+        :param block: True-等待推流进程连接服务器(最多9秒)后返回；False-立即返回，用wait_opened等待
+        :param stall_timeout: 向ffmpeg写一帧阻塞超过这么多秒(编码或推流卡住)时结束ffmpeg进程，
+                              reconn为True时重连，否则推流失败；None表示不检查
+        :param reconnect_policy: 推流失败后重启ffmpeg之前的等待时间和熔断，见reconnect.ReconnectPolicy，None时使用默认策略；
+                                 多个地址时每个地址的转推进程也按这个策略单独重连
         """
         assert w > 0 and h > 0, "宽高必须大于0"
         assert 0 < fr < 120, "帧率必须大于0且小于120"
-        assert pix_fmt in ["rgb24", "bgr24"]
+        assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        assert stall_timeout is None or stall_timeout > 0, "卡顿超时必须大于0"
 
         self._push_url = push_url
+        self._fanout: Union[FlvFanout, None] = None
+        if not isinstance(push_url, str):
+            assert len(push_url) > 0, "至少需要一个推流地址"
+            self._fanout = FlvFanout(push_url, reconn=reconn, reconnect_policy=reconnect_policy)
         self._w = w
         self._h = h
         self._fr = fr
         self._pix_fmt = pix_fmt
         self._reconn = reconn
         self._accel = accel
+        self._vfr = vfr
 
-        self._is_pushing = False # 是否正在推流，用来向外界反馈推流状态
+        self._state = StreamState(CONNECTING)  # 推流状态，由推流线程切换，见state
+        self._metrics = StreamMetrics(self._state)  # 性能计数，见stats
+        self._repeated = 0  # 恒定帧率时没有新帧、重复写入上一帧的次数
+        self._stall_timeout = stall_timeout
+        self._stalls = 0  # 因为卡住而结束ffmpeg进程的次数
+        self._writing_since = 0.  # 正在写的这一帧开始写的时间(time.monotonic)，没有在写时为0
+        self._stalled_proc: Union[subprocess.Popen, None] = None  # 已经因为卡住而结束的进程，避免重复处理
+        self._stalled_at = 0.
+        self._log = LogRing()  # ffmpeg最近的警告和错误，见ffmpeg_log
+        self._monitor: Union[FfmpegMonitor, None] = None  # 当前ffmpeg进程的日志和进度
+        self._ffmpeg_proc: Union[subprocess.Popen, None] = None  # 当前的推流进程
+        self._backoff = Backoff(reconnect_policy, push_url if isinstance(push_url, str) else push_url[0])
         self._stop = False  # 停止推流（用来关闭推流的信号量）
-        self._q = Queue(maxsize=5)
+        self._out_np_shape = get_out_numpy_shape((w, h), pix_fmt)
+        # put_frame把帧拷贝到预分配的帧槽中，推流线程直接从帧槽写入ffmpeg，不再tobytes
+        self._ring = FrameRing(self._out_np_shape, buffer_size, policy=buffer_policy)
+        self._put_lock = Lock()  # FrameRing只支持一个生产者，多个线程同时put_frame时依次写入
         self._push_thread = Thread(target=self._run)
         self._ffmpeg_cmd: Union[str, None] = None
 
         # 检查加速器是否可用
         if not self._accel.check_ffmpeg():
-            logger.warning("未安装ffmpeg或当前ffmpeg不支持nvidia GPU加速")
+            logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{self._accel.__name__}加速")
             self._accel = NoAccel
         elif self._accel.get_num() <= 0:
-            logger.warning("没有可用的nvidia显卡或没有正确安装nvidia驱动")
+            logger.warning(f"没有可用的{self._accel.__name__}设备或没有正确安装驱动")
             self._accel = NoAccel
 
         self._make_ffmpeg_cmd()
 
         # 开启推流线程，等待推流进程连接服务器
         self._push_thread.start()
-        wait_cnt = 0
-        while not self._is_pushing and wait_cnt < 300:
-            time.sleep(0.03)
-            wait_cnt += 1
+        if block:
+            self.wait_opened(9)
 
     def _make_ffmpeg_cmd(self):
         """生成ffmpeg命令"""
-        accel_opt = self._accel.get_accel_opt()
-        encoder = self._accel.get_encoder("h264")
-        encoder_param = self._accel.get_encoder_param()
-        self._ffmpeg_cmd = ("ffmpeg "
-                            "-loglevel warning "
-                            f"{accel_opt} "
-                            "-y "
-                            "-rw_timeout 3000000 "
-                            f"-f rawvideo "
-                            f"-pix_fmt {self._pix_fmt} "
-                            f"-s {self._w}x{self._h} "
-                            f"-r {self._fr} "
-                            "-i - "
-                            f"-c:v {encoder} "
-                            f"{encoder_param} "
-                            "-an "
-                            "-pix_fmt yuv420p "
-                            "-f flv "
-                            f"{self._push_url}")
+        if self._fanout is None:
+            self._ffmpeg_cmd = make_push_cmd(self._push_url, self._w, self._h, self._fr, self._pix_fmt, self._accel,
+                                             vfr=self._vfr)
+        else:
+            # 多个地址时编码结果以FLV格式输出到stdout，由FlvFanout分发；
+            # 断线的地址要等到下一个关键帧才能重新推流，所以关键帧间隔取2秒
+            self._ffmpeg_cmd = make_push_cmd("pipe:1", self._w, self._h, self._fr, self._pix_fmt, self._accel,
+                                             gop=2 * self._fr, vfr=self._vfr)
+
+    def _blank_frame(self) -> np.ndarray:
+        """还没有帧时写入的黑帧"""
+        frame = np.zeros(self._out_np_shape, dtype=np.uint8)
+        if self._pix_fmt in ("yuv420p", "yuvj420p", "nv12"):
+            frame[self._h:] = 128  # 色度为128时是灰度，亮度为0即黑色
+        return frame
 
     def _run(self):
         """推流子线程"""
-        sleep_secs = max(0., 1 / self._fr - 0.007)
-        frame = np.zeros((self._h, self._w, 3), dtype=np.uint8).tobytes()
+        frame = self._blank_frame()  # 当前要写的帧，恒定帧率没有新帧时重复写它
         ffmpeg_proc: Union[subprocess.Popen, None] = None
+        failed = False  # 最后一次推流是否因为写入失败而结束
+        if self._stall_timeout is not None:
+            watchdog.add(self._check_stall)
         while True:
             if ffmpeg_proc is not None:
                 release_process(ffmpeg_proc)
-            ffmpeg_proc = run_async(self._ffmpeg_cmd)
+            failed = False
+            ffmpeg_proc, self._monitor = run_monitored(self._ffmpeg_cmd, self._log)
+            self._ffmpeg_proc = ffmpeg_proc
+            if self._fanout is not None:
+                Thread(target=self._fanout.feed, args=(ffmpeg_proc.stdout,), daemon=True).start()
             push_cnt = 0
+            # 下一帧的写入时间，在单调时钟上按帧间隔累加，sleep的误差不会累积成漂移
+            deadline = time.monotonic()
+            base: Union[tuple, None] = None  # 可变帧率时，对齐用的(写入时间, pts)
 
             while not self._stop:
-                if not self._q.empty():
-                    frame = self._q.get()
+                if self._vfr:
+                    try:
+                        new_frame = self._ring.get(timeout=0.1)
+                    except Empty:
+                        continue
+                    if new_frame is None:
+                        break
+                    self._ring.release(frame)  # 写完的帧归还帧槽
+                    frame = new_frame
+                    pts = self._ring.ts_of(frame)
+                    now = time.monotonic()
+                    if base is None or abs(base[0] + pts - base[1] - now) > self._max_drift:
+                        # 第一帧，或者处理卡顿、pts跳变导致偏差太大，以这一帧重新对齐
+                        base = (now, pts)
+                    deadline = base[0] + pts - base[1]
+                elif self._ring.has_frame():
+                    new_frame = self._ring.get(block=False)
+                    self._ring.release(frame)
+                    frame = new_frame
+                else:
+                    self._repeated += 1
+
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
                 try:
-                    ffmpeg_proc.stdin.write(frame)
+                    t = time.perf_counter()
+                    self._writing_since = time.monotonic()
+                    ffmpeg_proc.stdin.write(memoryview(frame).cast("B"))
                     ffmpeg_proc.stdin.flush()
+                    self._writing_since = 0.
+                    self._metrics.frame_out(frame.nbytes, time.perf_counter() - t)
                     push_cnt += 1
                     if push_cnt == 10:
-                        self._is_pushing = True
+                        self._backoff.connected()
+                        self._state.set(RUNNING)
                 except BrokenPipeError:
+                    self._writing_since = 0.
                     logger.error("推流失败，可能是和服务器之间的网络连接问题")
-                    self._is_pushing = False
+                    failed = True
                     break
                 except Exception as e:
+                    self._writing_since = 0.
                     logger.exception("写数据失败", e)
-                    self._is_pushing = False
+                    failed = True
                     break
-                time.sleep(sleep_secs)
+
+                if not self._vfr:
+                    deadline += 1 / self._fr
+                    if time.monotonic() - deadline > self._max_drift:
+                        # 写入被阻塞太久，不再追赶落下的帧
+                        deadline = time.monotonic()
 
             if not self._reconn:
                 break
+            if failed:
+                self._state.set(RECONNECTING)
+                # 服务器不可用时按重连策略等待，不要不停地重启ffmpeg；等待期间put_frame按缓冲策略丢帧
+                delay = self._backoff.next_delay()
+                logger.info(f"{delay:.2f}秒后重新推流")
+                if not self._backoff.wait(delay, lambda: self._stop):
+                    break
 
+        if self._stall_timeout is not None:
+            watchdog.remove(self._check_stall)
         release_process(ffmpeg_proc)
+        self._state.set(FAILED if failed and not self._stop else STOPPED)
+
+    def _check_stall(self):
+        """在看门狗线程中定时调用：写一帧阻塞超过stall_timeout秒时结束ffmpeg进程，写入失败后由推流线程重连"""
+        proc = self._ffmpeg_proc
+        if self._stop or proc is None:
+            return
+        now = time.monotonic()
+        if proc is self._stalled_proc:
+            # terminate之后ffmpeg仍然没有退出，强制杀死，否则写帧会一直阻塞
+            if proc.poll() is None and now - self._stalled_at > 5:
+                proc.kill()
+            return
+        started = self._writing_since
+        if started and now - started > self._stall_timeout:
+            logger.warning(f"写一帧超过{self._stall_timeout}秒没有完成，结束推流的ffmpeg进程")
+            self._stalled_proc, self._stalled_at = proc, now
+            self._stalls += 1
+            proc.terminate()
 
-    def put_frame(self, frame: np.ndarray):
-        if not self._q.full():
-            self._q.put(frame.tobytes())
+    def put_frame(self, frame: np.ndarray, pts: Union[float, None] = None):
+        """
+        把帧拷贝到预分配的帧槽中后立即返回，调用方之后可以继续修改frame；可以在多个线程中调用
+        :param frame: 一帧，形状见get_out_numpy_shape
+        :param pts: 可变帧率时这一帧的时间(秒)，帧之间按pts的间隔写入；None时取调用时的时间；恒定帧率时忽略
+        """
+        assert frame.shape == self._out_np_shape, f"帧的形状应为{self._out_np_shape}"
+        with self._put_lock:
+            np.copyto(self._ring.acquire(), frame)
+            self._ring.commit(pts)
+            self._metrics.frame_in(frame.nbytes)
 
     def is_pushing(self) -> bool:
-        """是否正在推流"""
-        return self._is_pushing
+        """是否正在推流，多个地址时表示编码进程是否在运行"""
+        return self._state.state == RUNNING
+
+    @property
+    def state(self) -> str:
+        """推流状态：connecting、running、reconnecting、stopped或failed，见state"""
+        return self._state.state
+
+    def wait_state(self, states: Union[str, Sequence[str]], timeout: Union[float, None] = None) -> bool:
+        """阻塞等待进入states中的任意一个状态，超时或者推流已经结束(进入了其他最终状态)时返回False"""
+        return self._state.wait_for(states, timeout)
+
+    def on_state_change(self, callback: Callable[[str, str], None]) -> Callable[[str, str], None]:
+        """注册状态切换的回调callback(旧状态, 新状态)，在推流线程中调用，应尽快返回；可以作为装饰器使用"""
+        return self._state.on_change(callback)
+
+    def wait_opened(self, timeout: Union[float, None] = None) -> bool:
+        """等待开始推流，用于block=False时；返回是否正在推流"""
+        return self._state.wait_for(RUNNING, timeout)
+
+    def buffer_stats(self) -> dict:
+        """帧缓冲区的策略、已提交和丢弃的帧数、排队的帧数"""
+        return self._ring.stats()
+
+    def stats(self) -> dict:
+        """
+        推流的性能指标快照，只读取计数器，可以频繁调用；用metrics.MetricsExporter以Prometheus格式导出
+        :return: {"kind": "push", "state", "age", "uptime", "reconnects",
+                  "frames_in"/"bytes_in": put_frame的帧数/字节数, "fps_in",
+                  "frames_out"/"bytes_out": 写入ffmpeg的帧数/字节数, "fps_out": 最近1秒实际推流的帧率,
+                  "repeated": 恒定帧率时重复写入上一帧的次数, "dropped": 按缓冲策略丢弃的帧数, "queued": 排队的帧数,
+                  "stalls": 因为卡住而重启的次数, "reconnect_failures"/"reconnect_delay"/"reconnect_wait"/"circuit_open":
+                  重连的状态，见reconnect.Backoff.stats, "write_latency": 向ffmpeg写一帧阻塞时间的直方图,
+                  "buffers": {"main": buffer_stats}, "ffmpeg": 当前ffmpeg进程报告的编码进度，见monitor.parse_progress}
+        """
+        monitor = self._monitor
+        return {
+            "kind": "push",
+            **self._metrics.snapshot(),
+            "repeated": self._repeated,
+            "dropped": self._ring.dropped,
+            "queued": self._ring.qsize(),
+            "stalls": self._stalls,
+            **self._backoff.stats(),
+            "write_latency": self._metrics.write_latency.snapshot(),
+            "buffers": {"main": self._ring.stats()},
+            "ffmpeg": dict(monitor.progress) if monitor is not None else {},
+        }
+
+    def ffmpeg_log(self, n: Union[int, None] = None) -> list[tuple]:
+        """ffmpeg最近输出的n条警告和错误[(时间戳, 日志行), ...]，包括之前断线的进程，用于诊断"""
+        return self._log.lines(n)
+
+    def destination_health(self) -> list[dict]:
+        """
+        每个推流地址的状态
+        :return: [{"url", "alive": 是否在正常推流, "reconnects": 重连次数, "dropped": 因推流慢丢弃的数据包数,
+                   "reconnect_failures"/"reconnect_delay"/"reconnect_wait"/"circuit_open": 重连的状态}, ...]
+        """
+        if self._fanout is None:
+            return [{"url": self._push_url, "alive": self.is_pushing(), "reconnects": 0, "dropped": 0,
+                     **self._backoff.stats()}]
+        return self._fanout.health()
+
+    def stop(self):
+        """发出停止信号，不等待推流线程退出；同时关闭多路推流时先对每一路调用stop，见release_all"""
+        self._reconn = False
+        self._stop = True
+        self._ring.close()
 
     def release(self):
+        """停止推流，等待推流线程关闭ffmpeg进程后返回"""
         while self._push_thread.is_alive():
-            self._reconn = False
-            self._stop = True
-            time.sleep(0.03)
+            self.stop()
+            self._push_thread.join(0.03)
+        if self._fanout is not None:
+            self._fanout.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+import random
+import time
+from typing import Callable, Union
+
+from videostream.logger import logger
+
+
+class ReconnectPolicy:
+    def __init__(self, initial_delay: float = 0.5, max_delay: float = 30., factor: float = 2., jitter: float = 0.5,
+                 stable_time: float = 10., breaker_failures: Union[int, None] = 10, breaker_delay: float = 60.,
+                 reuse_info: bool = True):
+        """
+        断线重连的策略，只保存参数，可以被多路流共用；每一路流的重连状态见Backoff
+        连续失败时等待时间按指数增长：initial_delay * factor ** (失败次数 - 1)，不超过max_delay，
+        再乘以[1 - jitter, 1]之间的随机数，同时断线的多路流不会在同一时刻一起重连
+        :param stable_time: 一次连接持续这么多秒以上才算成功，之后断线从initial_delay重新开始计算
+        :param breaker_failures: 连续失败这么多次后熔断，之后每次等待breaker_delay秒再尝试一次，直到连接稳定；
+                                 None表示不熔断
+        :param reuse_info: 上一次连接收到过帧时，重连直接使用上一次的探测结果，不再运行ffprobe；
+                           重连失败后的下一次重新探测
+        """
+        assert initial_delay >= 0 and max_delay >= initial_delay and factor >= 1 and 0 <= jitter <= 1
+        assert breaker_failures is None or breaker_failures > 0
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.stable_time = stable_time
+        self.breaker_failures = breaker_failures
+        self.breaker_delay = breaker_delay
+        self.reuse_info = reuse_info
+
+    def delay(self, failures: int) -> float:
+        """连续失败failures次之后的等待时间(秒)，包括随机抖动"""
+        if self.breaker_failures is not None and failures >= self.breaker_failures:
+            base = self.breaker_delay
+        else:
+            base = min(self.max_delay, self.initial_delay * self.factor ** max(failures - 1, 0))
+        return base * (1 - self.jitter * random.random())
+
+
+DEFAULT_POLICY = ReconnectPolicy()
+
+
+class Backoff:
+    def __init__(self, policy: Union[ReconnectPolicy, None] = None, name: str = ""):
+        """
+        一路流的重连状态，只在这路流的工作线程中更新
+        :param name: 日志中显示的名字，一般是url
+        """
+        self.policy = policy or DEFAULT_POLICY
+        self._name = name
+        self.failures = 0  # 连续失败的次数，连接稳定后清零
+        self.last_delay = 0.  # 最近一次重连前等待的时间(秒)
+        self.total_wait = 0.  # 累计等待重连的时间(秒)
+        self._connected_at: Union[float, None] = None
+
+    @property
+    def circuit_open(self) -> bool:
+        """是否已经熔断"""
+        return self.policy.breaker_failures is not None and self.failures >= self.policy.breaker_failures
+
+    def connected(self):
+        """连接成功时调用：拉流收到第一帧、推流写入了几帧之后，只是启动了ffmpeg不算"""
+        self._connected_at = time.monotonic()
+
+    def next_delay(self) -> float:
+        """一次连接结束或者打开失败时调用，更新连续失败的次数，返回重连之前应该等待的秒数"""
+        uptime = time.monotonic() - self._connected_at if self._connected_at is not None else 0.
+        self._connected_at = None
+        if uptime >= self.policy.stable_time:
+            # 连接稳定运行了一段时间，这次断线是偶发的
+            self.failures = 0
+        was_open = self.circuit_open
+        self.failures += 1
+        self.last_delay = self.policy.delay(self.failures)
+        if self.circuit_open and not was_open:
+            logger.warning(f"{self._name} 连续{self.failures}次重连失败，之后每{self.policy.breaker_delay}秒尝试一次")
+        return self.last_delay
+
+    def wait(self, delay: float, stopped: Callable[[], bool]) -> bool:
+        """
+        等待delay秒，stopped()返回True时提前结束
+        :return: 是否等满了delay秒，被停止时返回False
+        """
+        deadline = time.monotonic() + delay
+        start = time.monotonic()
+        try:
+            while not stopped():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                time.sleep(min(remaining, 0.03))
+            return False
+        finally:
+            self.total_wait += time.monotonic() - start
+
+    def stats(self) -> dict:
+        """{"reconnect_failures": 连续失败的次数, "reconnect_delay": 最近一次等待的秒数,
+            "reconnect_wait": 累计等待的秒数, "circuit_open": 是否熔断}"""
+        return {
+            "reconnect_failures": self.failures,
+            "reconnect_delay": self.last_delay,
+            "reconnect_wait": self.total_wait,
+            "circuit_open": self.circuit_open,
+        }
@@ -0,0 +1,211 @@
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Sequence, Union
+
+import numpy as np
+
+
+_MAGIC = 0x56534255  # "VSBU"
+_VERSION = 1
+_HEADER_LEN = 8  # [magic, version, 槽个数, 维数, 最新帧序号, 一帧字节数, 是否已关闭, 保留]
+_MAX_NDIM = 4
+_ALIGN = 64
+_attach_lock = threading.Lock()
+
+
+def _layout(slot_num: int, frame_nbytes: int) -> tuple:
+    """共享内存布局：头部 | 帧形状 | 每个槽的序号 | 每个槽的时间戳 | 帧数据，返回各段的偏移和总大小"""
+    shape_off = _HEADER_LEN * 8
+    seq_off = shape_off + _MAX_NDIM * 8
+    ts_off = seq_off + slot_num * 8
+    data_off = (ts_off + slot_num * 8 + _ALIGN - 1) // _ALIGN * _ALIGN
+    return shape_off, seq_off, ts_off, data_off, data_off + slot_num * frame_nbytes
+
+
+def _attach_untracked(name: str) -> shared_memory.SharedMemory:
+    """
+    附加已有的共享内存，不登记到resource_tracker，
+    否则python3.13之前附加进程退出时会把发布者的共享内存删掉
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class _ShmRing:
+    def __init__(self, shm: shared_memory.SharedMemory):
+        buf = shm.buf
+        self._shm = shm
+        self.header = np.ndarray((_HEADER_LEN,), dtype=np.int64, buffer=buf)
+        slot_num, ndim, frame_nbytes = int(self.header[2]), int(self.header[3]), int(self.header[5])
+        shape_off, seq_off, ts_off, data_off, _ = _layout(slot_num, frame_nbytes)
+        self.slot_num = slot_num
+        self.shape = tuple(int(i) for i in np.ndarray((ndim,), dtype=np.int64, buffer=buf, offset=shape_off))
+        # 槽序号采用seqlock方式：偶数 2*帧序号 表示数据完整，奇数表示正在写入
+        self.slot_seq = np.ndarray((slot_num,), dtype=np.int64, buffer=buf, offset=seq_off)
+        self.slot_ts = np.ndarray((slot_num,), dtype=np.float64, buffer=buf, offset=ts_off)
+        self.slots = np.ndarray((slot_num,) + self.shape, dtype=np.uint8, buffer=buf, offset=data_off)
+
+    def release(self):
+        # 释放所有引用共享内存的numpy数组之后才能close
+        del self.header, self.slot_seq, self.slot_ts, self.slots
+        try:
+            self._shm.close()
+        except BufferError:
+            # 外部还持有帧视图，等这些视图被回收后再由垃圾回收关闭
+            pass
+
+
+class ShmFramePublisher:
+    def __init__(self, name: str, shape: Sequence[int], slot_num: int = 8):
+        """
+        把帧发布到multiprocessing共享内存的环形缓冲区中，其他进程用ShmFrameReader按名字附加后零拷贝读取
+        只有一个写者；写者从不等待读者，读得慢的读者会落后，落后超过一圈后自动跳到最新帧
+        :param name: 共享内存名字，读者用它附加，同名的旧共享内存会被替换
+        :param shape: 帧的形状，如get_out_numpy_shape的返回值
+        :param slot_num: 槽的个数，越大读者可以落后得越多
+        """
+        assert 2 <= slot_num
+        assert 1 <= len(shape) <= _MAX_NDIM
+        self.name = name
+        self.shape = tuple(shape)
+        frame_nbytes = int(np.prod(self.shape))
+        *_, size = _layout(slot_num, frame_nbytes)
+        try:
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((_HEADER_LEN,), dtype=np.int64, buffer=self._shm.buf)
+        header[:] = [_MAGIC, _VERSION, slot_num, len(self.shape), 0, frame_nbytes, 0, 0]
+        shape_off = _layout(slot_num, frame_nbytes)[0]
+        np.ndarray((len(self.shape),), dtype=np.int64, buffer=self._shm.buf, offset=shape_off)[:] = self.shape
+        del header
+        self._ring = _ShmRing(self._shm)
+        self._seq = 0
+        self._writing = -1
+
+    def begin(self) -> np.ndarray:
+        """取得下一个要写入的槽，写完后调用commit"""
+        seq = self._seq + 1
+        idx = seq % self._ring.slot_num
+        self._ring.slot_seq[idx] = 2 * seq - 1  # 标记为正在写入
+        self._writing = idx
+        return self._ring.slots[idx]
+
+    def commit(self):
+        """完成写入，对读者可见"""
+        idx = self._writing
+        self._seq += 1
+        self._ring.slot_ts[idx] = time.time()
+        self._ring.slot_seq[idx] = 2 * self._seq
+        self._ring.header[4] = self._seq
+        self._writing = -1
+
+    def publish(self, frame: np.ndarray):
+        """拷贝一帧到共享内存中"""
+        np.copyto(self.begin(), frame.reshape(self.shape))
+        self.commit()
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def close(self):
+        """通知读者发布已结束，然后删除共享内存"""
+        if self._ring is None:
+            return
+        self._ring.header[6] = 1
+        self._shm.unlink()
+        self._ring.release()
+        self._ring = None
+
+
+class ShmFrameReader:
+    def __init__(self, name: str):
+        """
+        按名字附加ShmFramePublisher发布的帧，可以在其他进程中使用
+        :param name: 发布者的共享内存名字
+        """
+        self._ring = _ShmRing(_attach_untracked(name))
+        assert self._ring.header[0] == _MAGIC and self._ring.header[1] == _VERSION, f"{name}不是帧共享内存"
+        self.name = name
+        self.shape = self._ring.shape
+        self._last = 0  # 上一次读到的帧序号
+        self.lagged = 0  # 因为落后超过一圈而跳过的帧数
+
+    @property
+    def latest_seq(self) -> int:
+        return int(self._ring.header[4])
+
+    @property
+    def closed(self) -> bool:
+        return bool(self._ring.header[6])
+
+    def read(self, timeout: Union[float, None] = None, poll: float = 0.001) -> tuple:
+        """
+        零拷贝读取下一帧，读者落后超过一圈时跳到最新帧
+        返回的视图在写者绕回这个槽之前有效，用完后可以用is_valid(seq)确认期间没有被覆盖
+        :param timeout: 没有新帧时最长等待时间(秒)，None表示一直等待
+        :param poll: 等待时的轮询间隔
+        :return: (帧序号, 帧视图, 发布时间)，超时或发布者已关闭时返回(0, None, 0.)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ring = self._ring
+        while True:
+            latest = int(ring.header[4])
+            if latest > self._last:
+                seq = self._last + 1
+                if latest - seq >= ring.slot_num - 1:
+                    # 落后太多，要读的槽可能正在被覆盖，直接跳到最新帧
+                    self.lagged += latest - seq
+                    seq = latest
+                idx = seq % ring.slot_num
+                if ring.slot_seq[idx] == 2 * seq:
+                    frame, ts = ring.slots[idx], float(ring.slot_ts[idx])
+                    if ring.slot_seq[idx] == 2 * seq:
+                        self._last = seq
+                        return seq, frame, ts
+                # 读的过程中被写者超过了，重新同步到最新帧
+                self._last = max(self._last, int(ring.header[4]) - 1)
+                continue
+            if ring.header[6]:
+                return 0, None, 0.
+            if deadline is not None and time.monotonic() >= deadline:
+                return 0, None, 0.
+            time.sleep(poll)
+
+    def read_copy(self, out: Union[np.ndarray, None] = None, timeout: Union[float, None] = None) -> tuple:
+        """
+        读取下一帧并拷贝出来，保证拷贝的数据不会是被写了一半的帧
+        :param out: 预分配的目标数组，None时新分配
+        :return: (帧序号, 帧, 发布时间)，超时或发布者已关闭时返回(0, None, 0.)
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8)
+        while True:
+            seq, frame, ts = self.read(timeout)
+            if frame is None:
+                return 0, None, 0.
+            np.copyto(out, frame)
+            if self.is_valid(seq):
+                return seq, out, ts
+
+    def is_valid(self, seq: int) -> bool:
+        """序号为seq的帧是否仍完整地保留在共享内存中"""
+        return bool(self._ring.slot_seq[seq % self._ring.slot_num] == 2 * seq)
+
+    def close(self):
+        self._ring.release()
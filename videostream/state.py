@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import Callable, Sequence, Union
+
+from videostream.logger import logger
+
+# 流的状态
+CONNECTING = "connecting"  # 正在探测、启动ffmpeg或等待第一批数据
+RUNNING = "running"  # 正在拉流/推流
+RECONNECTING = "reconnecting"  # 断线后正在重连
+STOPPED = "stopped"  # 调用了stop/release，或者视频文件播放结束，线程已经退出
+FAILED = "failed"  # 打开失败或者断线，并且不再重连，线程已经退出
+STATES = (CONNECTING, RUNNING, RECONNECTING, STOPPED, FAILED)
+FINAL_STATES = (STOPPED, FAILED)
+
+
+class StreamState:
+    def __init__(self, state: str = CONNECTING):
+        """
+        流的状态机，由工作线程切换状态，其他线程可以阻塞等待某个状态，或者注册状态切换的回调，不需要轮询
+        进入STOPPED或FAILED之后不再切换
+        """
+        assert state in STATES
+        self._state = state
+        self._since = time.monotonic()
+        self._cond = threading.Condition()
+        self._callbacks: list[Callable[[str, str], None]] = []
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def since(self) -> float:
+        """进入当前状态的时间(time.monotonic)"""
+        return self._since
+
+    def set(self, state: str) -> bool:
+        """
+        切换状态，唤醒等待的线程，然后在当前线程中依次调用回调(旧状态, 新状态)
+        :return: 状态是否改变，状态相同或者已经是最终状态时返回False
+        """
+        assert state in STATES
+        with self._cond:
+            old = self._state
+            if old == state or old in FINAL_STATES:
+                return False
+            self._state = state
+            self._since = time.monotonic()
+            callbacks = list(self._callbacks)
+            self._cond.notify_all()
+        for callback in callbacks:
+            try:
+                callback(old, state)
+            except Exception as e:
+                logger.exception("状态切换的回调出错", e)
+        return True
+
+    def wait_for(self, states: Union[str, Sequence[str]], timeout: Union[float, None] = None) -> bool:
+        """
+        等待进入states中的任意一个状态
+        :return: 是否已经进入，超时或者进入了不在states中的最终状态时返回False
+        """
+        if isinstance(states, str):
+            states = (states,)
+        with self._cond:
+            self._cond.wait_for(lambda: self._state in states or self._state in FINAL_STATES, timeout)
+            return self._state in states
+
+    def on_change(self, callback: Callable[[str, str], None]) -> Callable[[str, str], None]:
+        """
+        注册状态切换的回调callback(旧状态, 新状态)，在切换状态的线程(通常是工作线程)中调用，应尽快返回
+        :return: callback，可以作为装饰器使用
+        """
+        with self._cond:
+            self._callbacks.append(callback)
+        return callback
+
+    def remove_callback(self, callback: Callable[[str, str], None]):
+        with self._cond:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def __repr__(self):
+        return f"StreamState({self._state!r})"
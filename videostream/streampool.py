@@ -0,0 +1,530 @@
+import heapq
+import os
+import selectors
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Thread
+from typing import Callable, Sequence, Type, Union
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from videostream.accelerator import Accelerator, NoAccel
+from videostream.framering import BLOCK, DROP_OLDEST, FrameRing
+from videostream.logger import logger
+from videostream.monitor import watchdog
+from videostream.pull import make_pull_cmd
+from videostream.reconnect import Backoff, ReconnectPolicy
+from videostream.state import CONNECTING, FAILED, RECONNECTING, RUNNING, STOPPED, StreamState
+from videostream.tools import (PROBE_CACHE_TTL, get_info, is_stream, run_async, release_process, release_processes,
+                               get_out_numpy_shape)
+
+
+def _grow_pipe(fd: int, size: int):
+    """Linux下把管道缓冲区调大到能放下一帧，减少读线程被唤醒和读的次数，失败时保持默认大小"""
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
+
+class PoolStream:
+    def __init__(self, pool: "StreamPool", url: str, pix_fmt: str, reconn: bool, buffer_size: int,
+                 buffer_policy: str = DROP_OLDEST):
+        """
+        StreamPool中的一路拉流，由StreamPool.add创建，读帧接口和Pull相同
+        ffmpeg进程的stdout由StreamPool的读线程统一读取，不单独占用线程
+        """
+        assert pix_fmt in ("rgb24", "bgr24", "yuv420p", "yuvj420p", "nv12", "gray")
+        assert buffer_policy != BLOCK, "读线程同时服务多路流，不能因为一路流阻塞"
+        self._pool = pool
+        self._url = url
+        self._pix_fmt = pix_fmt
+        self._reconn = reconn
+        self._buffer_size = buffer_size
+        self._buffer_policy = buffer_policy
+        self._state = StreamState(CONNECTING)  # 由StreamPool的维护线程切换，见state
+        self._stop = False
+        self._ring: Union[FrameRing, None] = None
+        self._ffmpeg_cmd: Union[str, None] = None
+        self._proc: Union[subprocess.Popen, None] = None
+        self._reader: Union["_Reader", None] = None
+        self._backoff = Backoff(pool.reconnect_policy, url)  # 重连的等待时间，只在维护线程中更新
+        self._reuse_info = False  # 下一次启动是否直接使用上一次的探测结果
+        self._got_frame = False  # 这次启动的ffmpeg进程是否输出过帧，由读线程设置
+        self._last_in = 0.  # 最近一次提交帧的时间(time.monotonic)，由读线程设置
+        self._stalls = 0  # 因为卡住而结束ffmpeg进程的次数
+        self._stalled_proc: Union[subprocess.Popen, None] = None  # 已经因为卡住而结束的进程，避免重复处理
+        self._stalled_at = 0.
+        self._retired_counts = [0, 0]  # 分辨率改变时被替换掉的帧缓冲区已提交和丢弃的帧数
+        self.stream_info: list[dict] = []
+
+        # 以下变量只在读线程中使用：当前正在写入的帧槽和已写入的字节数
+        self._buf: Union[memoryview, None] = None
+        self._filled = 0
+
+    def _launch(self) -> bool:
+        """探测流信息并启动ffmpeg进程，成功返回True；任何错误都按启动失败处理，由调用方按重连策略重试"""
+        reuse_info, self._reuse_info = self._reuse_info, False
+        try:
+            # 第一次启动用add之前的探测结果(如果有)，重连时重新探测，分辨率可能已经改变；
+            # 按重连策略复用上一次的探测结果时不探测，输出缩放到上一次的分辨率，和帧缓冲区一致
+            if not reuse_info:
+                self.stream_info = get_info(self._url, max_age=PROBE_CACHE_TTL if self._ring is None else 0)
+            if len(self.stream_info) == 0:
+                logger.error("文件或流中没有视频流")
+                return False
+
+            out_np_shape = get_out_numpy_shape((self.stream_info[0]["width"], self.stream_info[0]["height"]),
+                                               self._pix_fmt)
+            if self._ring is None:
+                self._ring = FrameRing(out_np_shape, self._buffer_size, policy=self._buffer_policy)
+            elif out_np_shape != self._ring.shape:
+                # 重连后分辨率变了，重新分配帧缓冲区
+                old_ring = self._ring
+                self._ring = FrameRing(out_np_shape, self._buffer_size, policy=self._buffer_policy)
+                old_ring.close()
+                self._retired_counts[0] += old_ring.seq
+                self._retired_counts[1] += old_ring.dropped
+
+            size = (self.stream_info[0]["width"], self.stream_info[0]["height"]) if reuse_info else None
+            self._ffmpeg_cmd = make_pull_cmd(self._url, self._pix_fmt, self._pool.accel, size=size)
+            # 打开几百路流时可能因为文件描述符或内存不足(OSError)启动失败
+            self._proc = run_async(self._ffmpeg_cmd)
+            os.set_blocking(self._proc.stdout.fileno(), False)
+            _grow_pipe(self._proc.stdout.fileno(), self._ring.frame_nbytes)
+        except ValueError as e:
+            logger.error(e)
+            return False
+        except Exception as e:
+            logger.exception(f"{self._url} 启动拉流失败: {e}")
+            if self._proc is not None:
+                release_process(self._proc)
+                self._proc = None
+            return False
+
+        self._buf = memoryview(self._ring.acquire()).cast("B")
+        self._filled = 0
+        self._got_frame = False
+        self._state.set(RUNNING)
+        return True
+
+    def _on_readable(self) -> bool:
+        """
+        在读线程中调用，非阻塞地读空管道，每凑满一帧就提交给帧缓冲区
+        :return: False-管道已关闭
+        """
+        fd = self._proc.stdout.fileno()
+        while True:
+            try:
+                n = os.readv(fd, [self._buf[self._filled:]])
+            except BlockingIOError:
+                return True
+            except OSError:
+                n = 0
+            if n == 0:
+                self._ring.abort()
+                return False
+
+            self._filled += n
+            if self._filled == len(self._buf):
+                self._ring.commit()
+                self._buf = memoryview(self._ring.acquire()).cast("B")
+                self._filled = 0
+                self._last_in = time.monotonic()
+                if not self._got_frame:
+                    # 收到第一帧才算连接成功，接受连接却不出帧的摄像头仍然按连续失败计算等待时间
+                    self._got_frame = True
+                    self._backoff.connected()
+
+    def _check_stall(self, stall_timeout: float, now: float):
+        """在看门狗线程中调用，和Pull._check_stall相同：超过stall_timeout秒没有新帧时结束ffmpeg进程，
+        读线程读到管道关闭后交给维护线程按重连策略重连"""
+        proc = self._proc
+        if self._stop or proc is None:
+            return
+        if proc is self._stalled_proc:
+            # terminate之后ffmpeg仍然没有退出，强制杀死
+            if proc.poll() is None and now - self._stalled_at > 5:
+                proc.kill()
+            return
+        # 刚启动还没有收到帧时从进入RUNNING开始计时
+        if self._state.state == RUNNING and now - max(self._last_in, self._state.since) > stall_timeout:
+            logger.warning(f"{self._url} 超过{stall_timeout}秒没有收到新帧，结束ffmpeg进程")
+            self._stalled_proc, self._stalled_at = proc, now
+            self._stalls += 1
+            proc.terminate()
+
+    def get_frame(self, block: bool = True, timeout: Union[float, None] = None,
+                  copy: bool = False) -> Union[np.ndarray, None]:
+        """和Pull.get_frame相同"""
+        if self._ring is None:
+            return None
+        ring = self._ring
+        ring.release()
+        frame = ring.get(block, timeout)
+        if copy and frame is not None:
+            view, frame = frame, frame.copy()
+            ring.release(view)
+        return frame
+
+    def release_frame(self, frame: Union[np.ndarray, None] = None):
+        if self._ring is not None:
+            self._ring.release(frame)
+
+    @property
+    def frame_ring(self) -> Union[FrameRing, None]:
+        """当前使用的帧缓冲区，重连后分辨率变化时会被替换"""
+        return self._ring
+
+    def is_opened(self) -> bool:
+        return self._state.state == RUNNING
+
+    @property
+    def state(self) -> str:
+        """和Pull.state相同"""
+        return self._state.state
+
+    def wait_state(self, states: Union[str, Sequence[str]], timeout: Union[float, None] = None) -> bool:
+        """和Pull.wait_state相同"""
+        return self._state.wait_for(states, timeout)
+
+    def on_state_change(self, callback: Callable[[str, str], None]) -> Callable[[str, str], None]:
+        """和Pull.on_state_change相同，回调在StreamPool的维护线程中调用"""
+        return self._state.on_change(callback)
+
+    def wait_opened(self, timeout: Union[float, None] = None) -> bool:
+        return self._state.wait_for(RUNNING, timeout)
+
+    def wait_frame(self, timeout: Union[float, None] = None) -> bool:
+        """和Pull.wait_frame相同"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0., deadline - time.monotonic())
+            ring = self._ring
+            if ring is None:
+                if not self._state.wait_for(RUNNING, remaining):
+                    return False
+                continue
+            if ring.wait_frame(remaining):
+                return True
+            if ring is self._ring or (deadline is not None and time.monotonic() >= deadline):
+                return False
+
+    def has_frame(self) -> bool:
+        return self._ring is not None and self._ring.has_frame()
+
+    def buffer_stats(self) -> dict:
+        """帧缓冲区的策略、已提交和丢弃的帧数、排队的帧数"""
+        if self._ring is None:
+            return {}
+        stats = self._ring.stats()
+        stats["committed"] += self._retired_counts[0]
+        stats["dropped"] += self._retired_counts[1]
+        return stats
+
+    def release(self):
+        """从StreamPool中移除这一路流，并关闭ffmpeg进程"""
+        self._pool.remove(self)
+
+
+class _Reader:
+    def __init__(self, pool: "StreamPool"):
+        """一个读线程，用selector同时监听多个ffmpeg进程的stdout"""
+        self._pool = pool
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._pending: Queue = Queue()  # 由其他线程提交的(操作, 流)，在读线程中执行注册和注销
+        self._stop = False
+        self.stream_num = 0
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, stream: PoolStream):
+        stream._reader = self
+        self.stream_num += 1
+        self._pending.put(("add", stream))
+        os.write(self._wake_w, b"\0")
+
+    def remove(self, stream: PoolStream):
+        self._pending.put(("remove", stream))
+        os.write(self._wake_w, b"\0")
+
+    def _handle_pending(self):
+        while not self._pending.empty():
+            op, stream = self._pending.get()
+            if op == "add":
+                self._selector.register(stream._proc.stdout.fileno(), selectors.EVENT_READ, stream)
+            elif self._unregister(stream):
+                # 已经被读线程注销的流已经交给了维护线程，不重复提交
+                self._pool._dead.put(stream)
+
+    def _unregister(self, stream: PoolStream) -> bool:
+        """注销一路流，这路流不属于本线程(已经注销)时返回False"""
+        if stream._reader is not self:
+            return False
+        try:
+            self._selector.unregister(stream._proc.stdout.fileno())
+        except (KeyError, ValueError):
+            pass
+        stream._reader = None
+        self.stream_num -= 1
+        return True
+
+    def _run(self):
+        while not self._stop:
+            for key, _ in self._selector.select(timeout=1):
+                stream: Union[PoolStream, None] = key.data
+                if stream is None:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    self._handle_pending()
+                elif stream._reader is self and not stream._on_readable():
+                    # 管道关闭，交给维护线程回收进程或重连
+                    self._unregister(stream)
+                    self._pool._dead.put(stream)
+
+        # 线程退出前，把还在监听的流都交给维护线程回收
+        self._handle_pending()
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                self._unregister(key.data)
+                self._pool._dead.put(key.data)
+        self._selector.close()
+
+    def stop(self):
+        self._stop = True
+        os.write(self._wake_w, b"\0")
+        self._thread.join()
+        # 读线程看到_stop可能在上面的write之前就退出了，唤醒管道在线程结束后才能关闭
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class StreamPool:
+    def __init__(self, reader_num: int = 1, accel: Type[Accelerator] = NoAccel,
+                 reconnect_policy: Union[ReconnectPolicy, None] = None, stall_timeout: Union[float, None] = 10.):
+        """
+        管理多路拉流，所有ffmpeg进程的stdout由少量读线程通过selector(epoll)统一读取，
+        不再是每一路流一个阻塞读的线程，适合同时拉取几百路摄像头
+        线程数 = reader_num + 1(维护线程，负责回收退出的ffmpeg进程和断线重连)，和流的路数无关
+        基于管道的selector只支持类Unix系统
+        :param reader_num: 读线程的个数
+        :param accel: 使用的加速器，默认不使用加速器(NoAccel)
+        :param reconnect_policy: 所有流的断线重连策略，见reconnect.ReconnectPolicy，None时使用默认策略；
+                                 等待重连的流由维护线程按时间排队，不会阻塞其他流的重连
+        :param stall_timeout: 和Pull相同，一路流超过这么多秒没有收到新帧(摄像头卡住但没有断开连接)时结束它的ffmpeg进程，
+                              reconn为True时重连，否则这路流失败；所有流由一个看门狗检查函数检查；None表示不检查
+        """
+        assert os.name == "posix", "StreamPool只支持类Unix系统"
+        assert reader_num >= 1
+        assert stall_timeout is None or stall_timeout > 0, "卡顿超时必须大于0"
+        self.accel = accel
+        self.reconnect_policy = reconnect_policy
+
+        # 检查加速器是否可用
+        if not self.accel.check_ffmpeg():
+            logger.warning(f"未安装ffmpeg或当前ffmpeg不支持{self.accel.__name__}加速")
+            self.accel = NoAccel
+        elif self.accel.get_num() <= 0:
+            logger.warning(f"没有可用的{self.accel.__name__}设备或没有正确安装驱动")
+            self.accel = NoAccel
+
+        self._lock = threading.Lock()
+        self._streams: list[PoolStream] = []
+        self._readers = [_Reader(self) for _ in range(reader_num)]
+        self._dead: Queue = Queue()  # 读线程发现管道关闭的流
+        self._retry: list[tuple] = []  # 等待重连的流，(重连时间, 序号, 流, 排队时间)的最小堆，只在维护线程中使用
+        self._retry_seq = 0
+        self._stop = False
+        self._maintain_thread = Thread(target=self._maintain, daemon=True)
+        self._maintain_thread.start()
+        self._stall_timeout = stall_timeout
+        if stall_timeout is not None:
+            watchdog.add(self._check_stalls)
+
+    def _check_stalls(self):
+        """在看门狗线程中定时调用，检查所有流是否卡住"""
+        now = time.monotonic()
+        for stream in self.streams:
+            stream._check_stall(self._stall_timeout, now)
+
+    def add(self, url: str, pix_fmt: str = "rgb24", reconn: bool = False, buffer_size: int = 5,
+            buffer_policy: str = DROP_OLDEST) -> PoolStream:
+        """
+        添加一路拉流，参数和Pull相同，buffer_policy不能是"block"
+        打开失败时返回的流is_opened()为False
+        """
+        stream = PoolStream(self, url, pix_fmt, reconn, buffer_size, buffer_policy)
+        with self._lock:
+            self._streams.append(stream)
+        if stream._launch():
+            self._least_loaded_reader().add(stream)
+        else:
+            logger.error("无法打开视频流")
+            self._dead.put(stream)  # 由维护线程重试(reconn)或者标记为失败
+        return stream
+
+    def add_many(self, urls: Sequence[str], max_workers: int = 32, **kwargs) -> list[PoolStream]:
+        """
+        同时添加多路拉流，最多max_workers路同时探测和启动ffmpeg，总耗时接近最慢的一路，而不是各路耗时之和
+        :param kwargs: add的其他参数，所有流相同
+        :return: 和urls顺序相同的流
+        """
+        if len(urls) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+            return list(executor.map(lambda url: self.add(url, **kwargs), urls))
+
+    def _least_loaded_reader(self) -> _Reader:
+        return min(self._readers, key=lambda r: r.stream_num)
+
+    def remove(self, stream: PoolStream):
+        """关闭并移除一路流"""
+        with self._lock:
+            if stream not in self._streams:
+                return
+            self._streams.remove(stream)
+        stream._reconn = False
+        stream._stop = True
+        # 读线程随时可能注销这路流并把_reader置为None，只读取一次
+        reader = stream._reader
+        if reader is not None:
+            reader.remove(stream)
+        else:
+            self._dead.put(stream)
+
+    def _maintain(self):
+        """维护线程：回收退出的ffmpeg进程，需要时重新探测并重启"""
+        while True:
+            # 一次取出所有待处理的流，它们的ffmpeg进程一起结束、一起等待，关闭几百路流时不用逐个等待；
+            # 有等待重连的流时最多等到最早的重连时间
+            timeout = max(0., self._retry[0][0] - time.monotonic()) if self._retry else None
+            try:
+                batch = [self._dead.get(timeout=timeout)]
+            except Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self._dead.get_nowait())
+                except Empty:
+                    break
+            streams = [stream for stream in batch if stream is not None]
+            waiting = [stream for stream in streams if stream._reader is not None]
+            streams = [stream for stream in streams if stream._reader is None]
+            try:
+                release_processes([stream._proc for stream in streams])
+            except Exception as e:
+                logger.exception(f"回收ffmpeg进程出错: {e}")
+            for stream in streams:
+                stream._proc = None
+                self._guarded(self._restart_or_close, stream)
+            while self._retry and self._retry[0][0] <= time.monotonic():
+                _, _, stream, queued = heapq.heappop(self._retry)
+                if stream._reconn and not stream._stop and not self._stop:
+                    # 出堆时才计入等待时间，等待期间被移除的流不计
+                    stream._backoff.total_wait += time.monotonic() - queued
+                    self._guarded(self._relaunch, stream)
+                else:
+                    self._guarded(self._restart_or_close, stream)
+            if None in batch:
+                break
+            for stream in waiting:
+                # 正在等待读线程注销
+                self._dead.put(stream)
+            if waiting:
+                time.sleep(0.01)
+
+    def _guarded(self, action: Callable[[PoolStream], None], stream: PoolStream):
+        """在维护线程中对一路流执行action，出错时按重连策略排队或者结束这路流，一路流出错不影响整个拉流池的维护"""
+        try:
+            action(stream)
+        except Exception as e:
+            logger.exception(f"{stream._url} 维护出错: {e}")
+            if stream._reconn and not stream._stop and not self._stop:
+                self._schedule(stream, stream._backoff.next_delay())
+            else:
+                if stream._ring is not None:
+                    stream._ring.close()
+                stream._state.set(STOPPED if stream._stop or self._stop else FAILED)
+
+    def _restart_or_close(self, stream: PoolStream):
+        """在维护线程中调用，ffmpeg进程已经回收"""
+        if stream._reconn and not stream._stop and not self._stop:
+            productive = stream._state.state == RUNNING and stream._got_frame
+            if stream._state.state == RUNNING:
+                stream._state.set(RECONNECTING)
+            stream._reuse_info = productive and stream._backoff.policy.reuse_info
+            if productive and not is_stream(stream._url):
+                # 视频文件播放完，立即从头播放
+                self._relaunch(stream)
+            else:
+                self._schedule(stream, stream._backoff.next_delay())
+        else:
+            if stream._ring is not None:
+                stream._ring.close()
+            # 主动移除或者视频文件播放完是正常结束，视频流断线不再重连、打开失败是失败
+            if stream._stop or self._stop or (stream._state.state == RUNNING and not is_stream(stream._url)):
+                stream._state.set(STOPPED)
+            else:
+                stream._state.set(FAILED)
+
+    def _relaunch(self, stream: PoolStream):
+        """在维护线程中调用，重启一路流，失败时按重连策略排队等待下一次"""
+        if stream._launch():
+            if stream._stop:
+                # 重启期间被移除了
+                self._dead.put(stream)
+            else:
+                self._least_loaded_reader().add(stream)
+        else:
+            self._schedule(stream, stream._backoff.next_delay())
+
+    def _schedule(self, stream: PoolStream, delay: float):
+        """delay秒后由维护线程重启stream"""
+        self._retry_seq += 1
+        now = time.monotonic()
+        heapq.heappush(self._retry, (now + delay, self._retry_seq, stream, now))
+
+    @property
+    def streams(self) -> list[PoolStream]:
+        with self._lock:
+            return list(self._streams)
+
+    def stats(self) -> dict:
+        """拉流池的运行状态，用来观察线程数和CPU占用随流的路数的变化"""
+        return {
+            "streams": len(self._streams),
+            "opened": sum(1 for s in self._streams if s.is_opened()),
+            "waiting_reconnect": len(self._retry),  # 按重连策略等待重连的流
+            "circuit_open": sum(1 for s in self._streams if s._backoff.circuit_open),
+            "stalls": sum(s._stalls for s in self._streams),  # 因为卡住而重启的次数
+            "pool_threads": len(self._readers) + 1,
+            "process_threads": threading.active_count(),
+            "cpu_time": time.process_time(),
+        }
+
+    def release(self):
+        """关闭所有的流和线程"""
+        if self._stall_timeout is not None:
+            watchdog.remove(self._check_stalls)
+        for stream in self.streams:
+            self.remove(stream)
+        self._stop = True
+        for reader in self._readers:
+            reader.stop()
+        self._dead.put(None)
+        self._maintain_thread.join()
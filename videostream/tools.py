@@ -1,14 +1,23 @@
 import shlex
 from subprocess import check_output, STDOUT, CalledProcessError, Popen, TimeoutExpired, DEVNULL, PIPE
 import json
-from typing import Sequence
-import os
-import signal
+from typing import Sequence, Union
+import threading
+import time
 
 
 stream_protocols = ["rtmp", "rtsp", "http", "https", "rtmps", "hls", "dash", "m3u8"]
 video_format = ["mp4", "mkv", "flv", "avi", "mov"]
 
+# 低延迟探测：只读少量数据、不等待分析时长、不缓冲，显著缩短连接视频流的时间，
+# 代价是帧率等信息可能不准确，探测不到宽高时get_info会自动用默认参数重试
+# 只用于视频流，视频文件本来就探测得很快，而且nobuffer会让mp4等文件丢帧
+FAST_PROBE_OPT = "-probesize 500000 -analyzeduration 500000 -fflags nobuffer"
+
+PROBE_CACHE_TTL = 10.  # 探测结果的缓存时间(秒)
+_probe_cache: dict[tuple, tuple] = dict()  # (url, audio, fast) -> (探测时间, 流信息)
+_probe_cache_lock = threading.Lock()
+
 
 def is_stream(url: str) -> bool:
     """
@@ -55,30 +64,126 @@ def get_out_numpy_shape(size_wh: Sequence, pix_fmt: str) -> tuple:
     return out_numpy_shape
 
 
-def get_info(url: str, audio=False) -> list[dict]:
+def get_out_size(size_wh: Sequence, size: Union[Sequence, None] = None, crop: Union[Sequence, None] = None) -> tuple:
+    """
+    计算裁剪、缩放之后输出帧的宽高
+    :param size_wh: 源视频的宽高
+    :param size: 缩放后的(宽, 高)，其中一个为-1时按裁剪后的宽高比计算，并取偶数
+    :param crop: 裁剪区域(x, y, 宽, 高)，在缩放之前进行
+    :return: (宽, 高)
+    """
+    width, height = size_wh
+    if crop is not None:
+        x, y, cw, ch = crop
+        assert x >= 0 and y >= 0 and cw > 0 and ch > 0, "裁剪区域不合法"
+        assert x + cw <= width and y + ch <= height, f"裁剪区域{tuple(crop)}超出了画面{width}x{height}"
+        width, height = cw, ch
+    if size is None:
+        return width, height
+    w, h = size
+    assert not (w == -1 and h == -1) and (w > 0 or w == -1) and (h > 0 or h == -1), "缩放尺寸不合法"
+    if w == -1:
+        w = max(2, int(round(width * h / height / 2)) * 2)
+    elif h == -1:
+        h = max(2, int(round(height * w / width / 2)) * 2)
+    return w, h
+
+
+def make_probe_cmd(url: str, audio=False, fast=False) -> str:
+    """
+    构造获取流信息的ffprobe命令
+    :param fast: 对视频流使用低延迟探测参数FAST_PROBE_OPT
+    """
+    select_streams = "" if audio else "-select_streams v"
+    rtsp_flag = "-rtsp_transport tcp" if url.startswith("rtsp://") else ""
+    fast_opt = FAST_PROBE_OPT if fast and is_stream(url) else ""
+    return (f"ffprobe -v error -timeout 2000000 {rtsp_flag} {fast_opt} {select_streams} "
+            f"-print_format json -show_streams -i '{url}'")
+
+
+def parse_probe_output(output: str) -> list[dict]:
+    """解析ffprobe输出的json，返回流信息列表"""
+    # 如果数据包有问题，前几行会输出错误信息，所以需要去掉这些错误信息
+    sp, ep = -1, len(output)
+    for i, c in enumerate(output):
+        if sp == -1 and c == '{':
+            sp = i
+        if c == '}':
+            ep = i + 1
+
+    output = json.loads(output[sp:ep])
+    return output['streams']
+
+
+def get_cached_info(url: str, audio=False, max_age: float = PROBE_CACHE_TTL,
+                    fast=False) -> Union[list[dict], None]:
+    """
+    取缓存的探测结果，没有缓存或者已经超过max_age秒时返回None
+    低延迟探测的结果可能缺少码率、profile等字段，只返回给同样使用低延迟探测的调用方；完整探测的结果都可以用
+    """
+    now = time.monotonic()
+    with _probe_cache_lock:
+        candidates = [_probe_cache.get((url, audio, False))]
+        if fast:
+            candidates.append(_probe_cache.get((url, audio, True)))
+    cached = max((c for c in candidates if c is not None and now - c[0] <= max_age), default=None,
+                 key=lambda c: c[0])
+    if cached is None:
+        return None
+    # 每次返回一份拷贝，调用方修改流信息不影响缓存
+    return [dict(stream) for stream in cached[1]]
+
+
+def cache_info(url: str, audio, info: list[dict], fast=False):
+    """
+    缓存探测结果，供get_info和async_get_info共用
+    同时删除超过PROBE_CACHE_TTL的旧结果，打开过很多不同url时缓存不会一直增长
+    :param fast: 是否是低延迟探测的结果
+    """
+    now = time.monotonic()
+    with _probe_cache_lock:
+        for key in [key for key, (probed_at, _) in _probe_cache.items() if now - probed_at > PROBE_CACHE_TTL]:
+            del _probe_cache[key]
+        _probe_cache[(url, audio, fast)] = (now, [dict(stream) for stream in info])
+
+
+def clear_info_cache(url: Union[str, None] = None):
+    """清除url的探测结果缓存，url为None时清除全部缓存"""
+    with _probe_cache_lock:
+        if url is None:
+            _probe_cache.clear()
+            return
+        for key in [key for key in _probe_cache if key[0] == url]:
+            del _probe_cache[key]
+
+
+def has_video_size(info: list[dict]) -> bool:
+    """探测结果中是否有视频流的宽高，低延迟探测读的数据太少时可能没有"""
+    return any(s.get("codec_type", "video") == "video" and s.get("width") and s.get("height") for s in info)
+
+
+def get_info(url: str, audio=False, fast=False, max_age: float = PROBE_CACHE_TTL) -> list[dict]:
     """
     获取视频文件或RTSP流的信息
+    max_age秒内探测过的url直接返回缓存的结果，同一个流打开时不会重复运行ffprobe
     视频URL有问题时回抛出异常信息
     :param url: 视频地址
     :param audio: 是否获取音频流信息, 默认不获取
+    :param fast: 对视频流使用低延迟探测参数，探测不到宽高时用默认参数重试
+    :param max_age: 缓存的有效时间(秒)，0表示重新探测，例如重连后分辨率可能已经改变
     :return: 流信息列表
     """
-    select_streams = "" if audio else "-select_streams v"
-    rtsp_flag = "-rtsp_transport tcp" if url.startswith("rtsp://") else ""
-    cmd = f"ffprobe -v error -timeout 2000000 {rtsp_flag} {select_streams} -print_format json -show_streams -i '{url}'"
+    info = get_cached_info(url, audio, max_age, fast)
+    if info is not None:
+        return info
+
     try:
-        output = check_output(shlex.split(cmd), shell=False, stderr=STDOUT).decode("utf-8")
-
-        # 如果数据包有问题，前几行会输出错误信息，所以需要去掉这些错误信息
-        sp, ep = -1, len(output)
-        for i, c in enumerate(output):
-            if sp == -1 and c == '{':
-                sp = i
-            if c == '}':
-                ep = i + 1
-
-        output = json.loads(output[sp:ep])
-        return output['streams']
+        output = check_output(shlex.split(make_probe_cmd(url, audio, fast)), shell=False, stderr=STDOUT)
+        info = parse_probe_output(output.decode("utf-8"))
+        if fast and not has_video_size(info):
+            output = check_output(shlex.split(make_probe_cmd(url, audio)), shell=False, stderr=STDOUT)
+            info = parse_probe_output(output.decode("utf-8"))
+            fast = False  # 已经换成了完整探测
     except CalledProcessError as e:
         # 可能的错误：
         # 1、ffprobe命令不可用
@@ -86,11 +191,61 @@ def get_info(url: str, audio=False) -> list[dict]:
         # 3、文件格式错误，不是视频文件
         # 4、rtsp地址错误
         raise ValueError(e.output.decode('utf-8'))
+    cache_info(url, audio, info, fast)
+    return info
+
+
+def get_frame_index(url: str) -> dict:
+    """
+    用ffprobe读取视频文件中第一路视频流所有数据包的显示时间和关键帧标志，只解析不解码
+    视频URL有问题时回抛出异常信息
+    :param url: 视频文件地址
+    :return: {"start_time": 文件的起始时间,
+              "pts": 按显示时间排序的每一帧的时间(秒),
+              "keyframes": 关键帧在pts中的下标}
+    """
+    cmd = (f"ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags:format=start_time "
+           f"-print_format json -i '{url}'")
+    try:
+        output = json.loads(check_output(shlex.split(cmd), shell=False, stderr=DEVNULL).decode("utf-8"))
+    except CalledProcessError:
+        raise ValueError(f"无法读取视频文件的帧索引: {url}")
+
+    # 去掉没有时间戳和标记为丢弃(D)的数据包，剩下的每个数据包解码后对应一帧
+    packets = [(float(p["pts_time"]), "K" in p.get("flags", ""))
+               for p in output.get("packets", [])
+               if p.get("pts_time", "N/A") != "N/A" and "D" not in p.get("flags", "")]
+    packets.sort(key=lambda p: p[0])
+    start_time = output.get("format", {}).get("start_time", "N/A")
+    return {
+        "start_time": float(start_time) if start_time != "N/A" else (packets[0][0] if packets else 0.),
+        "pts": [p[0] for p in packets],
+        "keyframes": [i for i, p in enumerate(packets) if p[1]],
+    }
 
 
-def run_async(args):
+def make_seek_opt(index: dict, start: int) -> str:
+    """
+    构造从第start帧(必须是关键帧)开始解码的seek参数，配合-copyts使用
+    seek点取在这个关键帧和它的下一帧中间，向前seek时一定落在这个关键帧上
+    :param index: get_frame_index的返回值
+    """
+    if start <= 0:
+        return ""
+    pts = index["pts"]
+    next_pts = pts[start + 1] if start + 1 < len(pts) else pts[start] + 1
+    seek_t = (pts[start] + next_pts) / 2 - index["start_time"]
+    return f"-noaccurate_seek -ss {seek_t:.6f}"
+
+
+def run_async(args, pass_fds: Sequence[int] = (), capture_stderr: bool = False):
+    """
+    启动子进程，stdin和stdout为管道
+    :param pass_fds: 额外传给子进程的文件描述符，子进程中的编号不变
+    :param capture_stderr: stderr也使用管道，调用方需要一直读取，否则子进程写满管道后会阻塞
+    """
     quiet = True
-    stderr_stream = DEVNULL if quiet else None
+    stderr_stream = PIPE if capture_stderr else (DEVNULL if quiet else None)
     bufsize = -1
     if isinstance(args, str):
         args = shlex.split(args)
@@ -101,27 +256,44 @@ def run_async(args):
         stderr=stderr_stream,
         shell=False,
         bufsize=bufsize,
+        pass_fds=tuple(pass_fds),
     )
 
 
-def release_process(proc: Popen):
-    if hasattr(proc, "stdin") and proc.stdin is not None:
-        proc.stdin.close()
-    if hasattr(proc, "stdout") and proc.stdout is not None:
-        proc.stdout.close()
-    if hasattr(proc, "terminate"):
-        proc.terminate()
-    if hasattr(proc, "wait"):
+def release_processes(procs: Sequence[Popen], timeout: float = 5.):
+    """
+    同时关闭多个子进程：先关闭所有管道、向所有进程发送terminate，再一起等待，
+    总耗时取决于最慢的一个进程，而不是每个进程依次等待
+    :param timeout: 所有进程共用的等待时间(秒)，超时仍未退出的进程被强制杀死
+    """
+    procs = [proc for proc in procs if proc is not None]
+    for proc in procs:
+        if hasattr(proc, "stdin") and proc.stdin is not None:
+            try:
+                proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                # 子进程已经退出，缓冲区中还没写出的数据无法再写入
+                pass
+        if hasattr(proc, "stdout") and proc.stdout is not None:
+            proc.stdout.close()
+        if hasattr(proc, "terminate"):
+            proc.terminate()
+
+    deadline = time.monotonic() + timeout
+    for proc in procs:
+        if not hasattr(proc, "wait"):
+            continue
         try:
-            # 等待5秒，如果terminate没有正常结束进程，则强制杀死进程
-            proc.wait(timeout=5)
+            proc.wait(timeout=max(0., deadline - time.monotonic()))
         except TimeoutExpired:
-            if hasattr(os, "killpg"):
-                os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
-            elif hasattr(os, "kill"):
-                os.kill(proc.pid, signal.SIGKILL)
-            else:
-                proc.kill()
+            # 只杀死这个进程本身；子进程和我们在同一个进程组中，不能用killpg
+            proc.kill()
+            proc.wait()
+
+
+def release_process(proc: Popen):
+    """关闭子进程，等待5秒，terminate没有正常结束进程则强制杀死"""
+    release_processes([proc])
 
 
 if __name__ == '__main__':